@@ -1,15 +1,20 @@
 # SPDX-FileCopyrightText: © Cesar Velazquez <cesarve@gmail.com>
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from krita import (DockWidgetFactory,
-                   DockWidgetFactoryBase)
+try:
+    from krita import (DockWidgetFactory,
+                       DockWidgetFactoryBase)
+except ImportError:
+    # imported outside of Krita, e.g. by version_manager.maintenance
+    DockWidgetFactory = None
 
-# from .version_manager_gui import VersionManagerGui
-from .qt_docker_widget import QtDocker
+if DockWidgetFactory is not None:
+    # from .version_manager_gui import VersionManagerGui
+    from .qt_docker_widget import QtDocker
 
-doc_widget_factory = DockWidgetFactory(
-    "document_version_manager",
-    DockWidgetFactoryBase.DockRight,
-    QtDocker)
+    doc_widget_factory = DockWidgetFactory(
+        "document_version_manager",
+        DockWidgetFactoryBase.DockRight,
+        QtDocker)
 
-Krita.instance().addDockWidgetFactory(doc_widget_factory)
+    Krita.instance().addDockWidgetFactory(doc_widget_factory)
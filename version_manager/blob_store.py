@@ -0,0 +1,743 @@
+# SPDX-FileCopyrightText: © Cesar Velazquez <cesarve@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import contextlib
+import errno
+import hashlib
+import io
+import mmap
+import os
+import stat
+import tempfile
+import time
+import zlib
+
+from . import copy_engine, delta, recompress
+
+# size of read/write chunks used while hashing (in bytes)
+default_buffer_size = 4 * 1024 * 1024
+
+
+# suffix of objects stored as a delta against another object
+delta_suffix = ".delta"
+
+# deltas larger than this fraction of their target are not kept
+max_delta_ratio = 0.5
+
+# suffix of objects recompressed with version_manager.recompress
+recompressed_suffix = ".lzma"
+
+# all ways an object can be stored, by file name suffix
+_suffixes = ("", delta_suffix, recompressed_suffix)
+
+
+class BlobStore(object):
+    """Content addressed storage for checkpoint payloads.
+
+    Every object is stored once, named after the hex digest of its content:
+
+        <root>/<first 2 hex digits>/<remaining hex digits>
+
+    An object can also be stored as a delta against another object, in
+    which case its file name has a ".delta" suffix, or recompressed with
+    LZMA (".lzma" suffix). Either way reading it gives back the original
+    content.
+
+    Objects can be moved into a version_manager.packfile.PackFile, where
+    they are stored under the key "objects/<name of the loose file>".
+    Loose objects are preferred over packed ones.
+    """
+
+    hash_name = "sha256"
+
+    def __init__(self, root, buffer_size=default_buffer_size, reporter=None, pack=None):
+        """
+        Arguments:
+        root (str) - Directory holding the objects
+        buffer_size (int) - Size of chunks used when copying data (in bytes)
+        reporter (callable) - Receives messages describing copies (optional)
+        pack (version_manager.packfile.PackFile) - pack holding packed objects (optional)
+        """
+
+        self._root = root
+        self._buffer_size = buffer_size
+        self._reporter = reporter
+        self._pack = pack
+
+        # bytes added to the object directory (negative if removed) since
+        # the owner last reset it. Lets the owner keep track of the disk
+        # usage without walking the directory. Packed data is counted by
+        # the pack.
+        self.usage_change = 0
+
+    def report(self, msg):
+        """Sends a message to the reporter"""
+        if self._reporter:
+            self._reporter(msg)
+
+    @property
+    def root(self):
+        """Absolute path to object directory"""
+        return self._root
+
+    def object_path(self, digest):
+        """Returns the path to the object with the given digest"""
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def delta_path(self, digest):
+        """Returns the path to the delta of the object with the given digest"""
+        return self.object_path(digest) + delta_suffix
+
+    def recompressed_path(self, digest):
+        """Returns the path to the recompressed object with the given digest"""
+        return self.object_path(digest) + recompressed_suffix
+
+    def pack_key(self, digest, suffix=""):
+        """Returns the key of an object in the pack"""
+        return f"objects/{digest}{suffix}"
+
+    def _packed(self, key):
+        return self._pack is not None and key in self._pack
+
+    def _locate(self, digest):
+        """Finds the stored file of an object.
+
+        Returns (suffix, loose filename, pack key). Only one of filename
+        and key is set, loose files are preferred. Returns None if the
+        object is not stored.
+        """
+
+        for suffix in _suffixes:
+            filename = self.object_path(digest) + suffix
+            if os.path.isfile(filename):
+                return suffix, filename, None
+        for suffix in _suffixes:
+            key = self.pack_key(digest, suffix)
+            if self._packed(key):
+                return suffix, None, key
+        return None
+
+    def _open_stored(self, digest):
+        """Opens the stored file of an object as it is (possibly encoded)"""
+
+        found = self._locate(digest)
+        if found is None:
+            filename = self.object_path(digest)
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), filename)
+        _, filename, key = found
+        if filename is not None:
+            return open(filename, "rb")
+        return self._pack.open(key)
+
+    def stored_size(self, digest):
+        """Returns the number of bytes an object takes up in the store
+        (loose or packed), 0 if it is not stored
+        """
+
+        found = self._locate(digest)
+        if found is None:
+            return 0
+        _, filename, key = found
+        if filename is not None:
+            return os.path.getsize(filename)
+        return self._pack.locate(key)[2]
+
+    def is_loose(self, digest):
+        """Returns True if the object is stored as a loose file"""
+        found = self._locate(digest)
+        return found is not None and found[1] is not None
+
+    def exists(self, digest):
+        """Returns True if an object with the given digest is stored"""
+        return self._locate(digest) is not None
+
+    def is_delta(self, digest):
+        """Returns True if the object is stored as a delta"""
+        found = self._locate(digest)
+        return found is not None and found[0] == delta_suffix
+
+    def is_recompressed(self, digest):
+        """Returns True if the object is recompressed"""
+        found = self._locate(digest)
+        return found is not None and found[0] == recompressed_suffix
+
+    def delta_base(self, digest):
+        """Returns (base digest, chain depth) of an object stored as a delta"""
+
+        with self._open_stored(digest) as file_in:
+            base, depth, _ = delta.read_header(file_in)
+        return base, depth
+
+    def chain_depth(self, digest):
+        """Returns the number of deltas needed to rebuild an object"""
+
+        if not self.is_delta(digest):
+            return 0
+        return self.delta_base(digest)[1]
+
+    def closure(self, digests):
+        """Returns the given digests plus the bases of all deltas among them"""
+
+        result = set(digests)
+        pending = list(result)
+        while pending:
+            digest = pending.pop()
+            if self.is_delta(digest):
+                base, _ = self.delta_base(digest)
+                if base not in result:
+                    result.add(base)
+                    pending.append(base)
+        return result
+
+    def loose_digests(self):
+        """Generator yielding the digest of every loose object"""
+
+        if not os.path.isdir(self.root):
+            return
+
+        for fanout in os.listdir(self.root):
+            fanout_dir = os.path.join(self.root, fanout)
+            if len(fanout) != 2 or not os.path.isdir(fanout_dir):
+                continue
+            for name in os.listdir(fanout_dir):
+                yield fanout + _strip_suffix(name)
+
+    def packed_digests(self):
+        """Generator yielding the digest of every packed object"""
+
+        if self._pack is None:
+            return
+
+        for key, _ in self._pack.items("objects/"):
+            yield _strip_suffix(key[len("objects/") :])
+
+    def digests(self):
+        """Generator yielding the digest of every stored object"""
+
+        for digest in self.loose_digests():
+            yield digest
+        for digest in self.packed_digests():
+            yield digest
+
+    def store_file(self, filename):
+        """Copies a file into the store.
+
+        On copy-on-write filesystems the file is cloned (reflink) and the
+        clone is hashed. Otherwise the digest is computed while the file
+        is being copied. Either way the source is only read once.
+        Nothing new is written to the store if an object with the same
+        content exists already.
+
+        Parameters:
+        filename (str) - file to store
+
+        Returns (digest, size, stored) where stored is False if the
+        content was already present in the store.
+        """
+
+        os.makedirs(self.root, exist_ok=True)
+
+        fd, tmp_filename = tempfile.mkstemp(prefix="tmp_", dir=self.root)
+        os.close(fd)
+        try:
+            result = copy_engine.copy_file(filename, tmp_filename, allowed=("reflink",))
+        except OSError as e:
+            # copy_file() leaves the temporary file behind on fatal errors
+            if os.path.lexists(tmp_filename):
+                os.remove(tmp_filename)
+            if e.errno in copy_engine._fatal_errors:
+                raise
+            # no copy-on-write support
+        else:
+            try:
+                hasher = hashlib.new(self.hash_name)
+                with open(tmp_filename, "rb") as file_in:
+                    while True:
+                        chunk = file_in.read(self._buffer_size)
+                        if not chunk:
+                            break
+                        hasher.update(chunk)
+                digest = hasher.hexdigest()
+                self.report(f"Stored {filename} ({result})")
+                return (digest, result.size, self._commit(tmp_filename, digest))
+            except BaseException:
+                if os.path.exists(tmp_filename):
+                    os.remove(tmp_filename)
+                raise
+
+        start = time.perf_counter()
+        with open(filename, "rb") as file_in:
+            digest, size, stored = self.store_stream(file_in)
+        result = copy_engine.CopyResult("hashed copy", size, time.perf_counter() - start)
+        self.report(f"Stored {filename} ({result})")
+        return (digest, size, stored)
+
+    def store_stream(self, file_in, size=None):
+        """Copies data from an open file into the store.
+
+        Parameters:
+        file_in (file) - binary file object to read from
+        size (int) - Number of bytes to copy. Copies until EOF if None.
+
+        Returns (digest, size, stored). See store_file()
+        """
+
+        os.makedirs(self.root, exist_ok=True)
+
+        hasher = hashlib.new(self.hash_name)
+        copied = 0
+
+        # copy into a temporary object while hashing
+        fd, tmp_filename = tempfile.mkstemp(prefix="tmp_", dir=self.root)
+        try:
+            with os.fdopen(fd, "wb") as file_out:
+                while size is None or copied < size:
+                    length = self._buffer_size
+                    if size is not None:
+                        length = min(length, size - copied)
+                    chunk = file_in.read(length)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    file_out.write(chunk)
+                    copied += len(chunk)
+            if size is not None and copied != size:
+                raise EOFError(f"Expected {size} bytes, only {copied} available")
+            digest = hasher.hexdigest()
+            return (digest, copied, self._commit(tmp_filename, digest))
+        except BaseException:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+
+    def store_bytes(self, data):
+        """Stores a bytes object. Returns (digest, size, stored)"""
+
+        return self.store_stream(io.BytesIO(data))
+
+    def read_bytes(self, digest):
+        """Returns the content of an object"""
+
+        with self.open(digest) as file_in:
+            return file_in.read()
+
+    def open(self, digest, inflated=False):
+        """Opens an object for reading in binary mode
+
+        Parameters:
+        digest (str) - object to open
+        inflated (bool) - For recompressed zip members, read the uncompressed
+            member data instead (see recompress.DeflateMismatch)
+        """
+
+        found = self._locate(digest)
+        if found is not None and found[0] == "":
+            if found[1] is not None:
+                return open(found[1], "rb")
+            return self._pack.open(found[2])
+
+        file_out = tempfile.TemporaryFile(dir=self.root)
+        try:
+            self._write_content(digest, file_out, inflated)
+        except BaseException:
+            file_out.close()
+            raise
+        file_out.seek(0)
+        return file_out
+
+    @contextlib.contextmanager
+    def _buffer(self, digest, searchable=False):
+        """Context manager giving random access to the content of an object
+
+        Parameters:
+        digest (str) - object to access
+        searchable (bool) - The buffer must support find()
+        """
+
+        found = self._locate(digest)
+        if found is not None and found[0] == "":
+            if found[1] is not None:
+                with _map_file(found[1]) as data:
+                    yield data
+                return
+            if not searchable:
+                yield self._pack.view(found[2])
+                return
+
+        # rebuild into a temporary file
+        fd, tmp_filename = tempfile.mkstemp(prefix="tmp_", dir=self.root)
+        try:
+            with os.fdopen(fd, "wb") as file_out:
+                self._write_content(digest, file_out)
+            with _map_file(tmp_filename) as data:
+                yield data
+        finally:
+            os.remove(tmp_filename)
+
+    def _write_content(self, digest, file_out, inflated=False):
+        """Writes the content of an object to an open file, whichever way
+        it is stored. See open() for inflated.
+        """
+
+        found = self._locate(digest)
+        if found is None:
+            filename = self.object_path(digest)
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), filename)
+
+        suffix = found[0]
+        if suffix == delta_suffix:
+            self._materialize(digest, file_out)
+            return
+
+        with self._open_stored(digest) as file_in:
+            if suffix == "":
+                while True:
+                    chunk = file_in.read(self._buffer_size)
+                    if not chunk:
+                        break
+                    file_out.write(chunk)
+                return
+
+            if inflated:
+                recompress.decode(file_in, file_out, inflated=True)
+                return
+
+            # deflated members are rebuilt with this zlib, make sure
+            # that gives back the original bytes
+            writer = _HashingWriter(file_out, hashlib.new(self.hash_name))
+            recompress.decode(file_in, writer)
+            if writer.hexdigest() != digest:
+                raise recompress.DeflateMismatch(
+                    f"Object {digest} cannot be reproduced with zlib "
+                    f"{zlib.ZLIB_RUNTIME_VERSION}"
+                )
+
+    def _materialize(self, digest, file_out):
+        """Writes the content of an object stored as a delta to a file"""
+
+        base, _ = self.delta_base(digest)
+        with self._buffer(base) as base_data, self._open_stored(digest) as file_in:
+            delta.apply(base_data, file_in, file_out)
+
+    def store_delta(self, digest, base, max_chain_length):
+        """Replaces a stored object with a delta against another object.
+
+        Nothing changes if the delta chain would become longer than
+        max_chain_length (the object stays a full keyframe) or if the
+        delta is not much smaller than the object.
+
+        Parameters:
+        digest (str) - object to replace with a delta
+        base (str) - object the delta is computed against
+        max_chain_length (int) - maximum number of deltas needed to rebuild an object
+
+        Returns True if the object is now stored as a delta
+        """
+
+        target = self.object_path(digest)
+        if not os.path.isfile(target):
+            return False
+
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp_filename = tempfile.mkstemp(prefix="tmp_", dir=self.root)
+        os.close(fd)
+        try:
+            if not self.compute_delta(target, digest, base, max_chain_length, tmp_filename):
+                return False
+            self.commit_delta(digest, tmp_filename)
+        finally:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+        return True
+
+    def compute_delta(self, filename, digest, base, max_chain_length, delta_filename):
+        """Writes the delta of a file against a stored object, without
+        changing the store. See commit_delta().
+
+        Parameters:
+        filename (str) - content of object digest, e.g. a staged object
+        digest (str) - digest of the file
+        base (str) - object the delta is computed against
+        max_chain_length (int) - maximum number of deltas needed to rebuild an object
+        delta_filename (str) - file receiving the delta
+
+        Returns False if no delta should be stored: the chain would become
+        longer than max_chain_length, or the delta is not much smaller
+        than the file.
+        """
+
+        if digest == base or not self.exists(base):
+            return False
+
+        depth = self.chain_depth(base) + 1
+        if depth > max_chain_length:
+            self.report(f"Keeping {digest} as keyframe")
+            return False
+
+        start = time.perf_counter()
+        size = os.path.getsize(filename)
+        with open(delta_filename, "wb") as file_out:
+            with self._buffer(base, searchable=True) as base_data:
+                with _map_file(filename) as target_data:
+                    delta_size = delta.compute(base_data, target_data, file_out, base, depth)
+
+        if delta_size > size * max_delta_ratio:
+            self.report(f"Keeping {digest} as keyframe, delta too large")
+            return False
+
+        self.report(
+            "Computed delta of {} against {} ({:.1f} MB -> {:.1f} MB in {:.2f} s)".format(
+                digest, base, size / 1e6, delta_size / 1e6, time.perf_counter() - start
+            )
+        )
+        return True
+
+    def commit_delta(self, digest, delta_filename):
+        """Replaces the loose object digest with a delta written by
+        compute_delta(). The delta file is renamed, it must be on the
+        same file system as the store.
+        """
+
+        target = self.object_path(digest)
+        size = os.path.getsize(target)
+        delta_size = os.path.getsize(delta_filename)
+
+        os.chmod(delta_filename, stat.S_IREAD | stat.S_IRGRP | stat.S_IROTH)
+        os.replace(delta_filename, self.delta_path(digest))
+        os.chmod(target, stat.S_IWRITE | stat.S_IREAD)
+        os.remove(target)
+        self.usage_change += delta_size - size
+        self.report(f"Stored {digest} as delta ({size / 1e6:.1f} MB -> {delta_size / 1e6:.1f} MB)")
+
+    def _commit(self, tmp_filename, digest):
+        """Moves a temporary file into place as object <digest>.
+
+        Returns False if the object existed already.
+        """
+
+        target = self.object_path(digest)
+
+        if self.exists(digest):
+            os.remove(tmp_filename)
+            return False
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        # objects are immutable. Making them read-only also protects them
+        # from being written to through a hard link.
+        os.chmod(tmp_filename, stat.S_IREAD | stat.S_IRGRP | stat.S_IROTH)
+        self.usage_change += os.path.getsize(tmp_filename)
+        os.replace(tmp_filename, target)
+        return True
+
+    def export(self, digest, target, link=False):
+        """Writes the content of an object to a file.
+
+        Parameters:
+        digest (str) - digest of the object to export
+        target (str) - file to write
+        link (bool) - Allow the target to be a hard link to the object.
+
+        Returns version_manager.copy_engine.CopyResult
+        """
+
+        found = self._locate(digest)
+        if found is not None and found[0] != "":
+            start = time.perf_counter()
+            with open(target, "wb") as file_out:
+                self._write_content(digest, file_out)
+            result = copy_engine.CopyResult(
+                "delta" if found[0] == delta_suffix else "lzma",
+                os.path.getsize(target),
+                time.perf_counter() - start,
+            )
+            self.report(f"Rebuilt {digest} -> {target} ({result})")
+            return result
+
+        source = self.object_path(digest)
+        if not os.path.isfile(source):
+            key = self.pack_key(digest)
+            if not self._packed(key):
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), source)
+            start = time.perf_counter()
+            self._pack.extract(key, target)
+            result = copy_engine.CopyResult(
+                "pack", os.path.getsize(target), time.perf_counter() - start
+            )
+            self.report(f"Extracted {digest} -> {target} ({result})")
+            return result
+
+        result = copy_engine.copy_file(source, target, link=link)
+        self.report(f"Exported {digest} -> {target} ({result})")
+        return result
+
+    def remove(self, digest):
+        """Deletes the loose files of an object"""
+
+        for suffix in _suffixes:
+            filename = self.object_path(digest) + suffix
+            if not os.path.exists(filename):
+                continue
+            os.chmod(filename, stat.S_IWRITE | stat.S_IREAD)
+            # a hard linked checkout keeps the data on disk
+            info = os.stat(filename)
+            if info.st_nlink == 1:
+                self.usage_change -= info.st_size
+            os.remove(filename)
+
+    def adopt(self, other):
+        """Moves the loose objects of another store into this one.
+
+        The objects are renamed, both stores must be on the same file
+        system. Objects this store holds already are dropped.
+
+        Parameters:
+        other (BlobStore) - store to empty, e.g. one staging a new checkpoint
+
+        Returns set of digests of the moved objects
+        """
+
+        moved = set()
+        for digest in list(other.loose_digests()):
+            if self.exists(digest):
+                other.remove(digest)
+                continue
+            suffix, filename, _ = other._locate(digest)
+            target = self.object_path(digest) + suffix
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            size = os.path.getsize(filename)
+            os.replace(filename, target)
+            self.usage_change += size
+            moved.add(digest)
+        return moved
+
+    def loose_records(self, digests):
+        """Returns (pack key, filename) pairs for the loose files of objects"""
+
+        records = []
+        for digest in digests:
+            for suffix in _suffixes:
+                filename = self.object_path(digest) + suffix
+                if os.path.isfile(filename):
+                    records.append((self.pack_key(digest, suffix), filename))
+                    break
+        return records
+
+    def object_range(self, digest):
+        """Returns (filename, offset, size) of the data of an object that
+        is stored as is (not as a delta or recompressed), loose or packed.
+
+        Lets other processes read the object without a BlobStore.
+        """
+
+        found = self._locate(digest)
+        if found is None or found[0] != "":
+            raise ValueError(f"Object {digest} is not stored as is")
+        if found[1] is not None:
+            return found[1], 0, os.path.getsize(found[1])
+        return self._pack.locate(found[2])
+
+    def store_recompressed(self, recompressed):
+        """Replaces objects with their recompressed version.
+
+        Loose objects stay loose, packed objects stay packed.
+
+        Parameters:
+        recompressed (list) - (digest, filename) pairs. filename is a file
+            written by recompress.encode() inside the object directory.
+        """
+
+        records = []
+        packed_keys = []
+        for digest, filename in recompressed:
+            found = self._locate(digest)
+            if found is None or found[0] != "":
+                os.remove(filename)
+            elif found[1] is not None:
+                os.chmod(filename, stat.S_IREAD | stat.S_IRGRP | stat.S_IROTH)
+                self.usage_change += os.path.getsize(filename) - os.path.getsize(found[1])
+                os.replace(filename, self.recompressed_path(digest))
+                os.chmod(found[1], stat.S_IWRITE | stat.S_IREAD)
+                os.remove(found[1])
+            else:
+                records.append((self.pack_key(digest, recompressed_suffix), filename))
+                packed_keys.append(found[2])
+
+        if records:
+            try:
+                self._pack.append(records)
+                self._pack.remove(packed_keys)
+            finally:
+                for _, filename in records:
+                    os.remove(filename)
+
+    def prune(self, referenced):
+        """Removes all objects that are not referenced.
+
+        Parameters:
+        referenced (set) - digests of objects to keep. The bases of
+            deltas among them are kept as well.
+
+        Returns list of removed digests
+        """
+
+        referenced = self.closure(referenced)
+
+        removed = []
+        for digest in list(self.loose_digests()):
+            if digest in referenced:
+                continue
+            self.remove(digest)
+            removed.append(digest)
+
+        unused_keys = []
+        for digest in list(self.packed_digests()):
+            if digest in referenced:
+                continue
+            unused_keys.extend(self.pack_key(digest, suffix) for suffix in _suffixes)
+            removed.append(digest)
+        if unused_keys:
+            self._pack.remove(unused_keys)
+
+        return removed
+
+
+def _strip_suffix(name):
+    """Returns the digest part of the name of a stored object file"""
+
+    for suffix in _suffixes[1:]:
+        if name.endswith(suffix):
+            return name[: -len(suffix)]
+    return name
+
+
+class _HashingWriter(object):
+    """Writes to a file and hashes everything written"""
+
+    def __init__(self, file_out, hasher):
+        self._file = file_out
+        self._hasher = hasher
+
+    def write(self, data):
+        self._hasher.update(data)
+        return self._file.write(data)
+
+    def hexdigest(self):
+        return self._hasher.hexdigest()
+
+
+@contextlib.contextmanager
+def _map_file(filename):
+    """Context manager memory mapping a file for reading"""
+
+    with open(filename, "rb") as file_in:
+        if os.fstat(file_in.fileno()).st_size == 0:
+            yield b""
+            return
+        data = mmap.mmap(file_in.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield data
+        finally:
+            data.close()
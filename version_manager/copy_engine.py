@@ -0,0 +1,160 @@
+# SPDX-FileCopyrightText: © Cesar Velazquez <cesarve@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import errno
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # windows
+    fcntl = None
+
+# size of the buffer used by the buffered copy fallback (in bytes)
+default_buffer_size = 8 * 1024 * 1024
+
+# ioctl request to clone a file's extents on CoW filesystems (btrfs, XFS)
+FICLONE = 0x40049409
+
+# largest chunk handed to copy_file_range/sendfile in one call
+_max_chunk = 1024 * 1024 * 1024
+
+# errors that should not be hidden by trying the next strategy
+_fatal_errors = (errno.ENOSPC, getattr(errno, "EDQUOT", errno.ENOSPC), errno.ENOENT)
+
+# strategies in the order they are tried
+strategies = ("hardlink", "reflink", "copy_file_range", "sendfile", "buffered")
+
+
+class CopyResult(collections.namedtuple("CopyResult", ["strategy", "size", "seconds"])):
+    """Describes a finished copy.
+
+    strategy (str) - name of the strategy that copied the file
+    size (int) - number of bytes copied
+    seconds (float) - time spent copying
+    """
+
+    __slots__ = ()
+
+    @property
+    def rate(self):
+        """Copy speed in bytes per second"""
+        if self.seconds <= 0:
+            return float("inf")
+        return self.size / self.seconds
+
+    def __str__(self):
+        return "{}: {:.1f} MB in {:.3f} s ({:.1f} MB/s)".format(
+            self.strategy, self.size / 1e6, self.seconds, self.rate / 1e6
+        )
+
+
+def _reflink(fd_in, fd_out, size, buffer_size):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "reflink not supported on this platform")
+    fcntl.ioctl(fd_out, FICLONE, fd_in)
+
+
+def _copy_file_range(fd_in, fd_out, size, buffer_size):
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "copy_file_range not available")
+
+    copied = 0
+    while copied < size:
+        count = os.copy_file_range(fd_in, fd_out, min(size - copied, _max_chunk))
+        if count == 0:
+            raise OSError(errno.EIO, "copy_file_range stopped before end of file")
+        copied += count
+
+
+def _sendfile(fd_in, fd_out, size, buffer_size):
+    if not hasattr(os, "sendfile") or os.name == "nt":
+        raise OSError(errno.ENOSYS, "sendfile not available")
+
+    copied = 0
+    while copied < size:
+        count = os.sendfile(fd_out, fd_in, copied, min(size - copied, _max_chunk))
+        if count == 0:
+            raise OSError(errno.EIO, "sendfile stopped before end of file")
+        copied += count
+
+
+def _buffered(fd_in, fd_out, size, buffer_size):
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(fd_in, "rb", buffering=0, closefd=False) as file_in:
+        with open(fd_out, "wb", buffering=0, closefd=False) as file_out:
+            while True:
+                count = file_in.readinto(buffer)
+                if not count:
+                    break
+                file_out.write(view[:count])
+
+
+_functions = {
+    "reflink": _reflink,
+    "copy_file_range": _copy_file_range,
+    "sendfile": _sendfile,
+    "buffered": _buffered,
+}
+
+
+def copy_file(source, target, buffer_size=None, link=False, allowed=None):
+    """Copies a file using the fastest strategy that works.
+
+    Strategies are tried in this order:
+        hardlink - only if link is True
+        reflink - clone extents on copy-on-write filesystems (btrfs, XFS)
+        copy_file_range - in-kernel copy (Linux)
+        sendfile - in-kernel copy (Linux)
+        buffered - read/write with a large buffer
+
+    Parameters:
+    source (str) - file to copy
+    target (str) - destination. Existing files are replaced.
+    buffer_size (int) - Buffer size used by the buffered strategy
+    link (bool) - Allow the target to be a hard link to the source
+    allowed (sequence) - Restrict the strategies that are tried
+
+    Returns CopyResult. Raises the last error if no allowed strategy worked.
+    """
+
+    buffer_size = buffer_size or default_buffer_size
+    allowed = strategies if allowed is None else allowed
+
+    start = time.perf_counter()
+    size = os.path.getsize(source)
+    error = OSError(errno.EINVAL, "No copy strategy allowed")
+
+    for name in strategies:
+        if name not in allowed or (name == "hardlink" and not link):
+            continue
+
+        # never write through a hard link into another file
+        if os.path.lexists(target):
+            if name == "hardlink" or os.stat(target).st_nlink > 1:
+                os.remove(target)
+
+        try:
+            if name == "hardlink":
+                os.link(source, target)
+            else:
+                with open(source, "rb") as file_in, open(target, "wb") as file_out:
+                    _functions[name](
+                        file_in.fileno(), file_out.fileno(), size, buffer_size
+                    )
+        except OSError as e:
+            if e.errno in _fatal_errors:
+                raise
+            error = e
+            continue
+
+        return CopyResult(name, size, time.perf_counter() - start)
+
+    if os.path.lexists(target):
+        os.remove(target)
+    raise error
@@ -0,0 +1,224 @@
+# SPDX-FileCopyrightText: © Cesar Velazquez <cesarve@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import hashlib
+import random
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# delta file layout:
+#   header: magic, base digest, chain depth, size of target
+#   ops:    b"C" offset length   - copy bytes from base
+#           b"I" length data     - insert literal bytes
+_header = struct.Struct("<8s64sHQ")
+_copy = struct.Struct("<QQ")
+_insert = struct.Struct("<Q")
+_magic = b"KDVMDLT1"
+
+# chunk sizes (in bytes). Chunk boundaries are content defined, so
+# data inserted or removed in one place does not change the chunks
+# found in the rest of the file.
+min_chunk_size = 16 * 1024
+max_chunk_size = 1024 * 1024
+
+# Chunk boundaries are placed after occurrences of a 2 byte anchor,
+# found at C speed with find(). Compressed layer data is close to random,
+# which gives ~64k average chunks.
+_anchor = b"\x4b\x44"
+
+# Low entropy data may not contain the anchor. There, numpy is used to
+# evaluate a rolling hash (sum of a random value per byte over a sliding
+# window) and the boundary is placed where its low bits are zero. Without
+# numpy the chunk is cut at max_chunk_size.
+_window = 32
+_mask = 0xFFFF
+_gear = random.Random(0x4B44564D).sample(range(1 << 24), 256)
+
+# size of copies when writing data (in bytes)
+_copy_size = 4 * 1024 * 1024
+
+
+class DeltaError(Exception):
+    """Raised for malformed delta data"""
+
+    pass
+
+
+def _rolling_boundary(data, start, stop):
+    """Returns the first position in (start, stop] where the rolling hash
+    of the preceding window matches. Returns stop if there is none.
+    """
+
+    if numpy is None:
+        return stop
+
+    begin = start - _window
+    gear = numpy.array(_gear, dtype=numpy.uint32)
+    values = gear[numpy.frombuffer(data, dtype=numpy.uint8, count=stop - begin, offset=begin)]
+
+    # window sums. uint32 wraps around, which keeps the differences exact
+    sums = numpy.cumsum(values, dtype=numpy.uint32)
+    hashes = sums[_window:] - sums[:-_window]
+    matches = numpy.flatnonzero((hashes & numpy.uint32(_mask)) == 0)
+    if not len(matches):
+        return stop
+    return begin + _window + 1 + int(matches[0])
+
+
+def chunk_boundaries(data):
+    """Returns the end offsets of the content defined chunks of data
+
+    Parameters:
+    data (bytes, mmap) - data to split into chunks
+    """
+
+    size = len(data)
+    boundaries = []
+    last = 0
+    while last < size:
+        position = data.find(
+            _anchor, last + min_chunk_size - len(_anchor), last + max_chunk_size
+        )
+        if position != -1:
+            end = position + len(_anchor)
+        elif size - last <= max_chunk_size:
+            end = size
+        else:
+            end = _rolling_boundary(
+                data, last + min_chunk_size, last + max_chunk_size
+            )
+        boundaries.append(end)
+        last = end
+    return boundaries
+
+
+def _chunk_key(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def compute(base, target, file_out, base_digest, depth):
+    """Writes a delta that turns base into target
+
+    Parameters:
+    base (bytes, mmap, memoryview) - data the delta is computed against
+    target (bytes, mmap, memoryview) - data the delta reproduces
+    file_out (file) - binary file receiving the delta
+    base_digest (str) - digest of base, recorded in the header
+    depth (int) - length of the delta chain ending with this delta
+
+    Returns the number of bytes written.
+    """
+
+    # index the chunks of base
+    index = {}
+    start = 0
+    for end in chunk_boundaries(base):
+        index.setdefault(_chunk_key(base[start:end]), start)
+        start = end
+
+    written = file_out.write(
+        _header.pack(_magic, base_digest.encode("ascii"), depth, len(target))
+    )
+
+    # pending op, merged with following ops when possible
+    pending = None
+
+    def flush(op):
+        if op is None:
+            return 0
+        if op[0] == b"C":
+            return file_out.write(b"C" + _copy.pack(op[1], op[2]))
+        count = file_out.write(b"I" + _insert.pack(op[2] - op[1]))
+        return count + file_out.write(target[op[1] : op[2]])
+
+    start = 0
+    for end in chunk_boundaries(target):
+        chunk = target[start:end]
+        offset = index.get(_chunk_key(chunk))
+        if offset is not None and base[offset : offset + len(chunk)] != chunk:
+            offset = None
+
+        if offset is not None:
+            if pending and pending[0] == b"C" and pending[1] + pending[2] == offset:
+                pending = (b"C", pending[1], pending[2] + len(chunk))
+            else:
+                written += flush(pending)
+                pending = (b"C", offset, len(chunk))
+        else:
+            if pending and pending[0] == b"I":
+                pending = (b"I", pending[1], end)
+            else:
+                written += flush(pending)
+                pending = (b"I", start, end)
+        start = end
+
+    written += flush(pending)
+    return written
+
+
+def read_header(file_in):
+    """Reads the header of a delta.
+
+    Returns (base_digest, depth, size)
+    """
+
+    data = file_in.read(_header.size)
+    if len(data) != _header.size:
+        raise DeltaError("Truncated delta header")
+    magic, base_digest, depth, size = _header.unpack(data)
+    if magic != _magic:
+        raise DeltaError("Not a delta")
+    return base_digest.decode("ascii"), depth, size
+
+
+def apply(base, file_in, file_out):
+    """Rebuilds the target of a delta
+
+    Parameters:
+    base (bytes, mmap, memoryview) - data the delta was computed against
+    file_in (file) - binary file holding the delta
+    file_out (file) - binary file receiving the target
+
+    Returns the number of bytes written.
+    """
+
+    _, _, size = read_header(file_in)
+    written = 0
+
+    while True:
+        op = file_in.read(1)
+        if not op:
+            break
+
+        if op == b"C":
+            offset, length = _copy.unpack(file_in.read(_copy.size))
+            if offset + length > len(base):
+                raise DeltaError("Copy outside of base")
+            end = offset + length
+            while offset < end:
+                count = min(_copy_size, end - offset)
+                file_out.write(base[offset : offset + count])
+                offset += count
+        elif op == b"I":
+            (length,) = _insert.unpack(file_in.read(_insert.size))
+            remaining = length
+            while remaining:
+                data = file_in.read(min(_copy_size, remaining))
+                if not data:
+                    raise DeltaError("Truncated delta")
+                file_out.write(data)
+                remaining -= len(data)
+        else:
+            raise DeltaError(f"Unknown delta op {op!r}")
+
+        written += length
+
+    if written != size:
+        raise DeltaError(f"Delta produced {written} bytes, expected {size}")
+    return written
@@ -0,0 +1,80 @@
+# SPDX-FileCopyrightText: © Cesar Velazquez <cesarve@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Process wide cache of parsed histories.
+
+The docker and history widget create a new version_manager.utils.Utils
+for most user actions, each of them reading the history again. Parsed
+histories are kept here, keyed by data directory, and returned as long
+as the files they were read from did not change.
+
+Files are compared by (st_mtime_ns, st_size, st_ino), see signature().
+Writes made through Utils store the written history, so they never
+cause the history to be parsed again. Changes made by other processes
+show up in the signature.
+
+Histories are shared between the cache and the Utils instances reading
+them. The dictionaries returned by get() are copies, their entries are
+not: entries must be replaced rather than changed in place (see
+version_manager.journal.TrackedDict).
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import copy
+import os
+import threading
+
+# Number of histories kept, least recently used ones are dropped first
+max_entries = 16
+
+_entries = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+def signature(filenames):
+    """Returns a value that changes whenever one of the files changes.
+
+    Missing files are part of the signature too.
+    """
+
+    result = []
+    for filename in filenames:
+        try:
+            info = os.stat(filename)
+        except FileNotFoundError:
+            result.append((filename, None))
+        else:
+            result.append((filename, info.st_mtime_ns, info.st_size, info.st_ino))
+    return tuple(result)
+
+
+def get(data_dir, file_signature):
+    """Returns (history (dict), metadata (dict)) of a data directory if it
+    was cached with the same signature, None otherwise.
+    """
+
+    with _lock:
+        cached = _entries.get(data_dir)
+        if cached is None or cached[0] != file_signature:
+            return None
+        _entries.move_to_end(data_dir)
+        return dict(cached[1]), copy.deepcopy(cached[2])
+
+
+def put(data_dir, file_signature, history, metadata):
+    """Stores the history of a data directory as it was read or written"""
+
+    with _lock:
+        _entries[data_dir] = (file_signature, dict(history), copy.deepcopy(metadata))
+        _entries.move_to_end(data_dir)
+        while len(_entries) > max_entries:
+            _entries.popitem(last=False)
+
+
+def discard(data_dir):
+    """Drops the cached history of a data directory"""
+
+    with _lock:
+        _entries.pop(data_dir, None)
@@ -0,0 +1,223 @@
+# SPDX-FileCopyrightText: © Cesar Velazquez <cesarve@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Reader/writer lock for history files shared between processes.
+
+Writers hold an exclusive QLockFile (history.json.lock). Each reader
+holds a QLockFile of its own in a readers directory next to it:
+
+- a reader takes the writer lock, registers its reader lock and releases
+  the writer lock again, so readers never start while a writer is active
+- a writer takes the writer lock, then waits until all reader locks are
+  gone
+
+Both wait with exponential backoff and jitter instead of a single
+attempt, so instances sharing a history (e.g. on a NAS) take turns
+instead of failing. Locks of crashed processes are detected by
+QLockFile, on other hosts by their age (see default_stale_lock_time).
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import contextlib
+import os
+import random
+import time
+import uuid
+
+from PyQt5 import QtCore
+
+# seconds to wait for a lock before giving up
+default_timeout = 30.0
+
+# Lock files older than this number of seconds are considered stale if
+# their owner cannot be checked, e.g. because it runs on another host.
+# Must be longer than the longest operation holding the lock.
+default_stale_lock_time = 10 * 60
+
+# delays between attempts in seconds, doubled after each attempt
+_initial_delay = 0.005
+_max_delay = 0.5
+
+_errors = {
+    QtCore.QLockFile.NoError: "NoError",
+    QtCore.QLockFile.LockFailedError: "LockFailedError",
+    QtCore.QLockFile.PermissionError: "PermissionError",
+    QtCore.QLockFile.UnknownError: "UnknownError",
+}
+
+
+class LockTimeout(Exception):
+    """Raised when a lock cannot be obtained in time"""
+
+    pass
+
+
+class HistoryLock(object):
+    """Reader/writer lock on a history file"""
+
+    def __init__(self, filename, timeout=None, stale_lock_time=None, reporter=None):
+        """
+        Arguments:
+        filename (str) - writer lock file, the readers directory is created next to it
+        timeout (float) - seconds to wait for a lock (see default_timeout)
+        stale_lock_time (int) - see default_stale_lock_time
+        reporter (callable) - Receives messages about lock waits (optional)
+        """
+
+        self._filename = filename
+        self._readers_dir = f"{os.path.splitext(filename)[0]}.readers"
+        self._timeout = default_timeout if timeout is None else timeout
+        self._stale_lock_time = (
+            default_stale_lock_time if stale_lock_time is None else stale_lock_time
+        )
+        self._reporter = reporter
+
+        # held writer lock, None if not locked
+        self._writer = None
+
+        # lock wait metrics
+        #   acquired  - number of locks obtained
+        #   contended - number of locks that had to wait
+        #   timeouts  - number of locks given up on
+        #   wait      - total seconds waited
+        #   max_wait  - longest wait in seconds
+        self.stats = {"acquired": 0, "contended": 0, "timeouts": 0, "wait": 0.0, "max_wait": 0.0}
+
+    @property
+    def filename(self):
+        """Absolute path to the writer lock file"""
+        return self._filename
+
+    @property
+    def locked(self):
+        """True while the writer lock is held"""
+        return self._writer is not None
+
+    def report(self, msg):
+        """Sends a message to the reporter"""
+        if self._reporter:
+            self._reporter(msg)
+
+    def _lock_file(self, filename):
+        lockfile = QtCore.QLockFile(filename)
+        lockfile.setStaleLockTime(int(self._stale_lock_time * 1000))
+        return lockfile
+
+    def _wait(self, attempt, kind):
+        """Calls attempt() until it returns True, with exponential backoff
+        and jitter between attempts.
+
+        Returns the number of attempts. Raises LockTimeout if it does not
+        succeed within the timeout.
+        """
+
+        start = time.monotonic()
+        delay = _initial_delay
+        attempts = 1
+        while not attempt():
+            elapsed = time.monotonic() - start
+            if elapsed >= self._timeout:
+                self.stats["timeouts"] += 1
+                raise LockTimeout(
+                    f"Unable to obtain {kind} lock on {self.filename} "
+                    f"after {elapsed:.1f} s ({attempts} attempts)"
+                )
+            time.sleep(min(random.uniform(0, delay), self._timeout - elapsed))
+            delay = min(delay * 2, _max_delay)
+            attempts += 1
+
+        return attempts
+
+    def _record(self, kind, start, attempts):
+        """Updates the lock wait metrics"""
+
+        waited = time.monotonic() - start
+        self.stats["acquired"] += 1
+        if attempts > 1:
+            self.stats["contended"] += 1
+            self.stats["wait"] += waited
+            self.stats["max_wait"] = max(self.stats["max_wait"], waited)
+            self.report(
+                f"Waited {waited:.2f} s for {kind} lock on {self.filename} ({attempts} attempts)"
+            )
+
+    def _lock_writer(self, kind):
+        lockfile = self._lock_file(self.filename)
+
+        def attempt():
+            if lockfile.tryLock(0):
+                return True
+            if lockfile.error() != QtCore.QLockFile.LockFailedError:
+                raise LockTimeout(
+                    f"Unable to obtain {kind} lock on {self.filename}: {_errors.get(lockfile.error())}"
+                )
+            return False
+
+        return lockfile, self._wait(attempt, kind)
+
+    def _readers_gone(self):
+        """Returns True if no reader holds a lock. Stale reader locks are removed."""
+
+        try:
+            names = os.listdir(self._readers_dir)
+        except FileNotFoundError:
+            return True
+        for name in names:
+            reader = self._lock_file(os.path.join(self._readers_dir, name))
+            if not reader.tryLock(0):
+                return False
+            # the reader is gone, or its lock was stale
+            reader.unlock()
+        return True
+
+    def lock_exclusive(self):
+        """Obtains the writer lock and waits until all readers are done"""
+
+        if self.locked:
+            raise RuntimeError(f"Already holding the lock on {self.filename}")
+
+        start = time.monotonic()
+        lockfile, attempts = self._lock_writer("write")
+        try:
+            attempts += self._wait(self._readers_gone, "write") - 1
+        except BaseException:
+            lockfile.unlock()
+            raise
+        self._writer = lockfile
+        self._record("write", start, attempts)
+
+    def unlock_exclusive(self):
+        """Releases the writer lock"""
+
+        self._writer.unlock()
+        self._writer = None
+
+    @contextlib.contextmanager
+    def shared(self):
+        """Context manager holding a reader lock.
+
+        Does nothing if the writer lock is held already.
+        """
+
+        if self.locked:
+            yield
+            return
+
+        start = time.monotonic()
+        writer, attempts = self._lock_writer("read")
+        try:
+            os.makedirs(self._readers_dir, exist_ok=True)
+            reader = self._lock_file(os.path.join(self._readers_dir, f"{uuid.uuid4().hex}.lock"))
+            if not reader.tryLock(0):
+                raise LockTimeout(
+                    f"Unable to create reader lock in {self._readers_dir}: {_errors.get(reader.error())}"
+                )
+        finally:
+            writer.unlock()
+        self._record("read", start, attempts)
+
+        try:
+            yield
+        finally:
+            reader.unlock()
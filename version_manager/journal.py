@@ -0,0 +1,320 @@
+# SPDX-FileCopyrightText: © Cesar Velazquez <cesarve@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Append-only journal of history changes.
+
+The history is stored as a snapshot (history.json) plus a journal of the
+changes made since the snapshot was written. Each write appends a single
+JSON line holding all changes of that write, so the cost of a write
+depends on what changed and not on the size of the history.
+
+The history is read by loading the snapshot and replaying the journal.
+When the journal grows past a threshold it is compacted: the snapshot is
+rewritten with the replayed history and the journal is emptied.
+
+Crash safety:
+- journal lines are written with a single write and synced before a
+  write returns. A line torn by a crash is ignored on replay and cut off
+  by the next write.
+- the snapshot is replaced atomically. The journal is only emptied
+  afterwards. Should a crash happen in between, the journal is replayed
+  over the new snapshot, which gives the same history again because every
+  record holds the complete new state of what it changes.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import os
+
+from . import history_cache
+
+# The journal is compacted into the snapshot when it gets larger than
+# this number of bytes
+default_compact_size = 1024 * 1024
+
+
+class TrackedDict(dict):
+    """Dictionary remembering which keys were set or deleted.
+
+    Only assignments to keys are tracked. Values must not be changed in
+    place unless their key is assigned again before the next write, they
+    are shared with version_manager.history_cache once written:
+
+        entry = dict(history[doc_id])
+        entry["message"] = message
+        history[doc_id] = entry
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.changed = set()
+        self.removed = set()
+
+    def reset_changes(self):
+        """Forgets the tracked changes, e.g. after they were written"""
+        self.changed = set()
+        self.removed = set()
+
+    def has_changes(self):
+        return bool(self.changed or self.removed)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.changed.add(key)
+        self.removed.discard(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.changed.discard(key)
+        self.removed.add(key)
+
+    _missing = object()
+
+    def pop(self, key, default=_missing):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        if default is TrackedDict._missing:
+            raise KeyError(key)
+        return default
+
+    def popitem(self):
+        key, value = super().popitem()
+        self.changed.discard(key)
+        self.removed.add(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        for key in list(self):
+            del self[key]
+
+
+class Journal(object):
+    """Snapshot of a history and the journal of changes made since.
+
+    Not thread or process safe, writers must hold the history lock.
+    """
+
+    def __init__(self, snapshot_filename, metadata_key, compact_size=None):
+        """
+        Arguments:
+        snapshot_filename (str) - json file holding the snapshot, the
+            journal is written next to it
+        metadata_key (str) - snapshot key holding the history metadata
+        compact_size (int) - see default_compact_size
+        """
+
+        self._snapshot_filename = snapshot_filename
+        self._journal_filename = f"{os.path.splitext(snapshot_filename)[0]}.journal"
+        self._data_dir = os.path.dirname(os.path.abspath(snapshot_filename))
+        self._metadata_key = metadata_key
+        self._compact_size = default_compact_size if compact_size is None else compact_size
+
+        # metadata as it was last read or written, see write()
+        self._metadata = {}
+
+    @property
+    def snapshot_filename(self):
+        """Absolute path to the snapshot json file"""
+        return self._snapshot_filename
+
+    @property
+    def filename(self):
+        """Absolute path to the snapshot json file"""
+        return self._snapshot_filename
+
+    @property
+    def journal_filename(self):
+        """Absolute path to the journal file"""
+        return self._journal_filename
+
+    @property
+    def files(self):
+        """Absolute paths to the files the history is stored in"""
+        return (self.snapshot_filename, self.journal_filename)
+
+    def exists(self):
+        return os.path.exists(self.snapshot_filename)
+
+    def remove(self):
+        """Deletes the snapshot and the journal"""
+
+        history_cache.discard(self._data_dir)
+        for filename in (self.snapshot_filename, self.journal_filename):
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+    def journal_size(self):
+        """Size of the journal in bytes"""
+        try:
+            return os.path.getsize(self.journal_filename)
+        except FileNotFoundError:
+            return 0
+
+    def read(self):
+        """Loads the snapshot and replays the journal.
+
+        Returns (history (TrackedDict), metadata (dict))
+        """
+
+        signature = self._signature()
+        cached = history_cache.get(self._data_dir, signature)
+        if cached is not None:
+            history, metadata = cached
+        else:
+            history, metadata = self._parse()
+            history_cache.put(self._data_dir, signature, history, metadata)
+
+        self._metadata = json.loads(json.dumps(metadata))
+        return TrackedDict(history), metadata
+
+    def _parse(self):
+        with open(self.snapshot_filename, "r") as file_in:
+            history = json.load(file_in)
+        metadata = history.pop(self._metadata_key, {})
+
+        for record in self._records():
+            for doc_id in record.get("removed", ()):
+                history.pop(doc_id, None)
+            history.update(record.get("changed", {}))
+            if "metadata" in record:
+                metadata = record["metadata"]
+        return history, metadata
+
+    def _signature(self):
+        return history_cache.signature(self.files)
+
+    def _records(self):
+        """Generator yielding the complete records of the journal"""
+
+        try:
+            file_in = open(self.journal_filename, "rb")
+        except FileNotFoundError:
+            return
+        with file_in:
+            for line in file_in:
+                # a crash while appending leaves a line without newline
+                if not line.endswith(b"\n"):
+                    return
+                try:
+                    yield json.loads(line.decode("utf-8"))
+                except ValueError:
+                    return
+
+    def write(self, history, metadata):
+        """Appends the tracked changes of a history to the journal.
+
+        The journal is compacted instead if it got too large.
+
+        Parameters:
+        history (TrackedDict) - history dictionary
+        metadata (dict) - history metadata
+        """
+
+        if not os.path.exists(self.snapshot_filename):
+            self.compact(history, metadata)
+            return
+
+        record = {}
+        if history.removed:
+            record["removed"] = sorted(history.removed)
+        if history.changed:
+            record["changed"] = {doc_id: history[doc_id] for doc_id in history.changed}
+        if metadata != self._metadata:
+            record["metadata"] = metadata
+
+        if record:
+            line = json.dumps(record, sort_keys=True, separators=(",", ":")) + "\n"
+            self._append(line.encode("utf-8"))
+
+        history.reset_changes()
+        self._metadata = json.loads(json.dumps(metadata))
+
+        if self.journal_size() > self._compact_size:
+            self.compact(history, metadata)
+        else:
+            history_cache.put(self._data_dir, self._signature(), history, metadata)
+
+    def _append(self, data):
+        """Appends a line to the journal with a single synced write"""
+
+        flags = os.O_RDWR | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0)
+        fd = os.open(self.journal_filename, flags, 0o666)
+        try:
+            _truncate_torn_line(fd)
+            written = os.write(fd, data)
+            if written != len(data):
+                raise OSError(f"Short write to {self.journal_filename}")
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def compact(self, history, metadata):
+        """Writes the whole history to the snapshot and empties the journal"""
+
+        data = dict(history)
+        if metadata:
+            data[self._metadata_key] = metadata
+
+        tmp_filename = f"{self.snapshot_filename}.tmp"
+        with open(tmp_filename, "w") as file_out:
+            json.dump(data, file_out, sort_keys=True, indent=4)
+            file_out.flush()
+            os.fsync(file_out.fileno())
+        os.replace(tmp_filename, self.snapshot_filename)
+        _sync_directory(os.path.dirname(self.snapshot_filename))
+
+        try:
+            os.remove(self.journal_filename)
+        except FileNotFoundError:
+            pass
+
+        history.reset_changes()
+        self._metadata = json.loads(json.dumps(metadata))
+        history_cache.put(self._data_dir, self._signature(), history, metadata)
+
+
+def _truncate_torn_line(fd):
+    """Removes an incomplete line left at the end of a file by a crash.
+
+    Otherwise the next line would be appended to it and lost on replay.
+    """
+
+    size = os.fstat(fd).st_size
+    end = size
+    while end > 0:
+        start = max(0, end - 65536)
+        os.lseek(fd, start, os.SEEK_SET)
+        chunk = os.read(fd, end - start)
+        newline = chunk.rfind(b"\n")
+        if newline >= 0:
+            end = start + newline + 1
+            break
+        end = start
+    if end != size:
+        os.ftruncate(fd, end)
+
+
+def _sync_directory(directory):
+    """Makes a rename in a directory durable"""
+
+    if os.name == "nt":
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,375 @@
+# SPDX-FileCopyrightText: © Cesar Velazquez <cesarve@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import hashlib
+import json
+import os
+import struct
+import zipfile
+import zlib
+
+from . import recompress
+
+# zip record layouts (see APPNOTE.TXT)
+_local_header = struct.Struct("<4s2B4HL2L2H")
+_central_header = struct.Struct("<4s4B4HL2L5H2L")
+_end_record = struct.Struct("<4s4H2LH")
+
+_local_signature = b"PK\003\004"
+_central_signature = b"PK\001\002"
+_end_signature = b"PK\005\006"
+
+# general purpose flag bits
+_flag_encrypted = 0x1
+_flag_deflate_options = 0x6
+_flag_data_descriptor = 0x8
+_flag_utf8 = 0x800
+
+# largest values that fit without zip64 extensions
+_max_uint32 = 0xFFFFFFFF
+_max_uint16 = 0xFFFF
+
+manifest_version = 1
+
+
+class UnsupportedArchive(Exception):
+    """Raised for archives that cannot be split into members"""
+
+    pass
+
+
+class _HashingReader(object):
+    """Sequential reader that hashes every byte read from a file"""
+
+    def __init__(self, file_in, hasher):
+        self._file = file_in
+        self._hasher = hasher
+        self.position = 0
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self._hasher.update(data)
+        self.position += len(data)
+        return data
+
+    def skip_to(self, offset):
+        """Reads (and hashes) data up to the given offset"""
+
+        if offset < self.position:
+            raise UnsupportedArchive("Overlapping zip members")
+        while self.position < offset:
+            if not self.read(min(offset - self.position, 1024 * 1024)):
+                raise UnsupportedArchive("Unexpected end of archive")
+
+
+def split(filename, store):
+    """Stores the members of a krita archive in a blob store.
+
+    The file is read once, sequentially. Every member's compressed data
+    is stored as its own object, keyed by its sha256 digest. The CRC32 and
+    sizes from the central directory are kept alongside the digest in the
+    manifest.
+
+    Members are stored exactly as they appear in the archive (still
+    compressed), so unchanged layers are shared between checkpoints and
+    build() does not need to recompress anything.
+
+    Parameters:
+    filename (str) - krita document to split
+    store (version_manager.blob_store.BlobStore) - store receiving the members
+
+    Returns (manifest, digest, size) where digest is the sha256 digest of
+    the whole file.
+    """
+
+    try:
+        with zipfile.ZipFile(filename) as archive:
+            infos = sorted(archive.infolist(), key=lambda info: info.header_offset)
+            comment = archive.comment
+    except zipfile.BadZipFile as e:
+        raise UnsupportedArchive(str(e))
+
+    if len(infos) >= _max_uint16:
+        raise UnsupportedArchive("Too many members for a zip archive without zip64")
+
+    hasher = hashlib.new(store.hash_name)
+    members = []
+
+    with open(filename, "rb") as file_in:
+        reader = _HashingReader(file_in, hasher)
+
+        for info in infos:
+            if info.flag_bits & _flag_encrypted:
+                raise UnsupportedArchive(f"Encrypted member: {info.filename}")
+            if max(info.file_size, info.compress_size, info.header_offset) >= _max_uint32:
+                raise UnsupportedArchive(f"zip64 member: {info.filename}")
+
+            reader.skip_to(info.header_offset)
+            header = reader.read(_local_header.size)
+            if len(header) != _local_header.size:
+                raise UnsupportedArchive("Unexpected end of archive")
+
+            fields = _local_header.unpack(header)
+            if fields[0] != _local_signature:
+                raise UnsupportedArchive(f"Bad local header: {info.filename}")
+            name_length, extra_length = fields[10], fields[11]
+            reader.read(name_length)
+            local_extra = reader.read(extra_length)
+
+            digest, size, _ = store.store_stream(reader, info.compress_size)
+
+            members.append(
+                {
+                    "name": info.orig_filename,
+                    "digest": digest,
+                    "crc": info.CRC,
+                    "compress_size": info.compress_size,
+                    "file_size": info.file_size,
+                    "compress_type": info.compress_type,
+                    "flag_bits": info.flag_bits & ~_flag_data_descriptor,
+                    "dos_time": fields[5],
+                    "dos_date": fields[6],
+                    "create_version": info.create_version,
+                    "create_system": info.create_system,
+                    "extract_version": info.extract_version,
+                    "internal_attr": info.internal_attr,
+                    "external_attr": info.external_attr,
+                    "local_extra": local_extra.hex(),
+                    "extra": info.extra.hex(),
+                    "comment": info.comment.hex(),
+                }
+            )
+
+        # hash the rest of the file (central directory)
+        while reader.read(1024 * 1024):
+            pass
+
+    manifest = {
+        "version": manifest_version,
+        "comment": comment.hex(),
+        "members": members,
+    }
+    manifest["size"] = archive_size(manifest)
+
+    return manifest, hasher.hexdigest(), reader.position
+
+
+def archive_size(manifest):
+    """Returns the size of the archive build() creates for a manifest"""
+
+    size = _end_record.size + len(bytes.fromhex(manifest["comment"]))
+    for member in manifest["members"]:
+        name_length = len(_encode_name(member))
+        size += _local_header.size + name_length + len(member["local_extra"]) // 2
+        size += member["compress_size"]
+        size += _central_header.size + name_length
+        size += (len(member["extra"]) + len(member["comment"])) // 2
+    return size
+
+
+def dumps(manifest):
+    """Serializes a manifest for storage in a blob store"""
+    return json.dumps(manifest, sort_keys=True).encode("utf-8")
+
+
+def loads(data):
+    """Deserializes a manifest created with dumps()"""
+
+    manifest = json.loads(data.decode("utf-8"))
+    if manifest.get("version") != manifest_version:
+        raise UnsupportedArchive(f"Unknown manifest version {manifest.get('version')}")
+    return manifest
+
+
+def _encode_name(member):
+    if member["flag_bits"] & _flag_utf8:
+        return member["name"].encode("utf-8")
+    return member["name"].encode("cp437")
+
+
+def build(manifest, store, filename):
+    """Rebuilds a krita archive from its stored members.
+
+    Member data is copied as is, in the original order. Members that
+    cannot be deflated again to the original bytes (see
+    recompress.DeflateMismatch) are written uncompressed instead. The
+    archive is still valid, but not identical to the original.
+
+    Parameters:
+    manifest (dict) - manifest returned by split()
+    store (version_manager.blob_store.BlobStore) - store holding the members
+    filename (str) - krita file to write
+    """
+
+    tmp_filename = f"{filename}.tmp"
+    central = []
+
+    try:
+        with open(tmp_filename, "wb") as file_out:
+            for member in manifest["members"]:
+                offset = file_out.tell()
+                if offset >= _max_uint32:
+                    raise UnsupportedArchive("Archive too large for zip without zip64")
+
+                try:
+                    file_in = store.open(member["digest"])
+                except recompress.DeflateMismatch:
+                    file_in = store.open(member["digest"], inflated=True)
+                    member = dict(
+                        member,
+                        compress_type=zipfile.ZIP_STORED,
+                        compress_size=member["file_size"],
+                        flag_bits=member["flag_bits"] & ~_flag_deflate_options,
+                    )
+
+                name = _encode_name(member)
+                local_extra = bytes.fromhex(member["local_extra"])
+
+                file_out.write(
+                    _local_header.pack(
+                        _local_signature,
+                        member["extract_version"],
+                        0,
+                        member["flag_bits"],
+                        member["compress_type"],
+                        member["dos_time"],
+                        member["dos_date"],
+                        member["crc"],
+                        member["compress_size"],
+                        member["file_size"],
+                        len(name),
+                        len(local_extra),
+                    )
+                )
+                file_out.write(name)
+                file_out.write(local_extra)
+
+                copied = 0
+                with file_in:
+                    while True:
+                        chunk = file_in.read(4 * 1024 * 1024)
+                        if not chunk:
+                            break
+                        file_out.write(chunk)
+                        copied += len(chunk)
+                if copied != member["compress_size"]:
+                    raise UnsupportedArchive(f"Corrupt member object: {member['name']}")
+
+                central.append((member, name, offset))
+
+            central_offset = file_out.tell()
+            for member, name, offset in central:
+                extra = bytes.fromhex(member["extra"])
+                comment = bytes.fromhex(member["comment"])
+                file_out.write(
+                    _central_header.pack(
+                        _central_signature,
+                        member["create_version"],
+                        member["create_system"],
+                        member["extract_version"],
+                        0,
+                        member["flag_bits"],
+                        member["compress_type"],
+                        member["dos_time"],
+                        member["dos_date"],
+                        member["crc"],
+                        member["compress_size"],
+                        member["file_size"],
+                        len(name),
+                        len(extra),
+                        len(comment),
+                        0,
+                        member["internal_attr"],
+                        member["external_attr"],
+                        offset,
+                    )
+                )
+                file_out.write(name)
+                file_out.write(extra)
+                file_out.write(comment)
+            central_size = file_out.tell() - central_offset
+
+            comment = bytes.fromhex(manifest["comment"])
+            file_out.write(
+                _end_record.pack(
+                    _end_signature,
+                    0,
+                    0,
+                    len(central),
+                    len(central),
+                    central_size,
+                    central_offset,
+                    len(comment),
+                )
+            )
+            file_out.write(comment)
+
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
+def read_member(manifest, store, name):
+    """Returns the uncompressed content of an archive member stored with
+    split(), without rebuilding the archive.
+
+    Parameters:
+    manifest (dict) - manifest returned by split()
+    store (version_manager.blob_store.BlobStore) - store holding the members
+    name (str) - member name, e.g. "preview.png"
+
+    Returns None if the archive has no such member.
+    """
+
+    for member in manifest["members"]:
+        if member["name"] == name:
+            break
+    else:
+        return None
+
+    if member["compress_type"] == zipfile.ZIP_STORED:
+        data = store.read_bytes(member["digest"])
+    elif member["compress_type"] == zipfile.ZIP_DEFLATED:
+        try:
+            with store.open(member["digest"]) as file_in:
+                data = zlib.decompress(file_in.read(), -zlib.MAX_WBITS)
+        except recompress.DeflateMismatch:
+            with store.open(member["digest"], inflated=True) as file_in:
+                data = file_in.read()
+        except zlib.error as e:
+            raise UnsupportedArchive(f"Corrupt member object: {name} ({e})")
+    else:
+        raise UnsupportedArchive(f"Unsupported compression method of member: {name}")
+
+    if zlib.crc32(data) != member["crc"]:
+        raise UnsupportedArchive(f"Corrupt member object: {name}")
+    return data
+
+
+def read_archive_member(file_in, name):
+    """Returns the uncompressed content of a member of a krita archive.
+
+    Parameters:
+    file_in (str or file) - krita file, or a seekable binary file object
+    name (str) - member name, e.g. "preview.png"
+
+    Returns None if the archive has no such member.
+    """
+
+    try:
+        with zipfile.ZipFile(file_in) as archive:
+            try:
+                return archive.read(name)
+            except KeyError:
+                return None
+    except zipfile.BadZipFile as e:
+        raise UnsupportedArchive(str(e))
+
+
+def referenced_objects(manifest):
+    """Returns the set of member digests used by a manifest"""
+    return set(member["digest"] for member in manifest["members"])
@@ -0,0 +1,299 @@
+# SPDX-FileCopyrightText: © Cesar Velazquez <cesarve@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Headless maintenance tools for Krita document version histories.
+
+Usage:
+    python -m version_manager.maintenance repack artwork.kra --days 30 --keep 20
+    python -m version_manager.maintenance recompress artwork.kra --days 90
+    python -m version_manager.maintenance thin artwork.kra --dry-run
+    python -m version_manager.maintenance quota artwork.kra --limit 500 --enforce
+    python -m version_manager.maintenance compact artwork.kra
+    python -m version_manager.maintenance backend artwork.kra sqlite
+    python -m version_manager.maintenance export artwork.kra history_backup.json
+    python -m version_manager.maintenance thumbnails artwork.kra --missing
+    python -m version_manager.maintenance atlas artwork.kra on
+    python -m version_manager.maintenance lock-test artwork.kra --processes 8
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import multiprocessing
+import sys
+
+from . import quota, retention, thumbnail, utils
+
+
+def repack(args):
+    vmutils = utils.Utils(args.filename)
+    vmutils.info_update.connect(print)
+    vmutils.repack(older_than=args.days, keep_loose=args.keep)
+    return 0
+
+
+def recompress(args):
+    vmutils = utils.Utils(args.filename)
+    vmutils.info_update.connect(print)
+    vmutils.recompress(older_than=args.days, max_workers=args.workers)
+    return 0
+
+
+def thin(args):
+    vmutils = utils.Utils(args.filename)
+    vmutils.info_update.connect(print)
+    print(retention.describe())
+    removed = vmutils.thin_history(dry_run=args.dry_run)
+    if args.dry_run:
+        for doc_id in removed:
+            entry = vmutils.history[doc_id]
+            print(entry["id"], entry["date"].replace("\n", " "))
+    return 0
+
+
+def show_quota(args):
+    vmutils = utils.Utils(args.filename)
+    vmutils.info_update.connect(print)
+
+    if args.limit is not None or args.policy is not None:
+        vmutils.read_history()
+        limit = vmutils.quota if args.limit is None else args.limit * 1e6
+        vmutils.set_quota(limit, args.policy)
+    if args.global_limit is not None:
+        quota.set_global_quota(args.global_limit * 1e6, args.policy)
+    if args.enforce:
+        vmutils.enforce_quota()
+        utils.enforce_global_quota(reporter=print)
+
+    vmutils.read_history()
+    registry = quota.read_registry()
+    print(f"Document usage: {quota.format_size(vmutils.usage)}", end="")
+    print(f" of {quota.format_size(vmutils.quota)}" if vmutils.quota else "")
+    print(f"Global usage: {quota.format_size(quota.global_usage(registry))}", end="")
+    print(f" of {quota.format_size(registry['quota'])}" if registry["quota"] else "")
+    print(f"Eviction policy: {vmutils.eviction_policy}")
+    return 0
+
+
+def compact(args):
+    vmutils = utils.Utils(args.filename)
+    vmutils.info_update.connect(print)
+    vmutils.compact_history()
+    return 0
+
+
+def set_backend(args):
+    vmutils = utils.Utils(args.filename)
+    vmutils.info_update.connect(print)
+    vmutils.set_history_backend(args.backend)
+    return 0
+
+
+def export(args):
+    vmutils = utils.Utils(args.filename)
+    vmutils.export_history(args.output)
+    return 0
+
+
+def thumbnails(args):
+    vmutils = utils.Utils(args.filename)
+    vmutils.info_update.connect(print)
+    vmutils.regenerate_thumbnails(
+        missing_only=args.missing, levels=args.levels, max_workers=args.workers
+    )
+    return 0
+
+
+def atlas(args):
+    vmutils = utils.Utils(args.filename)
+    vmutils.info_update.connect(print)
+    vmutils.set_thumbnail_atlas(args.state == "on")
+    return 0
+
+
+def _lock_test_worker(filename, iterations, timeout):
+    """Alternates reads and counter increments, returns the lock metrics"""
+
+    vmutils = utils.Utils(filename, lock_timeout=timeout)
+    for _ in range(iterations):
+        vmutils.read_history()
+        with vmutils.transaction():
+            vmutils.metadata["lock_test"] += 1
+    return vmutils.lock_stats
+
+
+def lock_test(args):
+    """Runs transactions from several processes at once and checks that
+    none of them got lost
+    """
+
+    vmutils = utils.Utils(args.filename, lock_timeout=args.timeout)
+    with vmutils.transaction():
+        vmutils.metadata["lock_test"] = 0
+
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(args.processes) as pool:
+        results = pool.starmap(
+            _lock_test_worker,
+            [(args.filename, args.iterations, args.timeout)] * args.processes,
+        )
+
+    with vmutils.transaction():
+        count = vmutils.metadata.pop("lock_test")
+
+    contended = sum(stats["contended"] for stats in results)
+    acquired = sum(stats["acquired"] for stats in results)
+    wait = sum(stats["wait"] for stats in results)
+    print(f"Locks: {acquired}, waited for {contended} of them")
+    print(f"Total wait: {wait:.2f} s, longest: {max(stats['max_wait'] for stats in results):.2f} s")
+
+    expected = args.processes * args.iterations
+    if count != expected:
+        print(f"FAILED: {count} of {expected} increments recorded")
+        return 1
+    print(f"OK: {count} increments recorded")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m version_manager.maintenance",
+        description="Maintenance tools for Krita document version histories",
+    )
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    command = commands.add_parser(
+        "repack", help="Move old checkpoints into the pack file"
+    )
+    command.add_argument("filename", help="Krita document (.kra)")
+    command.add_argument(
+        "--days",
+        type=float,
+        default=utils.default_repack_age,
+        help="Pack checkpoints older than this number of days (default: %(default)s)",
+    )
+    command.add_argument(
+        "--keep",
+        type=int,
+        default=utils.default_repack_keep,
+        help="Number of recent checkpoints to keep unpacked (default: %(default)s)",
+    )
+    command.set_defaults(func=repack)
+
+    command = commands.add_parser(
+        "recompress", help="Recompress old checkpoints with LZMA"
+    )
+    command.add_argument("filename", help="Krita document (.kra)")
+    command.add_argument(
+        "--days",
+        type=float,
+        default=utils.default_recompress_age,
+        help="Recompress checkpoints older than this number of days (default: %(default)s)",
+    )
+    command.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: number of cores)",
+    )
+    command.set_defaults(func=recompress)
+
+    command = commands.add_parser(
+        "thin", help="Remove old checkpoints according to the retention policy"
+    )
+    command.add_argument("filename", help="Krita document (.kra)")
+    command.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only list the checkpoints that would be removed",
+    )
+    command.set_defaults(func=thin)
+
+    command = commands.add_parser(
+        "quota", help="Show or change storage quotas and evict checkpoints"
+    )
+    command.add_argument("filename", help="Krita document (.kra)")
+    command.add_argument(
+        "--limit", type=float, help="Document quota in MB (0 for no limit)"
+    )
+    command.add_argument(
+        "--global-limit", type=float, help="Quota of all documents in MB (0 for no limit)"
+    )
+    command.add_argument(
+        "--policy", choices=quota.policies, help="Which checkpoints are evicted first"
+    )
+    command.add_argument(
+        "--enforce",
+        action="store_true",
+        help="Evict checkpoints until the quotas are met",
+    )
+    command.set_defaults(func=show_quota)
+
+    command = commands.add_parser(
+        "compact", help="Write the history journal into history.json"
+    )
+    command.add_argument("filename", help="Krita document (.kra)")
+    command.set_defaults(func=compact)
+
+    command = commands.add_parser(
+        "backend", help="Move the history to history.json or to a SQLite database"
+    )
+    command.add_argument("filename", help="Krita document (.kra)")
+    command.add_argument("backend", choices=utils.history_backends)
+    command.set_defaults(func=set_backend)
+
+    command = commands.add_parser(
+        "export", help="Write the history to a json file in the history.json format"
+    )
+    command.add_argument("filename", help="Krita document (.kra)")
+    command.add_argument("output", help="json file to write")
+    command.set_defaults(func=export)
+
+    command = commands.add_parser(
+        "thumbnails", help="Make new thumbnails from the checkpoints' archives"
+    )
+    command.add_argument("filename", help="Krita document (.kra)")
+    command.add_argument(
+        "--missing", action="store_true", help="Only checkpoints without a thumbnail"
+    )
+    command.add_argument(
+        "--levels",
+        type=lambda value: [int(level) for level in value.split(",")],
+        default=list(thumbnail.pyramid_levels),
+        help="Comma separated widths of the thumbnail levels in pixels (default: %(default)s)",
+    )
+    command.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: number of cores)",
+    )
+    command.set_defaults(func=thumbnails)
+
+    command = commands.add_parser(
+        "atlas", help="Keep all thumbnails in a single file, or stop doing so"
+    )
+    command.add_argument("filename", help="Krita document (.kra)")
+    command.add_argument("state", choices=("on", "off"))
+    command.set_defaults(func=atlas)
+
+    command = commands.add_parser(
+        "lock-test", help="Check the history lock with concurrent writers"
+    )
+    command.add_argument("filename", help="Krita document (.kra)")
+    command.add_argument("--processes", type=int, default=4, help="Number of processes (default: %(default)s)")
+    command.add_argument(
+        "--iterations", type=int, default=50, help="Transactions per process (default: %(default)s)"
+    )
+    command.add_argument(
+        "--timeout", type=float, default=None, help="Seconds to wait for the lock"
+    )
+    command.set_defaults(func=lock_test)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,425 @@
+# SPDX-FileCopyrightText: © Cesar Velazquez <cesarve@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import io
+import mmap
+import os
+import struct
+
+# pack file layout:
+#   header: magic
+#   records: key length, data length, key, data
+# Records are only ever appended. Removing a record only removes it from
+# the index, compact() reclaims the space.
+_pack_header = struct.Struct("<8s")
+_pack_record = struct.Struct("<IQ")
+_pack_magic = b"KDVMPAK1"
+
+# index file layout:
+#   header: magic, number of entries, pack generation
+#   entries: key offset, key length, data offset, data size (sorted by key)
+#   key strings
+# compact() writes a pack with a new generation number, so the index
+# always refers to a complete pack file.
+_index_header = struct.Struct("<8sQQ")
+_index_entry = struct.Struct("<QIQQ")
+_index_magic = b"KDVMIDX1"
+
+# size of copies when writing data (in bytes)
+_copy_size = 4 * 1024 * 1024
+
+
+class PackError(Exception):
+    """Raised for malformed pack or index files"""
+
+    pass
+
+
+class _ViewReader(io.RawIOBase):
+    """Read-only file object on top of a memoryview"""
+
+    def __init__(self, view):
+        super().__init__()
+        self._view = view
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = max(0, offset)
+        return self._position
+
+    def readinto(self, buffer):
+        data = self._view[self._position : self._position + len(buffer)]
+        buffer[: len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+
+class PackFile(object):
+    """Single append-only pack file holding many small files.
+
+    Data is looked up through a sorted index with a binary search and
+    read with random access through mmap. Keys are strings, for example
+    "<doc_id>/thumbnail.png", so all records of a checkpoint are next to
+    each other in the index.
+    """
+
+    def __init__(self, directory, basename="checkpoints"):
+        """
+        Arguments:
+        directory (str) - directory holding the pack and index files
+        basename (str) - name of the pack and index files without extension
+        """
+
+        self._directory = directory
+        self._basename = basename
+        self._index_filename = os.path.join(directory, f"{basename}.idx")
+
+        self._generation = 0
+        self._pack_file = None
+        self._pack_map = None
+        self._index_file = None
+        self._index_map = None
+        self._count = 0
+
+        # bytes added to the pack and index files (negative if removed)
+        # since the owner last reset it
+        self.usage_change = 0
+
+    @property
+    def pack_filename(self):
+        """Absolute path to the pack file"""
+        return self._pack_path(self._generation)
+
+    def _pack_path(self, generation):
+        return os.path.join(self._directory, f"{self._basename}-{generation}.pack")
+
+    @property
+    def index_filename(self):
+        """Absolute path to the index file"""
+        return self._index_filename
+
+    def disk_usage(self):
+        """Returns the number of bytes used by the pack and index files"""
+
+        size = 0
+        for filename in (self.pack_filename, self.index_filename):
+            if os.path.isfile(filename):
+                size += os.path.getsize(filename)
+        return size
+
+    def exists(self):
+        """Returns True if the pack has an index"""
+        return os.path.isfile(self.index_filename)
+
+    def close(self):
+        """Releases the memory maps"""
+
+        for name in ("_pack_map", "_pack_file", "_index_map", "_index_file"):
+            handle = getattr(self, name)
+            setattr(self, name, None)
+            if handle is None:
+                continue
+            try:
+                handle.close()
+            except BufferError:
+                # views of the map are still alive. The map is released
+                # once they are gone.
+                pass
+        self._count = 0
+
+    def _open(self):
+        """Maps the pack and index files if that has not happened yet"""
+
+        if self._index_map is not None or not self.exists():
+            return
+
+        self._index_file = open(self.index_filename, "rb")
+        self._index_map = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count, self._generation = _index_header.unpack_from(
+            self._index_map, 0
+        )
+        if magic != _index_magic:
+            self.close()
+            raise PackError(f"Not an index file: {self.index_filename}")
+
+        self._pack_file = open(self.pack_filename, "rb")
+        self._pack_map = mmap.mmap(self._pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._pack_map[: _pack_header.size] != _pack_magic:
+            self.close()
+            raise PackError(f"Not a pack file: {self.pack_filename}")
+
+    def __len__(self):
+        self._open()
+        return self._count
+
+    def _entry(self, i):
+        """Returns (key, data offset, data size) of index entry i"""
+
+        key_offset, key_length, offset, size = _index_entry.unpack_from(
+            self._index_map, _index_header.size + i * _index_entry.size
+        )
+        key = self._index_map[key_offset : key_offset + key_length]
+        return key, offset, size
+
+    def _bisect(self, key):
+        """Returns the position of the first index entry >= key"""
+
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _find(self, key):
+        """Returns (offset, size) of a key, None if not found"""
+
+        self._open()
+        if not self._count:
+            return None
+        key = key.encode("utf-8")
+        i = self._bisect(key)
+        if i < self._count:
+            found, offset, size = self._entry(i)
+            if found == key:
+                return offset, size
+        return None
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def items(self, prefix=""):
+        """Generator yielding (key, size) for all keys starting with prefix"""
+
+        self._open()
+        if not self._count:
+            return
+        encoded = prefix.encode("utf-8")
+        i = self._bisect(encoded)
+        while i < self._count:
+            key, _, size = self._entry(i)
+            if not key.startswith(encoded):
+                break
+            yield key.decode("utf-8"), size
+            i += 1
+
+    def view(self, key):
+        """Returns a memoryview of the data stored for key"""
+
+        found = self._find(key)
+        if found is None:
+            raise KeyError(key)
+        offset, size = found
+        return memoryview(self._pack_map)[offset : offset + size]
+
+    def locate(self, key):
+        """Returns (pack filename, offset, size) of the data stored for key"""
+
+        found = self._find(key)
+        if found is None:
+            raise KeyError(key)
+        return (self.pack_filename,) + found
+
+    def open(self, key):
+        """Returns a read-only file object for the data stored for key"""
+        return io.BufferedReader(_ViewReader(self.view(key)), _copy_size)
+
+    def read(self, key):
+        """Returns the data stored for key as bytes"""
+        return bytes(self.view(key))
+
+    def extract(self, key, filename):
+        """Writes the data stored for key to a file"""
+
+        view = self.view(key)
+        with open(filename, "wb") as file_out:
+            for start in range(0, len(view), _copy_size):
+                file_out.write(view[start : start + _copy_size])
+
+    def _entries(self):
+        """Returns dictionary of key -> (offset, size) for all entries"""
+
+        self._open()
+        entries = {}
+        for i in range(self._count):
+            key, offset, size = self._entry(i)
+            entries[bytes(key)] = (offset, size)
+        return entries
+
+    def append(self, records):
+        """Appends files to the pack.
+
+        Parameters:
+        records (iterable) - (key, filename) pairs. Existing keys are replaced.
+        """
+
+        entries = self._entries()
+        self.close()
+        before = self.disk_usage()
+
+        os.makedirs(self._directory, exist_ok=True)
+        if not os.path.exists(self.pack_filename):
+            with open(self.pack_filename, "wb") as file_out:
+                file_out.write(_pack_header.pack(_pack_magic))
+
+        with open(self.pack_filename, "ab") as file_out:
+            for key, filename in records:
+                key = key.encode("utf-8")
+                size = os.path.getsize(filename)
+                file_out.write(_pack_record.pack(len(key), size))
+                file_out.write(key)
+                offset = file_out.tell()
+                with open(filename, "rb") as file_in:
+                    while True:
+                        chunk = file_in.read(_copy_size)
+                        if not chunk:
+                            break
+                        file_out.write(chunk)
+                entries[key] = (offset, size)
+            file_out.flush()
+            os.fsync(file_out.fileno())
+
+        self._write_index(entries)
+        self.usage_change += self.disk_usage() - before
+
+    def remove(self, keys):
+        """Removes keys from the index"""
+
+        entries = self._entries()
+        removed = False
+        for key in keys:
+            removed = entries.pop(key.encode("utf-8"), None) is not None or removed
+        if removed:
+            self.close()
+            before = self.disk_usage()
+            self._write_index(entries)
+            self.usage_change += self.disk_usage() - before
+
+    def _generation_filenames(self):
+        """Returns the pack files of all generations found on disk"""
+
+        if not os.path.isdir(self._directory):
+            return []
+        prefix = f"{self._basename}-"
+        return [
+            os.path.join(self._directory, name)
+            for name in os.listdir(self._directory)
+            if name.startswith(prefix)
+            and name.endswith(".pack")
+            and name[len(prefix) : -len(".pack")].isdigit()
+        ]
+
+    def delete(self):
+        """Deletes the pack and index files, of all generations.
+
+        Files of older generations are left behind if compact() could not
+        remove them, e.g. while another process had them open.
+        """
+
+        # the generation is only known once the index was read
+        if self.exists():
+            self._open()
+        self.close()
+
+        filenames = [self.index_filename, f"{self.index_filename}.tmp"]
+        filenames.extend(self._generation_filenames())
+
+        for filename in filenames:
+            if os.path.isfile(filename):
+                self.usage_change -= os.path.getsize(filename)
+                os.remove(filename)
+        self._generation = 0
+
+    def garbage(self):
+        """Returns number of bytes in the pack that are no longer indexed"""
+
+        if not self.exists():
+            return 0
+        entries = self._entries()
+        used = _pack_header.size + sum(
+            _pack_record.size + len(key) + size for key, (_, size) in entries.items()
+        )
+        return os.path.getsize(self.pack_filename) - used
+
+    def compact(self):
+        """Rewrites the pack file without the data of removed keys"""
+
+        entries = self._entries()
+        before = self.disk_usage()
+        old_filename = self.pack_filename
+        generation = self._generation + 1
+        new_filename = self._pack_path(generation)
+        new_entries = {}
+
+        with open(new_filename, "wb") as file_out:
+            file_out.write(_pack_header.pack(_pack_magic))
+            for key in sorted(entries):
+                offset, size = entries[key]
+                file_out.write(_pack_record.pack(len(key), size))
+                file_out.write(key)
+                new_entries[key] = (file_out.tell(), size)
+                for start in range(offset, offset + size, _copy_size):
+                    end = min(start + _copy_size, offset + size)
+                    file_out.write(self._pack_map[start:end])
+            file_out.flush()
+            os.fsync(file_out.fileno())
+
+        self.close()
+        self._write_index(new_entries, generation)
+        # the old pack file is still on disk until it is removed below
+        self.usage_change += self.disk_usage() - before + os.path.getsize(old_filename)
+
+        # Windows refuses to remove files another PackFile still maps, e.g.
+        # one serving thumbnails through view(). Those are left for a
+        # later compaction or delete().
+        for filename in self._generation_filenames():
+            if filename == new_filename:
+                continue
+            size = os.path.getsize(filename)
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            self.usage_change -= size
+
+    def _write_index(self, entries, generation=None):
+        """Writes a sorted index for the given entries and replaces the old one"""
+
+        if generation is None:
+            generation = self._generation
+
+        keys = sorted(entries)
+        strings_offset = _index_header.size + len(keys) * _index_entry.size
+        tmp_filename = f"{self.index_filename}.tmp"
+
+        with open(tmp_filename, "wb") as file_out:
+            file_out.write(_index_header.pack(_index_magic, len(keys), generation))
+            key_offset = strings_offset
+            for key in keys:
+                offset, size = entries[key]
+                file_out.write(_index_entry.pack(key_offset, len(key), offset, size))
+                key_offset += len(key)
+            for key in keys:
+                file_out.write(key)
+            file_out.flush()
+            os.fsync(file_out.fileno())
+
+        os.replace(tmp_filename, self.index_filename)
+        self._generation = generation
@@ -59,6 +59,7 @@ class VersionManager(QtWidgets.QWidget, qt_docker_widget_ui.Ui_Form):
         self.history_widget.info_update.connect(self.info_update)
         self.history_widget.error_update.connect(self.report_error)
         self.history_widget.in_progress.connect(self.set_progress_indicator)
+        self.history_widget.progress_update.connect(self.show_progress)
 
         # setup history menu
         self.history_menu = QtWidgets.QMenu(self)
@@ -76,6 +77,41 @@ class VersionManager(QtWidgets.QWidget, qt_docker_widget_ui.Ui_Form):
         action.triggered.connect(self.history_widget.import_krita)
         self.history_menu.addAction(action)
 
+        action = QtWidgets.QAction('Storage Quota...', self)
+        action.setToolTip('Limit the disk space used by checkpoints.')
+        action.triggered.connect(self.history_widget.edit_quota)
+        self.history_menu.addAction(action)
+
+        action = QtWidgets.QAction('Thin Out History', self)
+        action.setToolTip('Removes old checkpoints, keeping fewer of them the older they get.')
+        action.triggered.connect(self.history_widget.thin_history)
+        self.history_menu.addAction(action)
+
+        action = QtWidgets.QAction('Repack Old Checkpoints', self)
+        action.setToolTip('Move old checkpoints into a single pack file.')
+        action.triggered.connect(self.history_widget.repack_history)
+        self.history_menu.addAction(action)
+
+        action = QtWidgets.QAction('Recompress Old Checkpoints', self)
+        action.setToolTip('Recompress old checkpoints to save disk space. They take longer to load afterwards.')
+        action.triggered.connect(self.history_widget.recompress_history)
+        self.history_menu.addAction(action)
+
+        action = QtWidgets.QAction('Regenerate Missing Thumbnails', self)
+        action.setToolTip('Makes thumbnails for checkpoints that have none.')
+        action.triggered.connect(lambda: self.history_widget.regenerate_thumbnails(missing_only=True))
+        self.history_menu.addAction(action)
+
+        action = QtWidgets.QAction('Regenerate All Thumbnails', self)
+        action.setToolTip('Makes new thumbnails for all checkpoints, e.g. after changing the thumbnail resolution.')
+        action.triggered.connect(lambda: self.history_widget.regenerate_thumbnails(missing_only=False))
+        self.history_menu.addAction(action)
+
+        action = QtWidgets.QAction('Cancel Thumbnail Regeneration', self)
+        action.setToolTip('Stops regenerating thumbnails. Thumbnails made so far are kept.')
+        action.triggered.connect(self.history_widget.cancel_thumbnails)
+        self.history_menu.addAction(action)
+
         action = QtWidgets.QAction('Toggle Log View', self)
         action.setToolTip('Toggle visibility of log window.')
         action.triggered.connect(self.toggle_log_view)
@@ -97,6 +133,16 @@ class VersionManager(QtWidgets.QWidget, qt_docker_widget_ui.Ui_Form):
         else:
             self.busy_indicator.setPixmap(QtGui.QPixmap(
                 ':/images/ready.png').scaledToWidth(17))
+            self.busy_indicator.setToolTip('')
+
+    def show_progress(self, done, total):
+        """Shows the progress of a background job on the busy indicator
+
+        Parameters:
+        done (int): number of finished steps
+        total (int): number of steps
+        """
+        self.busy_indicator.setToolTip(f'{done} of {total} done ({100 * done // max(total, 1)}%)')
 
     def toggle_log_view(self):
         """Toggle visibility of log view"""
@@ -4,15 +4,28 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import ast
+import collections
 import os
-import shutil
 import subprocess
 import sys
+import tempfile
+import threading
 
 import krita
 from PyQt5 import QtCore, QtGui, QtWidgets
 
-from . import utils
+from . import (
+    copy_engine,
+    history_lock,
+    kra_archive,
+    packfile,
+    qt_thumbnail_loader,
+    qt_worker,
+    quota,
+    retention,
+    thumbnail,
+    utils,
+)
 
 # default thumbnail resolution (in pixels)
 default_thumbnail_resolution = 240
@@ -20,11 +33,137 @@ default_thumbnail_resolution = 240
 # default size of icon in gui (10-300)
 default_thumbnail_scale = 64
 
+# milliseconds to wait for further changes of the history files before
+# updating the view, so a burst of writes causes a single update
+default_refresh_delay = 250
+
+# memory (in bytes) for scaled thumbnails, shared by all history views
+default_pixmap_cache_size = 64 * 1024 * 1024
+
+# height / width of the placeholder shown while a thumbnail is loaded
+default_placeholder_aspect = 0.75
+
+# rows above and below the viewport whose thumbnails are loaded ahead
+default_prefetch_rows = 10
+
+# milliseconds the thumbnail size slider has to rest before thumbnails
+# are loaded at the new size. Until then loaded thumbnails are scaled.
+default_rescale_delay = 150
+
 
 class CheckFailed(Exception):
     pass
 
 
+def _runs(rows):
+    """Returns (first, last) of each run of consecutive numbers in a sorted list"""
+
+    runs = []
+    for row in rows:
+        if runs and runs[-1][1] == row - 1:
+            runs[-1] = (runs[-1][0], row)
+        else:
+            runs.append((row, row))
+    return runs
+
+
+class PixmapCache(object):
+    """Least recently used cache of scaled thumbnails, bounded by the
+    memory their pixels take.
+
+    Keys are (data directory, checkpoint key, width). A null QPixmap is
+    cached for checkpoints without a thumbnail, so they are not looked
+    for on every paint either.
+    """
+
+    def __init__(self, max_size=None):
+        """
+        Arguments:
+        max_size (int) - memory budget in bytes (see default_pixmap_cache_size)
+        """
+
+        self._max_size = default_pixmap_cache_size if max_size is None else max_size
+        self._entries = collections.OrderedDict()
+        self._size = 0
+
+    @property
+    def max_size(self):
+        """Memory budget in bytes"""
+        return self._max_size
+
+    @property
+    def size(self):
+        """Memory used by the cached pixmaps in bytes"""
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def set_max_size(self, max_size):
+        """Changes the memory budget, evicting pixmaps if needed
+
+        Parameters:
+        max_size (int) - memory budget in bytes
+        """
+
+        self._max_size = max_size
+        self._evict()
+
+    @staticmethod
+    def _cost(pixmap):
+        return pixmap.width() * pixmap.height() * max(pixmap.depth(), 8) // 8
+
+    def get(self, key):
+        """Returns the pixmap cached for a key, None if there is none"""
+
+        pixmap = self._entries.get(key)
+        if pixmap is not None:
+            self._entries.move_to_end(key)
+        return pixmap
+
+    def put(self, key, pixmap):
+        """Caches a pixmap. Pixmaps larger than the budget are not cached."""
+
+        self._remove(key)
+        cost = self._cost(pixmap)
+        if cost > self._max_size:
+            return
+        self._entries[key] = pixmap
+        self._size += cost
+        self._evict()
+
+    def discard(self, data_dir, doc_id=None, keep_width=None):
+        """Drops cached pixmaps of a data directory.
+
+        Parameters:
+        data_dir (str) - data directory of the document
+        doc_id (str) - only drop the pixmaps of this checkpoint (optional)
+        keep_width (int) - keep the pixmaps of this width (optional)
+        """
+
+        for key in list(self._entries):
+            if (
+                key[0] == data_dir
+                and (doc_id is None or key[1] == doc_id)
+                and key[2] != keep_width
+            ):
+                self._remove(key)
+
+    def _remove(self, key):
+        pixmap = self._entries.pop(key, None)
+        if pixmap is not None:
+            self._size -= self._cost(pixmap)
+
+    def _evict(self):
+        while self._size > self._max_size and self._entries:
+            _, pixmap = self._entries.popitem(last=False)
+            self._size -= self._cost(pixmap)
+
+
+# thumbnails shown by HistoryModel
+pixmap_cache = PixmapCache()
+
+
 class HistoryModel(QtCore.QAbstractTableModel):
     def __init__(self, utils):
         """Table model for displaying document history.
@@ -46,21 +185,42 @@ class HistoryModel(QtCore.QAbstractTableModel):
         # dictionary containing document history
         self._history = self._utils.history
 
-        # 2D array of data for model
-        self._data = [
-            [
-                key,
-                self._history[key]["thumbnail"],
-                # "{}\n{}".format(self._history[key]["date"], key),
-                "{}\n{}".format(self._history[key]["date"], self._history[key]["id"]),
-                ast.literal_eval(self._history[key]["message"]),
-            ]
-            for key in reversed(sorted(self._history))
-        ]
+        # 2D array of data for model, newest checkpoint first
+        self._data = [self._row(key) for key in reversed(sorted(self._history))]
+
+        # row of each checkpoint key, see key_row()
+        self._rows = {}
+        self._index_rows()
 
         # Default thumbnail scaling factor
         self._thumbnail_scale = 1.0
 
+        # decodes thumbnails in background threads
+        self._loader = qt_thumbnail_loader.ThumbnailLoader(self)
+        self._loader.loaded.connect(self._thumbnail_loaded)
+
+        # pixmaps shown while thumbnails are loaded, by size. See _placeholder()
+        self._placeholders = {}
+
+        # see set_preview_width()
+        self._preview_width = None
+
+    def _row(self, key):
+        """Returns the model data of a checkpoint"""
+
+        entry = self._history[key]
+        return [
+            key,
+            entry["thumbnail"],
+            # "{}\n{}".format(entry["date"], key),
+            "{}\n{}{}".format(
+                entry["date"],
+                entry["id"],
+                "\nPinned" if entry.get("pinned") else "",
+            ),
+            ast.literal_eval(entry["message"]),
+        ]
+
     @property
     def history(self):
         """Dictionary holding document version data"""
@@ -74,26 +234,34 @@ class HistoryModel(QtCore.QAbstractTableModel):
     def data(self, index, role):
 
         # thumbnail column
-        if index.column() == 1:
+        if index.column() == 1 and role in (
+            QtCore.Qt.DecorationRole,
+            QtCore.Qt.SizeHintRole,
+            QtCore.Qt.DisplayRole,
+        ):
 
             # get dictionary key for current document in column 0
             key = self._data[index.row()][0]
+            if not self._history[key]["thumbnail"]:
+                return None
 
-            # build path to thumbnail
-            pixmap_filename = os.path.join(
-                self._utils.data_dir,
-                self._history[key]["dirname"],
-                self._history[key]["thumbnail"],
-            )
-
-            # quit if not file found
-            if not os.path.isfile(pixmap_filename):
+            pixmap = self.thumbnail(key)
+            if pixmap is not None and pixmap.isNull():
                 return None
 
-            # create and scale thumbnail
-            pixmap = QtGui.QPixmap(pixmap_filename)
-            scale_factor = int(default_thumbnail_resolution * self._thumbnail_scale)
-            pixmap = pixmap.scaledToWidth(scale_factor)
+            # views ask for the size of every row, it is computed from the
+            # size stored with the checkpoint so no thumbnail is read
+            size = self.thumbnail_size(key)
+            if role == QtCore.Qt.SizeHintRole and size is not None:
+                return size
+
+            # a placeholder is shown until the thumbnail is loaded (see
+            # load_rows()), painting does not start loading
+            if pixmap is None:
+                pixmap = self._placeholder(size)
+            elif self._preview_width is not None:
+                # quickly scaled while the scale is being changed
+                pixmap = pixmap.scaledToWidth(self._preview_width, QtCore.Qt.FastTransformation)
 
             if role == QtCore.Qt.DecorationRole:
                 return pixmap
@@ -108,6 +276,261 @@ class HistoryModel(QtCore.QAbstractTableModel):
             # return text for thumbnail filename
             return self._data[index.row()][index.column()]
 
+    def thumbnail_width(self):
+        """Width (in pixels) thumbnails are loaded at"""
+        return int(default_thumbnail_resolution * self._thumbnail_scale)
+
+    def shown_width(self):
+        """Width (in pixels) thumbnails are shown at, see set_preview_width()"""
+        if self._preview_width is not None:
+            return self._preview_width
+        return self.thumbnail_width()
+
+    def set_preview_width(self, width):
+        """Shows the thumbnails that are loaded already at another width,
+        scaled quickly while painting, e.g. while a slider is dragged.
+        Nothing is loaded or cached for that width.
+
+        Views are not notified, they need to be updated.
+
+        Parameters:
+            width (int) - width (in pixels), None to show thumbnails at
+                thumbnail_width() again
+        """
+
+        if width != self._preview_width:
+            self._preview_width = width
+            self._placeholders.clear()
+
+    def _cache_key(self, key):
+        return (self._utils.data_dir, key, self.thumbnail_width())
+
+    def thumbnail(self, key):
+        """Returns the thumbnail of a checkpoint, scaled to thumbnail_width().
+
+        Returns None if the thumbnail has not been loaded yet (see
+        load_thumbnail()), a null QPixmap for checkpoints without a
+        thumbnail.
+
+        Parameters:
+            key (str) - history dictionary key of the checkpoint
+        """
+
+        return pixmap_cache.get(self._cache_key(key))
+
+    def load_thumbnail(self, key, priority=0):
+        """Loads the thumbnail of a checkpoint in the background, unless it
+        is cached or being loaded already. dataChanged is emitted for the
+        thumbnail's cell once it is loaded.
+
+        Parameters:
+            key (str) - history dictionary key of the checkpoint
+            priority (int) - thumbnails with a higher priority are loaded first
+        """
+
+        cache_key = self._cache_key(key)
+        if pixmap_cache.get(cache_key) is not None or self._loader.is_pending(cache_key):
+            return
+
+        filename, data = self._thumbnail_source(key)
+        if filename is None and data is None:
+            pixmap_cache.put(cache_key, QtGui.QPixmap())
+            return
+        self._loader.request(cache_key, filename, data, cache_key[2], priority)
+
+    def _thumbnail_source(self, key):
+        """Returns (filename, data) of the thumbnail to show for a
+        checkpoint, see qt_thumbnail_loader.load_image()
+
+        Thumbnails in the thumbnail atlas or in the pack file are returned
+        as views of their memory maps, so they are decoded without opening
+        a file per checkpoint. The views keep the maps alive until the
+        thumbnails are decoded.
+        """
+
+        entry = self._history[key]
+
+        # the smallest stored level at least as wide as shown, so it
+        # is only scaled down a little. Older checkpoints have a single
+        # thumbnail.
+        levels = entry.get("thumbnails")
+        if levels:
+            name = thumbnail.level_filename(thumbnail.nearest_level(levels, self.thumbnail_width()))
+        else:
+            name = entry["thumbnail"]
+        if not name:
+            return None, None
+
+        filename = os.path.join(self._utils.data_dir, entry["dirname"], name)
+        packs = []
+        if self._utils.use_thumbnail_atlas:
+            packs.append(self._utils.thumbnail_atlas)
+        if entry.get("packed") and not os.path.isfile(filename):
+            # thumbnail of a packed checkpoint, unless a loose copy was made
+            packs.append(self._utils.pack)
+        for pack in packs:
+            try:
+                return None, pack.view(f"{key}/{name}")
+            except (KeyError, packfile.PackError):
+                pass
+
+        return filename, None
+
+    def load_rows(self, first, last):
+        """Loads the thumbnails of a range of rows, e.g. the rows shown by
+        a view and a few around them. Rows in the middle are loaded first.
+        Loads of thumbnails outside the range are cancelled.
+
+        Parameters:
+            first (int) - first row
+            last (int) - last row
+        """
+
+        first = max(first, 0)
+        last = min(last, self.rowCount(None) - 1)
+        keep = set()
+        middle = (first + last) // 2
+        for row in range(first, last + 1):
+            key = self._data[row][0]
+            keep.add(self._cache_key(key))
+            self.load_thumbnail(key, -abs(row - middle))
+
+        self._loader.cancel([key for key in self._loader.pending() if key not in keep])
+
+    def thumbnail_size(self, key):
+        """Returns the size (QtCore.QSize) of a checkpoint's thumbnail at
+        shown_width(), computed from the size stored in the history.
+        None for checkpoints made before sizes were stored.
+
+        Parameters:
+            key (str) - history dictionary key of the checkpoint
+        """
+
+        stored = self._history[key].get("thumbnail_size")
+        if not stored:
+            return None
+        width = self.shown_width()
+        return QtCore.QSize(width, max(1, round(stored[1] * width / stored[0])))
+
+    def _placeholder(self, size=None):
+        """Returns the pixmap shown while a thumbnail is loaded
+
+        Parameters:
+            size (QtCore.QSize) - size of the thumbnail, if known
+        """
+
+        if size is None:
+            width = self.shown_width()
+            size = QtCore.QSize(width, max(1, round(width * default_placeholder_aspect)))
+        key = (size.width(), size.height())
+        if key not in self._placeholders:
+            pixmap = QtGui.QPixmap(size)
+            pixmap.fill(QtCore.Qt.transparent)
+            self._placeholders[key] = pixmap
+        return self._placeholders[key]
+
+    def _thumbnail_loaded(self, cache_key, image):
+        """Caches a loaded thumbnail and updates its cell"""
+
+        pixmap_cache.put(cache_key, QtGui.QPixmap.fromImage(image))
+
+        if cache_key[0] != self._utils.data_dir or cache_key[2] != self.thumbnail_width():
+            return
+        row = self.key_row(cache_key[1])
+        if row is not None:
+            index = self.index(row, 1)
+            self.dataChanged.emit(index, index)
+
+    def key_row(self, key):
+        """Returns the row of a checkpoint, None if it is not shown"""
+
+        return self._rows.get(key)
+
+    def _index_rows(self):
+        """Rebuilds the row lookup of key_row() after rows changed"""
+
+        self._rows = {data[0]: row for row, data in enumerate(self._data)}
+
+    def _discard_thumbnail(self, key):
+        """Forgets the thumbnails of a checkpoint"""
+
+        self._loader.cancel(
+            [cache_key for cache_key in self._loader.pending() if cache_key[1] == key]
+        )
+        pixmap_cache.discard(self._utils.data_dir, key)
+
+    def update_history(self, utils):
+        """Shows a newer version of the same document's history.
+
+        Only the rows of added, removed and changed checkpoints are
+        updated, so views keep their selection and scroll position.
+
+        Parameters:
+            utils (version_manager.utils) - Version history data, read again
+        """
+
+        old_history = self._history
+        history = utils.history
+
+        # the number of columns changes with the first and last row
+        if not old_history or not history:
+            self.beginResetModel()
+            self._utils = utils
+            self._history = history
+            self._data = [self._row(key) for key in reversed(sorted(self._history))]
+            self._index_rows()
+            self.endResetModel()
+            return
+
+        self._utils = utils
+        self._history = history
+
+        # removed checkpoints, bottom first so the rows above keep their numbers
+        removed = [row for row, data in enumerate(self._data) if data[0] not in history]
+        for row in removed:
+            self._discard_thumbnail(self._data[row][0])
+        for first, last in reversed(_runs(removed)):
+            self.beginRemoveRows(QtCore.QModelIndex(), first, last)
+            del self._data[first : last + 1]
+            self.endRemoveRows()
+
+        # changed checkpoints. Entries are replaced rather than changed in
+        # place (see version_manager.journal.TrackedDict), unchanged ones
+        # are usually the very same objects.
+        changed = [
+            row
+            for row, data in enumerate(self._data)
+            if history[data[0]] is not old_history[data[0]]
+            and history[data[0]] != old_history[data[0]]
+        ]
+        for first, last in _runs(changed):
+            for row in range(first, last + 1):
+                self._discard_thumbnail(self._data[row][0])
+                self._data[row] = self._row(self._data[row][0])
+            self.dataChanged.emit(
+                self.index(first, 0), self.index(last, len(self._data[first]) - 1)
+            )
+
+        # added checkpoints, inserted in runs where they are next to each other
+        added = sorted((key for key in history if key not in old_history), reverse=True)
+        row = 0
+        start = 0
+        while start < len(added):
+            while row < len(self._data) and self._data[row][0] > added[start]:
+                row += 1
+            end = start + 1
+            while end < len(added) and (
+                row == len(self._data) or added[end] > self._data[row][0]
+            ):
+                end += 1
+            self.beginInsertRows(QtCore.QModelIndex(), row, row + end - start - 1)
+            self._data[row:row] = [self._row(key) for key in added[start:end]]
+            self.endInsertRows()
+            row += end - start
+            start = end
+
+        self._index_rows()
+
     def rowCount(self, index):
         return len(self._data)
 
@@ -123,7 +546,15 @@ class HistoryModel(QtCore.QAbstractTableModel):
         factor (float) - Thumbnail scale multiplier."""
 
         self._thumbnail_scale = float(factor)
-        self.dataChanged.emit(self.index(0, 0), self.index(0, self.rowCount(0)))
+
+        # pixmaps of other widths are not shown any more
+        width = self.thumbnail_width()
+        pixmap_cache.discard(self._utils.data_dir, keep_width=width)
+        self._placeholders.clear()
+        self._loader.cancel([key for key in self._loader.pending() if key[2] != width])
+
+        if self._data:
+            self.dataChanged.emit(self.index(0, 1), self.index(len(self._data) - 1, 1))
 
 
 class HistoryWidget(QtWidgets.QWidget):
@@ -138,6 +569,9 @@ class HistoryWidget(QtWidgets.QWidget):
     error_update = QtCore.pyqtSignal(str, str)
     in_progress = QtCore.pyqtSignal(bool)
 
+    # Signal with the progress of background jobs (done, total)
+    progress_update = QtCore.pyqtSignal(int, int)
+
     def __init__(self, parent=None):
         super().__init__(parent)
 
@@ -146,6 +580,27 @@ class HistoryWidget(QtWidgets.QWidget):
 
         self.model = None
 
+        # background jobs that are still running
+        self._workers = set()
+
+        # set to stop a running regenerate_thumbnails() job
+        self._thumbnail_cancel = None
+
+        # Watches the history files of the shown document, so checkpoints
+        # added by other Krita windows or scripts show up without reloading.
+        # Changes are collected for default_refresh_delay milliseconds.
+        self._watcher = QtCore.QFileSystemWatcher(self)
+        self._watcher.fileChanged.connect(self.history_files_changed)
+        self._watcher.directoryChanged.connect(self.history_files_changed)
+
+        self._refresh_timer = QtCore.QTimer(self)
+        self._refresh_timer.setSingleShot(True)
+        self._refresh_timer.setInterval(default_refresh_delay)
+        self._refresh_timer.timeout.connect(self.refresh_history)
+
+        # utils.Utils.history_signature() of the history shown by the model
+        self._history_signature = None
+
         self.table = QtWidgets.QTableView()
         self.table.verticalHeader().hide()
         self.table.horizontalHeader().hide()
@@ -161,6 +616,32 @@ class HistoryWidget(QtWidgets.QWidget):
 
         self.table.doubleClicked.connect(self.double_click_row)
 
+        # Thumbnails are loaded in the background, those of the rows in
+        # and around the viewport first. Updated once scrolling settles.
+        self._visible_rows_timer = QtCore.QTimer(self)
+        self._visible_rows_timer.setSingleShot(True)
+        self._visible_rows_timer.setInterval(0)
+        self._visible_rows_timer.timeout.connect(self.load_visible_thumbnails)
+        scroll_bar = self.table.verticalScrollBar()
+        scroll_bar.valueChanged.connect(lambda *args: self._visible_rows_timer.start())
+        scroll_bar.rangeChanged.connect(lambda *args: self._visible_rows_timer.start())
+        self.table.verticalHeader().sectionResized.connect(
+            lambda *args: self._visible_rows_timer.start()
+        )
+
+        # Rows fitted to the current thumbnail size. Others are fitted
+        # once they come close to the viewport.
+        self._sized_rows = set()
+
+        # changes of the thumbnail size slider are collected for
+        # default_rescale_delay milliseconds
+        self._rescale_timer = QtCore.QTimer(self)
+        self._rescale_timer.setSingleShot(True)
+        self._rescale_timer.setInterval(default_rescale_delay)
+        self._rescale_timer.timeout.connect(
+            lambda: self.resize_thumbnails(self.slider_widget.value())
+        )
+
         layout.addWidget(self.table)
 
         # create widget to encapsulate slider widgets
@@ -177,7 +658,7 @@ class HistoryWidget(QtWidgets.QWidget):
 
         # setup icon scale slider
         self.slider_widget = QtWidgets.QSlider(QtCore.Qt.Horizontal)
-        self.slider_widget.valueChanged.connect(self.resize_thumbnails)
+        self.slider_widget.valueChanged.connect(self.preview_thumbnails)
         self.slider_widget.setMinimum(10)
         self.slider_widget.setMaximum(300)
         self.slider_widget.setValue(default_thumbnail_scale)
@@ -213,6 +694,10 @@ class HistoryWidget(QtWidgets.QWidget):
                 "func": "generate_thumbnail_action",
                 "tooltip": "Regenerates the thumbnail for this checkpoint",
             },
+            "Pin / Unpin Checkpoint": {
+                "func": "toggle_pin",
+                "tooltip": "Pinned checkpoints are never removed when thinning out the history",
+            },
             "Delete Checkpoint": {
                 "func": "delete_checkpoint",
                 "tooltip": "Deletes this checkpoint from the version manager and file system",
@@ -314,7 +799,7 @@ class HistoryWidget(QtWidgets.QWidget):
 
         # commit new message to disk
         self.model.utils.update_checkpoint_message(doc_id, new_msg)
-        self.reload_history()
+        self.refresh_history()
         self.in_progress.emit(False)
 
     def load_checkpoint(self, doc_id):
@@ -327,14 +812,11 @@ class HistoryWidget(QtWidgets.QWidget):
         self.in_progress.emit(True)
         current_doc = Krita.instance().activeDocument()
 
-        filename = os.path.join(
-            self.model.utils.data_dir,
-            self.model.history[doc_id]["dirname"],
-            self.model.history[doc_id]["filename"],
-        )
+        filename = self.model.utils.checkpoint_filename(doc_id)
         if not os.path.exists(filename):
             self.in_progress.emit(False)
             raise FileNotFoundError(filename)
+        self.model.utils.mark_loaded(doc_id)
 
         new_doc = Krita.instance().openDocument(filename)
         Krita.instance().activeWindow().addView(new_doc)
@@ -363,17 +845,10 @@ class HistoryWidget(QtWidgets.QWidget):
 
         old_date = self.model.history[doc_id]["date"]
 
-        checkpoint_filename = os.path.join(
-            self.model.utils.data_dir,
-            self.model.history[doc_id]["dirname"],
-            self.model.history[doc_id]["filename"],
-        )
-        if not os.path.exists(checkpoint_filename):
-            self.in_progress.emit(False)
-            raise FileNotFoundError(checkpoint_filename)
+        checkpoint_filename = self.model.history[doc_id]["filename"]
 
         self.status_update(f"copying {checkpoint_filename} -> {active_filename}")
-        shutil.copyfile(checkpoint_filename, active_filename)
+        self.model.utils.export_checkpoint(doc_id, active_filename)
 
         self.status_update("closing old document")
         current_doc.close()
@@ -388,8 +863,9 @@ class HistoryWidget(QtWidgets.QWidget):
             msg=f"Copied from version:\n{old_date}\n\n{old_message}",
             autosave=True,
             generate_thumbnail=True,
+            loaded=doc_id,
         )
-        self.reload_history()
+        self.refresh_history()
         self.status_update("Finished making current")
 
         self.in_progress.emit(False)
@@ -402,36 +878,31 @@ class HistoryWidget(QtWidgets.QWidget):
         """
 
         self.in_progress.emit(True)
-        thumbnail_src = os.path.join(
-            self.model.utils.data_dir,
-            self.model.history[doc_id]["dirname"],
-            self.model.history[doc_id]["filename"],
-        )
-        if not os.path.exists(thumbnail_src):
-            self.in_progress.emit(False)
-            raise FileNotFoundError(thumbnail_src)
-
-        thumbnail_tgt = os.path.join(
-            self.model.utils.data_dir,
-            self.model.history[doc_id]["dirname"],
-            "thumbnail.png",
-        )
+        vmutils = utils.Utils(Krita.instance().activeDocument().fileName())
+        vmutils.info_update.connect(self.status_update)
 
-        self.status_update(f"opening {thumbnail_src}")
-        doc = Krita.instance().openDocument(thumbnail_src)
+        self.status_update(f"Generating thumbnail of {self.model.history[doc_id]['id']}")
+        try:
+            # read from the checkpoint's archive, without opening it in Krita
+            vmutils.make_thumbnail(doc_id)
+        except (thumbnail.ThumbnailError, kra_archive.UnsupportedArchive) as e:
+            self.status_update(f"{e}, rendering the thumbnail with Krita")
 
-        self.status_update(f"Generating thumbnail {thumbnail_tgt}")
-        self.generate_thumbnail(doc, thumbnail_tgt)
-        doc.close()
+            thumbnail_src = vmutils.checkpoint_filename(doc_id)
+            if not os.path.exists(thumbnail_src):
+                self.in_progress.emit(False)
+                raise FileNotFoundError(thumbnail_src)
 
-        # update path to thumbnail in history.json if needed
-        if self.model.history[doc_id]["thumbnail"] != "thumbnail.png":
-            vmutils = utils.Utils(Krita.instance().activeDocument().fileName())
-            vmutils.lock_history()
-            vmutils.read_history()
-            vmutils.history[doc_id]["thumbnail"] = "thumbnail.png"
-            vmutils.write_history()
-            vmutils.unlock_history()
+            self.status_update(f"opening {thumbnail_src}")
+            doc = Krita.instance().openDocument(thumbnail_src)
+            fd, thumbnail_tgt = tempfile.mkstemp(suffix=".png")
+            os.close(fd)
+            try:
+                self.generate_thumbnail(doc, thumbnail_tgt)
+                doc.close()
+                vmutils.set_thumbnail_image(doc_id, thumbnail_tgt)
+            finally:
+                os.remove(thumbnail_tgt)
 
         self.reload_history()
         self.status_update("Finished generating thumbnail")
@@ -486,24 +957,18 @@ class HistoryWidget(QtWidgets.QWidget):
 
         tgt_dir = os.path.join(vmutils.data_dir, vmutils.history[doc_id]["dirname"])
 
-        if not os.path.isdir(tgt_dir):
+        if not os.path.isdir(tgt_dir) and not vmutils.history[doc_id].get("packed"):
             self.in_progress.emit(False)
             raise FileNotFoundError(f"Document directory not found: {tgt_dir}")
 
         self.status_update(f"Removing document directory {tgt_dir}")
-        vmutils.lock_history()
-        vmutils.read_history()
         try:
-            shutil.rmtree(tgt_dir)
-            del vmutils.history[doc_id]
+            vmutils.remove_checkpoints([doc_id], keep_pinned=False)
         except Exception as e:
             self.in_progress.emit(False)
-            vmutils.unlock_history()
             self.report_error(str(e), "Checkpoint delete failed")
             return
-        vmutils.write_history()
-        vmutils.unlock_history()
-        self.reload_history()
+        self.refresh_history()
         self.status_update("Checkpoint removal complete")
 
         self.in_progress.emit(False)
@@ -598,7 +1063,8 @@ class HistoryWidget(QtWidgets.QWidget):
 
         # copy krita file to current document
         self.status_update(f"copying {filename} -> {self.model.utils.krita_filename}")
-        shutil.copyfile(filename, self.model.utils.krita_filename)
+        result = copy_engine.copy_file(filename, self.model.utils.krita_filename)
+        self.status_update(f"Copy finished ({result})")
 
         self.status_update("closing old document")
         current_doc = Krita.instance().activeDocument().close()
@@ -614,7 +1080,7 @@ class HistoryWidget(QtWidgets.QWidget):
             autosave=True,
             generate_thumbnail=True,
         )
-        self.reload_history()
+        self.refresh_history()
         self.status_update("Finished import krita file.")
         self.in_progress.emit(False)
 
@@ -637,6 +1103,10 @@ class HistoryWidget(QtWidgets.QWidget):
             self.model.utils.data_dir, self.model.history[doc_id]["dirname"]
         )
 
+        # packed checkpoints have no directory of their own
+        if not os.path.isdir(doc_dir):
+            doc_dir = self.model.utils.data_dir
+
         if sys.platform == "win32":
             subprocess.Popen(["start", doc_dir], shell=True)
 
@@ -652,6 +1122,275 @@ class HistoryWidget(QtWidgets.QWidget):
 
         self.in_progress.emit(False)
 
+    def run_in_background(self, title, func, *args, callback=None, errback=None):
+        """Runs a function in the global thread pool.
+
+        The history is reloaded once the function finished.
+
+        Parameters:
+        title (str) - name of the operation, used in messages
+        func (callable) - function to run
+        args - arguments passed to func
+        callback (callable) - called with the result of func once it finished (optional)
+        errback (callable) - called with the error message if func failed (optional)
+        """
+
+        self.in_progress.emit(True)
+
+        worker = qt_worker.Worker(func, *args)
+        self._workers.add(worker)
+
+        def finished(result):
+            self._workers.discard(worker)
+            self.refresh_history()
+            self.status_update(f"{title} finished")
+            self.in_progress.emit(False)
+            if callback is not None:
+                callback(result)
+
+        def failed(msg):
+            self._workers.discard(worker)
+            self.in_progress.emit(False)
+            if errback is not None:
+                errback(msg)
+            self.report_error(msg, f"{title} failed")
+
+        worker.signals.finished.connect(finished)
+        worker.signals.failed.connect(failed)
+        QtCore.QThreadPool.globalInstance().start(worker)
+
+    def repack_history(self):
+        """Moves old checkpoints of the current document into the pack file"""
+
+        if not self.model:
+            return
+
+        days, ok = QtWidgets.QInputDialog.getInt(
+            self,
+            "Repack Old Checkpoints",
+            "Pack checkpoints older than (days):",
+            utils.default_repack_age,
+            0,
+            36500,
+        )
+        if not ok:
+            return
+
+        keep, ok = QtWidgets.QInputDialog.getInt(
+            self,
+            "Repack Old Checkpoints",
+            "Number of recent checkpoints to keep unpacked:",
+            utils.default_repack_keep,
+            0,
+            1000000,
+        )
+        if not ok:
+            return
+
+        vmutils = utils.Utils(self.model.utils.krita_filename)
+        vmutils.info_update.connect(self.status_update)
+
+        self.status_update(f"Repacking {vmutils.data_dir}")
+        self.run_in_background("Repack", vmutils.repack, days, keep)
+
+    def toggle_pin(self, doc_id):
+        """Pins or unpins a checkpoint
+
+        Parameters:
+        doc_id (str): document key in history dictionary
+        """
+
+        pinned = not self.model.history[doc_id].get("pinned")
+        self.model.utils.set_pinned(doc_id, pinned)
+        self.status_update(
+            f"{'Pinned' if pinned else 'Unpinned'} checkpoint {self.model.history[doc_id]['id']}"
+        )
+        self.refresh_history()
+
+    def thin_history(self):
+        """Removes checkpoints of the current document according to the
+        retention policy, after showing which ones would be removed.
+        """
+
+        if not self.model:
+            return
+
+        vmutils = utils.Utils(self.model.utils.krita_filename)
+        vmutils.info_update.connect(self.status_update)
+
+        def confirm(removed):
+            if not removed:
+                QtWidgets.QMessageBox.information(
+                    self,
+                    "Thin Out History",
+                    "No checkpoints to remove.\n\n" + retention.describe(),
+                )
+                return
+
+            history = self.model.history
+            dates = [
+                history[doc_id]["date"].replace("\n", " ")
+                for doc_id in removed
+                if doc_id in history
+            ]
+            if len(dates) > 20:
+                dates = dates[:20] + [f"... and {len(dates) - 20} more"]
+
+            result = QtWidgets.QMessageBox.question(
+                self,
+                "Thin Out History",
+                "\n".join(
+                    [
+                        retention.describe(),
+                        "",
+                        "Pinned checkpoints and the latest checkpoint are kept.",
+                        f"Remove {len(removed)} checkpoints? (There is no undo)",
+                        "",
+                    ]
+                    + dates
+                ),
+            )
+            if result != QtWidgets.QMessageBox.Yes:
+                return
+
+            # remove what the user saw, the history may have changed meanwhile
+            self.run_in_background(
+                "Thin out history", vmutils.thin_history, None, False, removed
+            )
+
+        self.run_in_background(
+            "Thin out preview", vmutils.thin_history, None, True, callback=confirm
+        )
+
+    def edit_quota(self):
+        """Opens dialog to set the storage quotas"""
+
+        if not self.model:
+            return
+
+        vmutils = self.model.utils
+        registry = quota.read_registry()
+
+        editor = QtWidgets.QDialog(self)
+        editor.setWindowTitle("Storage Quota")
+        layout = QtWidgets.QFormLayout()
+        editor.setLayout(layout)
+
+        layout.addRow(
+            "This document uses:", QtWidgets.QLabel(quota.format_size(vmutils.usage))
+        )
+        layout.addRow(
+            "All documents use:",
+            QtWidgets.QLabel(quota.format_size(quota.global_usage(registry))),
+        )
+
+        limits = []
+        for label, limit in (
+            ("Document quota (MB, 0 = no limit):", vmutils.quota),
+            ("Global quota (MB, 0 = no limit):", registry["quota"]),
+        ):
+            spin_box = QtWidgets.QDoubleSpinBox()
+            spin_box.setRange(0, 1e9)
+            spin_box.setDecimals(0)
+            spin_box.setValue(limit / 1e6)
+            layout.addRow(label, spin_box)
+            limits.append(spin_box)
+
+        policy_box = QtWidgets.QComboBox()
+        for policy in quota.policies:
+            policy_box.addItem(policy.replace("_", " ").capitalize(), policy)
+        policy_box.setCurrentIndex(quota.policies.index(vmutils.eviction_policy))
+        layout.addRow("Evict first:", policy_box)
+
+        buttons = QtWidgets.QDialogButtonBox(
+            QtWidgets.QDialogButtonBox.Ok | QtWidgets.QDialogButtonBox.Cancel
+        )
+        buttons.accepted.connect(editor.accept)
+        buttons.rejected.connect(editor.reject)
+        layout.addRow(buttons)
+
+        if not editor.exec():
+            return
+
+        policy = policy_box.currentData()
+        vmutils.set_quota(int(limits[0].value() * 1e6), policy)
+        quota.set_global_quota(int(limits[1].value() * 1e6), policy)
+        self.status_update("Storage quota updated")
+
+    def recompress_history(self):
+        """Recompresses old checkpoints of the current document with LZMA"""
+
+        if not self.model:
+            return
+
+        days, ok = QtWidgets.QInputDialog.getInt(
+            self,
+            "Recompress Old Checkpoints",
+            "Recompress checkpoints older than (days):",
+            utils.default_recompress_age,
+            0,
+            36500,
+        )
+        if not ok:
+            return
+
+        vmutils = utils.Utils(self.model.utils.krita_filename)
+        vmutils.info_update.connect(self.status_update)
+
+        self.status_update(f"Recompressing {vmutils.data_dir}")
+        self.run_in_background("Recompress", vmutils.recompress, days)
+
+    def regenerate_thumbnails(self, missing_only=False):
+        """Makes new thumbnails for the checkpoints of the current document
+        in the background, see cancel_thumbnails().
+
+        Parameters:
+        missing_only (bool) - Only make thumbnails of checkpoints that have none
+        """
+
+        if not self.model:
+            return
+
+        if self._thumbnail_cancel is not None:
+            self.report_error("Thumbnails are being regenerated already", "Regenerate Thumbnails")
+            return
+
+        vmutils = utils.Utils(self.model.utils.krita_filename)
+        vmutils.info_update.connect(self.status_update)
+        vmutils.progress_update.connect(self.progress_update)
+
+        cancel = threading.Event()
+        self._thumbnail_cancel = cancel
+
+        def finished(result):
+            self._thumbnail_cancel = None
+            # the thumbnail files changed, their names in the history may not have
+            self.reload_history()
+
+        def failed(msg):
+            self._thumbnail_cancel = None
+
+        self.status_update(f"Regenerating thumbnails of {vmutils.data_dir}")
+        self.run_in_background(
+            "Regenerate thumbnails",
+            vmutils.regenerate_thumbnails,
+            missing_only,
+            None,
+            None,
+            cancel,
+            callback=finished,
+            errback=failed,
+        )
+
+    def cancel_thumbnails(self):
+        """Stops a running regenerate_thumbnails() job"""
+
+        if self._thumbnail_cancel is None:
+            self.status_update("No thumbnails are being regenerated")
+            return
+        self.status_update("Cancelling thumbnail regeneration")
+        self._thumbnail_cancel.set()
+
     def set_default_icon_scale(self):
         self.slider_widget.setValue(64)
         self.resize_thumbnails(64)
@@ -663,6 +1402,8 @@ class HistoryWidget(QtWidgets.QWidget):
 
         # remove existing model
         self.table.setModel(None)
+        self._refresh_timer.stop()
+        self.watch_history(None)
 
         self.table.setDisabled(True)
         self.slider_widget.setDisabled(True)
@@ -682,9 +1423,24 @@ class HistoryWidget(QtWidgets.QWidget):
 
         self.status_update("reloading document history {}".format(doc.fileName()))
 
+        # taken before reading, so a write in between is picked up later
+        signature = vmutils.history_signature()
         vmutils.read_history()
+        self._history_signature = signature
+        self.watch_history(vmutils)
+
+        # thumbnails may have changed on disk, e.g. after regenerating them
+        pixmap_cache.discard(vmutils.data_dir)
 
         self.model = HistoryModel(vmutils)
+        # the first layout already uses the slider's size
+        self.model.setThumbnailScale(
+            float(self.slider_widget.value()) / default_thumbnail_resolution
+        )
+        self.model.rowsInserted.connect(self.rows_inserted)
+        self.model.rowsRemoved.connect(self.rows_removed)
+        self.model.modelReset.connect(self.rows_removed)
+        self.model.dataChanged.connect(self.rows_changed)
         self.table.setModel(self.model)
         self.table.verticalHeader().hide()
         self.table.horizontalHeader().hide()
@@ -698,6 +1454,129 @@ class HistoryWidget(QtWidgets.QWidget):
         self.table.setEnabled(True)
         self.slider_widget.setEnabled(True)
 
+    def watch_history(self, vmutils):
+        """Watches the history files of a document for changes.
+
+        Parameters:
+        vmutils (version_manager.utils) - document to watch, None to stop watching
+        """
+
+        paths = self._watcher.files() + self._watcher.directories()
+        if paths:
+            self._watcher.removePaths(paths)
+
+        if vmutils is None or not vmutils.data_dir_exists():
+            return
+
+        # Files only appear in the directory's changes when they are
+        # created, replaced or removed, which also drops them from the
+        # watcher. Appends to the journal are changes of the file itself.
+        self._watcher.addPath(vmutils.data_dir)
+        existing = [path for path in vmutils.history_files() if os.path.exists(path)]
+        if existing:
+            self._watcher.addPaths(existing)
+
+    def history_files_changed(self, path):
+        """Schedules an update of the model once the history files changed.
+
+        Parameters:
+        path (str) - changed file or directory
+        """
+
+        if not self.model:
+            return
+
+        # lock files come and go in the data directory with every read
+        if self.model.utils.history_signature() == self._history_signature:
+            return
+
+        # restarted by every change of a burst
+        self._refresh_timer.start()
+
+    def refresh_history(self):
+        """Updates the model with the changes made to the history since it
+        was read. The model is rebuilt if the history can not be read.
+        """
+
+        if not self.model:
+            self.reload_history()
+            return
+
+        try:
+            vmutils = utils.Utils(self.model.utils.krita_filename)
+            if not vmutils.history_exists():
+                raise FileNotFoundError(vmutils.history_filename)
+            signature = vmutils.history_signature()
+            vmutils.read_history()
+        except history_lock.LockTimeout as e:
+            # a writer holds the lock for a long time, try again later
+            self.status_update(str(e))
+            self._refresh_timer.start()
+            return
+        except FileNotFoundError:
+            self.reload_history()
+            return
+
+        # the table's columns are set up when the first checkpoint shows
+        if not self.model.history or not vmutils.history:
+            self.reload_history()
+            return
+
+        self._history_signature = signature
+        self.watch_history(vmutils)
+        self.model.update_history(vmutils)
+
+    def rows_inserted(self, parent, first, last):
+        """Fits the height of added rows to their thumbnails"""
+
+        # the rows below moved
+        self._sized_rows.clear()
+        for row in range(first, last + 1):
+            self.table.resizeRowToContents(row)
+        self._visible_rows_timer.start()
+
+    def rows_removed(self, *args):
+        """Schedules fitting the rows that moved into the viewport"""
+
+        self._sized_rows.clear()
+        self._visible_rows_timer.start()
+
+    def rows_changed(self, top_left, bottom_right, roles=None):
+        """Schedules fitting the height of rows whose thumbnails changed,
+        e.g. because they have been loaded
+        """
+
+        if top_left.column() <= 1 <= bottom_right.column():
+            self._sized_rows.difference_update(range(top_left.row(), bottom_right.row() + 1))
+            self._visible_rows_timer.start()
+
+    def _visible_rows(self, margin=0):
+        """Returns (first, last) row in the viewport, extended by margin rows"""
+
+        first = self.table.rowAt(0)
+        last = self.table.rowAt(self.table.viewport().height() - 1)
+        if first < 0:
+            first = 0
+        if last < 0:
+            last = self.model.rowCount(None) - 1
+        return max(first - margin, 0), min(last + margin, self.model.rowCount(None) - 1)
+
+    def load_visible_thumbnails(self):
+        """Fits the rows in and around the viewport to their thumbnails and
+        loads the thumbnails
+        """
+
+        # thumbnails are scaled while the size slider moves
+        if not self.model or not self.model.rowCount(None) or self._rescale_timer.isActive():
+            return
+
+        first, last = self._visible_rows(default_prefetch_rows)
+        for row in range(first, last + 1):
+            if row not in self._sized_rows:
+                self.table.resizeRowToContents(row)
+                self._sized_rows.add(row)
+        self.model.load_rows(first, last)
+
     def thumbnail_decrement(self):
         """Decrements icons scale slider by it page step"""
 
@@ -718,9 +1597,39 @@ class HistoryWidget(QtWidgets.QWidget):
         new_value = max(min_value, min(value + page_step, max_value))
         self.slider_widget.setValue(new_value)
 
+    def preview_thumbnails(self, s):
+        """Slot to receive thumbnail size slider changes.
+
+        Only the rows in the viewport are fitted to the loaded thumbnails,
+        scaled to the new size. Thumbnails are loaded at the new size once
+        the slider rests, see default_rescale_delay.
+
+        Parameters:
+        s (int) - New thumbnail width (in pixels)
+        """
+
+        if not self.model:
+            return
+
+        self._rescale_timer.start()
+        self.model.set_preview_width(s)
+
+        # rows below move up or down as the rows above are resized
+        self._sized_rows.clear()
+        row = max(self.table.rowAt(0), 0)
+        height = self.table.viewport().height()
+        while row < self.model.rowCount(None) and self.table.rowViewportPosition(row) < height:
+            self.table.resizeRowToContents(row)
+            row += 1
+        self.table.resizeColumnToContents(1)
+        self.table.viewport().update()
+
     def resize_thumbnails(self, s):
         """Slot to receive thumbnail resize events.
 
+        The rows in and around the viewport are fitted to the new size,
+        the others once they are scrolled into view.
+
         Parameters:
         s (int) - New thumbnail width (in pixels)
         """
@@ -729,10 +1638,14 @@ class HistoryWidget(QtWidgets.QWidget):
         if not self.model:
             return
 
+        self._rescale_timer.stop()
+
         # update model with new thumbnail scale
+        self.model.set_preview_width(None)
         self.model.setThumbnailScale(float(s) / default_thumbnail_resolution)
 
-        self.table.resizeRowsToContents()
+        self._sized_rows.clear()
+        self.load_visible_thumbnails()
         self.table.resizeColumnToContents(1)
 
         self.in_progress.emit(False)
@@ -745,12 +1658,13 @@ class HistoryWidget(QtWidgets.QWidget):
         """Does nothing. Included here to be compatible with Designer generated gui"""
         pass
 
-    def add_checkpoint(self, msg="", autosave=False, generate_thumbnail=True):
+    def add_checkpoint(self, msg="", autosave=False, generate_thumbnail=True, loaded=None):
         """Adds document checkpoint to data directory
 
         Parameters:
             msg (str) - checkpoint message
             autosave (bool) - Save the file first before creating checkpoint
+            loaded (str) - Document ID of a checkpoint the document was copied from
         """
 
         self.in_progress.emit(True)
@@ -773,34 +1687,64 @@ class HistoryWidget(QtWidgets.QWidget):
             self.status_update(f"Initializing data directory {vmutils.data_dir}")
             vmutils.init()
 
-        # Create new checkpoint
-        doc_id, doc_data = vmutils.add_checkpoint(msg)
-
-        if generate_thumbnail:
-            filename = os.path.join(
-                vmutils.data_dir, doc_data["dirname"], "thumbnail.png"
+        # warn before the checkpoint exceeds a storage quota
+        incoming = os.path.getsize(doc.fileName())
+        warning = vmutils.quota_warning(incoming)
+        if warning is not None:
+            result = QtWidgets.QMessageBox.question(
+                self, "Storage Quota", f"{warning}\n\nAdd the checkpoint anyway?"
             )
-            self.status_update(f"Generating thumbnail: {filename}")
-            self.generate_thumbnail(doc, filename)
-            self.status_update("Updating document history with thumbnail information")
-            vmutils.lock_history()
-            vmutils.read_history()
-            if doc_id not in vmutils.history:
-                vmutils.unlock_history()
+            if result != QtWidgets.QMessageBox.Yes:
                 self.in_progress.emit(False)
-                raise KeyError(f"document {doc_id} not found in history json")
-            doc_data = vmutils.history[doc_id]
-            doc_data["thumbnail"] = "thumbnail.png"
-            vmutils.write_history()
-            vmutils.unlock_history()
+                return
 
-        self.reload_history()
+        def make_thumbnail(filename):
+            self.status_update(f"Generating thumbnail: {filename}")
+            # the document is saved, its archive holds the flattened image
+            try:
+                # wide enough for all levels, see Utils.stage_checkpoint()
+                thumbnail.save_from_file(
+                    doc.fileName(), filename, width=max(thumbnail.pyramid_levels)
+                )
+            except (thumbnail.ThumbnailError, kra_archive.UnsupportedArchive) as e:
+                self.status_update(f"{e}, rendering the thumbnail with Krita")
+                self.generate_thumbnail(doc, filename)
+
+        # Copy the document and render its thumbnail without holding the
+        # history lock, then add the checkpoint with a single write
+        staged = vmutils.stage_checkpoint(
+            thumbnail=make_thumbnail if generate_thumbnail else None
+        )
+        try:
+            with vmutils.transaction():
+                vmutils.add_checkpoint(msg, staged=staged)
+                if loaded is not None:
+                    vmutils.mark_loaded(loaded)
+                evicted = vmutils.enforce_quota()
+        except FileExistsError as e:
+            self.in_progress.emit(False)
+            self.report_error(str(e), "No modifications")
+            return
+        finally:
+            staged.discard()
+
+        for evicted in (
+            evicted,
+            utils.enforce_global_quota(reporter=self.status_update),
+        ):
+            if evicted:
+                self.status_update(f"Evicted checkpoints to stay within quota: {evicted}")
+
+        self.refresh_history()
         self.status_update("Add Checkpoint successfully completed.")
 
         self.in_progress.emit(False)
 
     def generate_thumbnail(self, doc, filename):
-        """Opens a krita document and generates a new thumbnail images
+        """Opens a krita document and generates a new thumbnail images.
+
+        Renders the document with Krita, only used for archives without a
+        flattened image (see version_manager.thumbnail).
 
         Parameters:
             doc (Krita static instance) - document to create clone of
@@ -0,0 +1,141 @@
+# SPDX-FileCopyrightText: © Cesar Velazquez <cesarve@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Decodes thumbnails in a QThreadPool, so views do not block while
+images are read and scaled.
+
+Requests carry a priority, e.g. the distance of their row from the
+viewport, and can be cancelled until they have started. Results of
+cancelled requests are dropped.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+
+from PyQt5 import QtCore, QtGui
+
+# number of threads decoding thumbnails
+default_max_threads = 2
+
+
+def load_image(filename, data, width):
+    """Reads a thumbnail and scales it to width.
+
+    Returns a null QImage if there is no such thumbnail.
+
+    Parameters:
+    filename (str) - png file of the thumbnail, None for none
+    data (bytes-like) - encoded thumbnail, decoded instead of reading
+        filename, e.g. a memoryview of a pack file (see
+        packfile.PackFile.view). None for none.
+    width (int) - width of the returned image
+    """
+
+    image = QtGui.QImage()
+    if data is not None:
+        image.loadFromData(data)
+    elif filename and os.path.isfile(filename):
+        image.load(filename)
+    if not image.isNull() and image.width() != width:
+        image = image.scaledToWidth(width, QtCore.Qt.SmoothTransformation)
+    return image
+
+
+class _LoadSignals(QtCore.QObject):
+    """Signals emitted by _LoadTask"""
+
+    # the task and the image it read
+    loaded = QtCore.pyqtSignal(object, QtGui.QImage)
+
+
+class _LoadTask(QtCore.QRunnable):
+    """Runs load_image() in a QThreadPool"""
+
+    def __init__(self, key, filename, data, width):
+        super().__init__()
+
+        self.signals = _LoadSignals()
+        self.key = key
+        self.cancelled = False
+
+        self._args = (filename, data, width)
+
+    def run(self):
+        if self.cancelled:
+            return
+        self.signals.loaded.emit(self, load_image(*self._args))
+
+
+class ThumbnailLoader(QtCore.QObject):
+    """Loads thumbnails in background threads.
+
+    Emits loaded(key, image) in the thread of the loader once a
+    thumbnail was read.
+    """
+
+    loaded = QtCore.pyqtSignal(object, QtGui.QImage)
+
+    def __init__(self, parent=None, max_threads=None):
+        """
+        Arguments:
+        parent (QtCore.QObject) - parent object (optional)
+        max_threads (int) - see default_max_threads
+        """
+
+        super().__init__(parent)
+
+        self._pool = QtCore.QThreadPool(self)
+        self._pool.setMaxThreadCount(max_threads or default_max_threads)
+
+        # tasks that have not finished, by key
+        self._pending = {}
+
+    def is_pending(self, key):
+        """Returns True if the thumbnail of key is being loaded"""
+        return key in self._pending
+
+    def pending(self):
+        """Returns the keys of all requests that have not finished"""
+        return list(self._pending)
+
+    def request(self, key, filename, data, width, priority=0):
+        """Starts loading a thumbnail. Does nothing if it is being loaded.
+
+        Parameters:
+        key (object) - identifies the thumbnail in loaded()
+        filename, data, width - see load_image()
+        priority (int) - requests with a higher priority are started first
+        """
+
+        if key in self._pending:
+            return
+
+        task = _LoadTask(key, filename, data, width)
+        task.signals.loaded.connect(self._task_loaded)
+        self._pending[key] = task
+        self._pool.start(task, priority)
+
+    def cancel(self, keys):
+        """Cancels requests that have not started yet. Results of running
+        requests are dropped.
+
+        Parameters:
+        keys (iterable) - keys of the requests
+        """
+
+        for key in keys:
+            task = self._pending.pop(key, None)
+            if task is not None:
+                task.cancelled = True
+
+    def cancel_all(self):
+        """Cancels all requests"""
+        self.cancel(list(self._pending))
+
+    def _task_loaded(self, task, image):
+        # dropped if the request was cancelled or made again meanwhile
+        if self._pending.get(task.key) is not task:
+            return
+        del self._pending[task.key]
+        self.loaded.emit(task.key, image)
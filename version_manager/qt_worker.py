@@ -0,0 +1,49 @@
+# SPDX-FileCopyrightText: © Cesar Velazquez <cesarve@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import traceback
+
+from PyQt5 import QtCore
+
+
+class WorkerSignals(QtCore.QObject):
+    """Signals emitted by Worker.
+
+    QRunnable is not a QObject, so the signals live in their own object.
+    """
+
+    # result of the function
+    finished = QtCore.pyqtSignal(object)
+
+    # error message
+    failed = QtCore.pyqtSignal(str)
+
+
+class Worker(QtCore.QRunnable):
+    """Runs a function in a QThreadPool"""
+
+    def __init__(self, func, *args, **kwargs):
+        """
+        Arguments:
+        func (callable) - function to run
+        args, kwargs - arguments passed to func
+        """
+
+        super().__init__()
+
+        self.signals = WorkerSignals()
+
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+
+    def run(self):
+        try:
+            result = self._func(*self._args, **self._kwargs)
+        except Exception as e:
+            traceback.print_exc()
+            self.signals.failed.emit(str(e))
+            return
+        self.signals.finished.emit(result)
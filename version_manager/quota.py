@@ -0,0 +1,268 @@
+# SPDX-FileCopyrightText: © Cesar Velazquez <cesarve@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Disk usage accounting and storage quotas.
+
+The disk usage of each document's data directory is kept up to date in
+its history.json (see version_manager.utils.Utils.usage). The usage of
+all documents together is collected in a registry file in the user's
+configuration directory, next to the global quota.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import json
+import os
+
+from PyQt5 import QtCore
+
+# quota of a single document's data directory in bytes, 0 for no limit
+default_document_quota = 0
+
+# quota of all data directories together in bytes, 0 for no limit
+default_global_quota = 0
+
+# Which checkpoints are evicted first when a quota is exceeded
+#   "oldest"                - oldest checkpoints
+#   "largest"               - checkpoints freeing the most space
+#   "least_recently_loaded" - checkpoints that were not loaded for the longest time
+policies = ("oldest", "largest", "least_recently_loaded")
+default_policy = "oldest"
+
+# The running disk usage is checked against the files on disk after this
+# number of seconds, in case files were changed outside of the version manager
+usage_recount_interval = 24 * 60 * 60
+
+
+def directory_usage(directory):
+    """Returns the number of bytes used by the files in a directory tree.
+
+    Hard linked files are only counted once.
+    """
+
+    seen = set()
+    size = 0
+    for root, _, names in os.walk(directory):
+        for name in names:
+            try:
+                info = os.lstat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            if (info.st_dev, info.st_ino) in seen:
+                continue
+            seen.add((info.st_dev, info.st_ino))
+            size += info.st_size
+    return size
+
+
+def file_usage(filename):
+    """Returns the number of bytes a file adds to the disk usage of its
+    directory. Hard links to other files add nothing.
+    """
+
+    info = os.lstat(filename)
+    if info.st_nlink > 1:
+        return 0
+    return info.st_size
+
+
+_sort_keys = {
+    "oldest": lambda candidate: candidate["mtime"],
+    "largest": lambda candidate: (-candidate["size"], candidate["mtime"]),
+    "least_recently_loaded": lambda candidate: (candidate["loaded"], candidate["mtime"]),
+}
+
+
+def order_candidates(candidates, policy=None):
+    """Sorts eviction candidates, first to evict first.
+
+    Parameters:
+    candidates (list) - dictionaries with the keys "mtime", "loaded" (time
+        the checkpoint was last loaded, 0 if never) and "size" (bytes freed)
+    policy (str) - one of policies
+    """
+
+    policy = policy or default_policy
+    if policy not in _sort_keys:
+        raise ValueError(f"Unknown eviction policy: {policy}")
+    return sorted(candidates, key=_sort_keys[policy])
+
+
+def select_candidates(candidates, amount):
+    """Returns (candidates to evict to free amount bytes, bytes freed).
+
+    An object is only freed once every checkpoint that needs it is
+    evicted, e.g. the bases of a delta chain stay while a later checkpoint
+    of the chain is kept. Candidates whose eviction is not needed to free
+    amount are left out. If amount cannot be freed, nothing is selected
+    and the bytes that evicting all candidates would free are returned.
+
+    Parameters:
+    candidates (list) - result of order_candidates(), dictionaries with
+        the keys "files" (bytes of the checkpoint's own files), "objects"
+        (object digest -> stored bytes of the objects the checkpoint
+        needs) and "needed_by" (object digest -> number of checkpoints of
+        the document that need the object)
+    amount (int) - bytes to free
+    """
+
+    selected = []
+    evicted = collections.Counter()
+    freed = 0
+    for candidate in candidates:
+        if freed >= amount:
+            break
+        selected.append(candidate)
+        freed += _freed_by(candidate, evicted)
+
+    if freed < amount:
+        return [], freed
+
+    for candidate in reversed(list(selected)):
+        rest = [other for other in selected if other is not candidate]
+        rest_freed = _freed(rest)
+        if rest_freed >= amount:
+            selected, freed = rest, rest_freed
+
+    return selected, freed
+
+
+def _freed(candidates):
+    """Returns the bytes freed by evicting candidates together, see
+    select_candidates()
+    """
+
+    evicted = collections.Counter()
+    return sum(_freed_by(candidate, evicted) for candidate in candidates)
+
+
+def _freed_by(candidate, evicted):
+    """Returns the bytes freed by also evicting candidate.
+
+    Parameters:
+    candidate (dict) - see select_candidates()
+    evicted (collections.Counter) - (id of the "needed_by" counts, object
+        digest) -> number of evicted checkpoints needing the object,
+        updated in place
+    """
+
+    freed = candidate["files"]
+    for digest, size in candidate["objects"].items():
+        key = (id(candidate["needed_by"]), digest)
+        evicted[key] += 1
+        if evicted[key] == candidate["needed_by"][digest]:
+            freed += size
+    return freed
+
+
+def format_size(size):
+    """Returns a human readable size"""
+
+    for unit in ("bytes", "KB", "MB", "GB"):
+        if abs(size) < 1000 or unit == "GB":
+            break
+        size /= 1000
+    if unit == "bytes":
+        return f"{int(size)} {unit}"
+    return f"{size:.1f} {unit}"
+
+
+def registry_filename():
+    """Absolute path to the registry of all documents' disk usage"""
+
+    config_dir = QtCore.QStandardPaths.writableLocation(
+        QtCore.QStandardPaths.GenericConfigLocation
+    )
+    return os.path.join(config_dir, "krita-version-manager", "documents.json")
+
+
+def read_registry():
+    """Returns the registry of all documents' disk usage.
+
+    Keys:
+    quota (int) - global quota in bytes, 0 for no limit
+    policy (str) - eviction policy for the global quota
+    documents (dict) - data directory -> disk usage in bytes
+    """
+
+    registry = {"quota": default_global_quota, "policy": default_policy, "documents": {}}
+    filename = registry_filename()
+    if os.path.isfile(filename):
+        try:
+            with open(filename, "r") as file_in:
+                registry.update(json.load(file_in))
+        except ValueError:
+            # damaged registry. Documents register again on their next write.
+            pass
+    return registry
+
+
+def update_registry(func):
+    """Changes the registry under a lock.
+
+    Parameters:
+    func (callable) - receives the registry dictionary and changes it in place
+
+    Returns the updated registry
+    """
+
+    filename = registry_filename()
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    lockfile = QtCore.QLockFile(f"{filename}.lock")
+    if not lockfile.tryLock(5000):
+        raise Exception(f"Unable to obtain file lock on {filename}.lock")
+    try:
+        registry = read_registry()
+        func(registry)
+        tmp_filename = f"{filename}.tmp"
+        with open(tmp_filename, "w") as file_out:
+            json.dump(registry, file_out, sort_keys=True, indent=4)
+        os.replace(tmp_filename, filename)
+        return registry
+    finally:
+        lockfile.unlock()
+
+
+def record_usage(data_dir, usage):
+    """Stores the disk usage of a document's data directory in the registry"""
+
+    def update(registry):
+        registry["documents"][data_dir] = usage
+
+    update_registry(update)
+
+
+def set_global_quota(limit, policy=None):
+    """Sets the quota of all data directories together
+
+    Parameters:
+    limit (int) - maximum number of bytes, 0 for no limit
+    policy (str) - which checkpoints are evicted first, see policies
+    """
+
+    if policy is not None and policy not in policies:
+        raise ValueError(f"Unknown eviction policy: {policy}")
+
+    def update(registry):
+        registry["quota"] = int(limit)
+        if policy is not None:
+            registry["policy"] = policy
+
+    update_registry(update)
+
+
+def global_usage(registry=None):
+    """Returns the disk usage of all registered documents.
+
+    Documents whose data directory no longer exists are ignored.
+    """
+
+    if registry is None:
+        registry = read_registry()
+    return sum(
+        usage
+        for data_dir, usage in registry["documents"].items()
+        if os.path.isdir(data_dir)
+    )
@@ -0,0 +1,232 @@
+# SPDX-FileCopyrightText: © Cesar Velazquez <cesarve@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import lzma
+import os
+import struct
+import tempfile
+import zlib
+
+# recompressed object layout:
+#   header: magic, method, deflate level, deflate memory level, size of the original object
+#   data:   xz stream
+_header = struct.Struct("<8sBBBQ")
+_magic = b"KDVMLZM1"
+
+# the object data is compressed as is
+method_raw = 0
+
+# the object is a raw deflate stream (a deflated zip member). Its
+# uncompressed content is compressed instead, and deflated again with the
+# recorded settings when the object is read.
+method_deflate = 1
+
+# xz preset used for recompression. Higher presets need a lot of memory
+# per worker (preset 9 uses ~700 MB).
+default_preset = 6
+
+# recompressed objects larger than this fraction of the original are not kept
+max_ratio = 0.9
+
+# deflate settings tried when looking for the ones that reproduce a member,
+# most common first. Krita writes members with zlib's defaults.
+_deflate_levels = (6, 9, 1, 2, 3, 4, 5, 7, 8)
+_deflate_mem_levels = (8, 9)
+
+# size of read/write chunks (in bytes)
+_copy_size = 1024 * 1024
+
+
+class RecompressError(Exception):
+    """Raised when a recompressed object cannot be decoded"""
+
+    pass
+
+
+class DeflateMismatch(RecompressError):
+    """Raised when deflating a member again does not give back the
+    original bytes, e.g. because this zlib differs from the one used for
+    recompression. The uncompressed member data is still available.
+    """
+
+    pass
+
+
+def _read_range(filename, offset, size):
+    """Generator yielding the bytes of a range of a file in chunks"""
+
+    with open(filename, "rb") as file_in:
+        file_in.seek(offset)
+        remaining = size
+        while remaining:
+            chunk = file_in.read(min(_copy_size, remaining))
+            if not chunk:
+                raise EOFError(f"Unexpected end of file: {filename}")
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _read_file(file_in):
+    """Generator yielding the remaining bytes of an open file in chunks"""
+
+    while True:
+        chunk = file_in.read(_copy_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _deflater(level, mem_level):
+    return zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, mem_level)
+
+
+def _reproduces(raw_file, filename, offset, size, level, mem_level):
+    """Returns True if deflating raw_file with the given settings gives
+    exactly the bytes of the range of filename.
+
+    Stops at the first difference.
+    """
+
+    deflater = _deflater(level, mem_level)
+    remaining = size
+    raw_file.seek(0)
+
+    with open(filename, "rb") as original:
+        original.seek(offset)
+
+        def matches(data):
+            nonlocal remaining
+            if len(data) > remaining:
+                return False
+            remaining -= len(data)
+            return original.read(len(data)) == data
+
+        for chunk in _read_file(raw_file):
+            if not matches(deflater.compress(chunk)):
+                return False
+        return matches(deflater.flush()) and remaining == 0
+
+
+def _deflate_settings(raw_file, filename, offset, size):
+    """Returns (level, memory level) that reproduce a deflated member,
+    None if there are none.
+    """
+
+    for mem_level in _deflate_mem_levels:
+        for level in _deflate_levels:
+            if _reproduces(raw_file, filename, offset, size, level, mem_level):
+                return level, mem_level
+    return None
+
+
+def encode(filename, offset, size, compress_type, target, preset=default_preset):
+    """Recompresses an object with LZMA.
+
+    Runs in a worker process, all arguments are picklable.
+
+    Parameters:
+    filename (str) - file holding the object (a loose object or a pack file)
+    offset (int) - position of the object in the file
+    size (int) - size of the object
+    compress_type (int) - zip compression method if the object is a zip member, None otherwise
+    target (str) - file receiving the recompressed object
+    preset (int) - xz preset
+
+    Returns (method, recompressed size) or None if recompression does
+    not save enough space. Nothing is written in that case.
+    """
+
+    method = method_raw
+    level = mem_level = 0
+
+    with tempfile.TemporaryFile(dir=os.path.dirname(target)) as raw_file:
+        if compress_type == 8:
+            # zipfile.ZIP_DEFLATED. Look for settings that give back the
+            # exact same bytes, otherwise the member is compressed as is.
+            inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+            try:
+                for chunk in _read_range(filename, offset, size):
+                    raw_file.write(inflater.decompress(chunk))
+                raw_file.write(inflater.flush())
+            except zlib.error:
+                pass
+            else:
+                settings = _deflate_settings(raw_file, filename, offset, size)
+                if settings is not None:
+                    method = method_deflate
+                    level, mem_level = settings
+
+        if method == method_raw:
+            chunks = _read_range(filename, offset, size)
+        else:
+            raw_file.seek(0)
+            chunks = _read_file(raw_file)
+
+        compressor = lzma.LZMACompressor(preset=preset)
+        with open(target, "wb") as file_out:
+            file_out.write(_header.pack(_magic, method, level, mem_level, size))
+            for chunk in chunks:
+                file_out.write(compressor.compress(chunk))
+            file_out.write(compressor.flush())
+            encoded_size = file_out.tell()
+
+    if encoded_size > size * max_ratio:
+        os.remove(target)
+        return None
+    return method, encoded_size
+
+
+def read_header(file_in):
+    """Reads the header of a recompressed object.
+
+    Returns (method, deflate level, deflate memory level, original size)
+    """
+
+    data = file_in.read(_header.size)
+    if len(data) != _header.size:
+        raise RecompressError("Truncated header")
+    magic, method, level, mem_level, size = _header.unpack(data)
+    if magic != _magic:
+        raise RecompressError("Not a recompressed object")
+    return method, level, mem_level, size
+
+
+def decode(file_in, file_out, inflated=False):
+    """Writes the original content of a recompressed object.
+
+    Parameters:
+    file_in (file) - binary file holding the recompressed object
+    file_out (file) - binary file receiving the content
+    inflated (bool) - For deflated zip members, write the uncompressed
+        member data instead of deflating it again.
+
+    Returns the number of bytes written.
+    """
+
+    method, level, mem_level, size = read_header(file_in)
+    decompressor = lzma.LZMADecompressor()
+    deflater = None
+    if method == method_deflate and not inflated:
+        deflater = _deflater(level, mem_level)
+
+    written = 0
+    try:
+        for chunk in _read_file(file_in):
+            data = decompressor.decompress(chunk)
+            if deflater is not None:
+                data = deflater.compress(data)
+            written += file_out.write(data)
+    except lzma.LZMAError as e:
+        raise RecompressError(str(e))
+    if deflater is not None:
+        written += file_out.write(deflater.flush())
+
+    if not decompressor.eof:
+        raise RecompressError("Truncated xz stream")
+    if deflater is not None and written != size:
+        raise DeflateMismatch(f"Deflated {written} bytes, expected {size}")
+    if method == method_raw and written != size:
+        raise RecompressError(f"Decoded {written} bytes, expected {size}")
+    return written
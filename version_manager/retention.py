@@ -0,0 +1,130 @@
+# SPDX-FileCopyrightText: © Cesar Velazquez <cesarve@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Grandfather-father-son thinning of checkpoint histories."""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import time
+
+hour = 60 * 60
+day = 24 * hour
+week = 7 * day
+
+# (maximum age, interval) pairs in seconds, youngest first.
+# A checkpoint is handled by the first rule whose maximum age it is below,
+# None applies to any age. Of the checkpoints falling into the same
+# interval only the newest is kept, an interval of 0 keeps all of them.
+# Checkpoints older than every rule are removed.
+default_rules = (
+    (day, 0),
+    (7 * day, hour),
+    (90 * day, day),
+    (None, week),
+)
+
+
+def _rule_index(age, rules):
+    """Returns the index of the rule handling a checkpoint, None if there is none"""
+
+    for i, (max_age, _) in enumerate(rules):
+        if max_age is None or age < max_age:
+            return i
+    return None
+
+
+def thin(history, rules=None, now=None):
+    """Selects the checkpoints removed by a retention policy.
+
+    Intervals are aligned to local calendar time, not to now, so running
+    the policy again later does not remove checkpoints it kept before
+    unless they moved on to a rule with a longer interval.
+
+    Pinned checkpoints and the most recent checkpoint are always kept.
+
+    Parameters:
+    history (dict) - history dictionary (see version_manager.utils.Utils.history)
+    rules (sequence) - (maximum age, interval) pairs, see default_rules
+    now (float) - time to compute ages from. Defaults to the current time.
+
+    Returns list of keys of the checkpoints to remove, oldest first
+    """
+
+    if rules is None:
+        rules = default_rules
+    if now is None:
+        now = time.time()
+
+    newest_first = sorted(history, key=lambda doc_id: history[doc_id]["mtime"], reverse=True)
+
+    # keys of the intervals that already kept a checkpoint
+    kept = set()
+    removed = []
+
+    for position, doc_id in enumerate(newest_first):
+        entry = history[doc_id]
+        if position == 0 or entry.get("pinned"):
+            continue
+
+        rule = _rule_index(now - entry["mtime"], rules)
+        if rule is None:
+            removed.append(doc_id)
+            continue
+
+        interval = rules[rule][1]
+        if not interval:
+            continue
+
+        mtime = entry["mtime"]
+        local_time = mtime + time.localtime(mtime).tm_gmtoff
+        bucket = (rule, int(local_time // interval))
+        if bucket in kept:
+            removed.append(doc_id)
+        else:
+            kept.add(bucket)
+
+    removed.reverse()
+    return removed
+
+
+def _duration(seconds):
+    """Returns (count, unit name) for a number of seconds"""
+
+    for unit, name in ((week, "week"), (day, "day"), (hour, "hour"), (60, "minute")):
+        if seconds >= unit and seconds % unit == 0:
+            return seconds // unit, name
+    return seconds, "second"
+
+
+def _format_duration(seconds):
+    count, name = _duration(seconds)
+    return f"{count} {name}{'' if count == 1 else 's'}"
+
+
+def describe(rules=None):
+    """Returns a human readable description of retention rules"""
+
+    if rules is None:
+        rules = default_rules
+
+    lines = []
+    previous = 0
+    for max_age, interval in rules:
+        if max_age is None:
+            period = f"Older than {_format_duration(previous)}"
+        elif not previous:
+            period = f"Last {_format_duration(max_age)}"
+        else:
+            period = f"{_format_duration(previous)} to {_format_duration(max_age)} old"
+
+        if not interval:
+            keep = "keep all"
+        elif _duration(interval)[0] == 1:
+            keep = f"keep one per {_duration(interval)[1]}"
+        else:
+            keep = f"keep one per {_format_duration(interval)}"
+
+        lines.append(f"{period}: {keep}")
+        if max_age is not None:
+            previous = max_age
+    return "\n".join(lines)
@@ -0,0 +1,272 @@
+# SPDX-FileCopyrightText: © Cesar Velazquez <cesarve@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""SQLite storage for checkpoint histories.
+
+An alternative to history.json and its journal (see
+version_manager.journal) for histories with many checkpoints. Entries
+are stored as rows indexed by modification time, short id, owner and
+content digest, so the latest checkpoints or the checkpoints of a date
+range can be looked up without loading the whole history.
+
+The database uses write-ahead logging: readers, e.g. other Krita
+instances showing the same history, never wait for writers and do not
+need the history lock. Writers still hold it. WAL needs a local file
+system, network shares should keep using history.json.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import contextlib
+import json
+import os
+
+try:
+    import sqlite3
+except ImportError:
+    # Python builds without the sqlite3 module can only use history.json
+    sqlite3 = None
+
+from . import history_cache, journal
+
+# seconds a connection waits for another one holding a write lock
+_timeout = 15
+
+_schema = """
+CREATE TABLE checkpoints (
+    doc_id TEXT PRIMARY KEY,
+    id TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    owner TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    entry TEXT NOT NULL
+);
+CREATE INDEX checkpoints_mtime ON checkpoints (mtime);
+CREATE INDEX checkpoints_id ON checkpoints (id);
+CREATE INDEX checkpoints_owner ON checkpoints (owner);
+CREATE INDEX checkpoints_digest ON checkpoints (digest);
+CREATE TABLE metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def available():
+    """Returns True if this Python comes with the sqlite3 module"""
+    return sqlite3 is not None
+
+
+def _row(doc_id, entry):
+    return (
+        doc_id,
+        str(entry.get("id", "")),
+        float(entry.get("mtime", 0.0)),
+        entry.get("owner", ""),
+        entry.get("digest", ""),
+        json.dumps(entry, sort_keys=True),
+    )
+
+
+class SqliteHistory(object):
+    """History stored in a SQLite database.
+
+    Has the same interface as version_manager.journal.Journal, plus
+    queries returning lists of (doc_id, entry) tuples.
+    """
+
+    def __init__(self, filename):
+        """
+        Arguments:
+        filename (str) - database file
+        """
+
+        self._filename = filename
+        self._data_dir = os.path.dirname(os.path.abspath(filename))
+
+        # metadata as it was last read or written, see write()
+        self._metadata = {}
+
+    @property
+    def filename(self):
+        """Absolute path to the database"""
+        return self._filename
+
+    @property
+    def files(self):
+        """Absolute paths to the files the history is stored in.
+
+        The shared memory index (-shm) changes on reads too and is left out.
+        """
+        return (self.filename, f"{self.filename}-wal")
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        if not available():
+            raise RuntimeError("The sqlite3 module is not available")
+        connection = sqlite3.connect(self.filename, timeout=_timeout)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def read(self):
+        """Loads the whole history.
+
+        Returns (history (version_manager.journal.TrackedDict), metadata (dict))
+        """
+
+        if not self.exists():
+            raise FileNotFoundError(f"File not found: {self.filename}")
+
+        signature = self._signature()
+        cached = history_cache.get(self._data_dir, signature)
+        if cached is not None:
+            history, metadata = cached
+        else:
+            with self._connect() as connection:
+                # a single transaction so the rows and metadata match
+                with connection:
+                    connection.execute("BEGIN")
+                    rows = connection.execute("SELECT doc_id, entry FROM checkpoints").fetchall()
+                    metadata = {
+                        key: json.loads(value)
+                        for key, value in connection.execute("SELECT key, value FROM metadata")
+                    }
+            history = dict((doc_id, json.loads(entry)) for doc_id, entry in rows)
+            history_cache.put(self._data_dir, signature, history, metadata)
+
+        self._metadata = json.loads(json.dumps(metadata))
+        return journal.TrackedDict(history), metadata
+
+    def _signature(self):
+        return history_cache.signature(self.files)
+
+    def write(self, history, metadata):
+        """Writes the tracked changes of a history in a single transaction.
+
+        Parameters:
+        history (version_manager.journal.TrackedDict) - history dictionary
+        metadata (dict) - history metadata
+        """
+
+        if not self.exists():
+            self.compact(history, metadata)
+            return
+
+        with self._connect() as connection:
+            with connection:
+                self._write_changes(connection, history, metadata)
+
+        history.reset_changes()
+        self._metadata = json.loads(json.dumps(metadata))
+        history_cache.put(self._data_dir, self._signature(), history, metadata)
+
+    def _write_changes(self, connection, history, metadata):
+        connection.executemany(
+            "DELETE FROM checkpoints WHERE doc_id = ?",
+            [(doc_id,) for doc_id in history.removed],
+        )
+        connection.executemany(
+            "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?)",
+            [_row(doc_id, history[doc_id]) for doc_id in history.changed],
+        )
+
+        connection.executemany(
+            "DELETE FROM metadata WHERE key = ?",
+            [(key,) for key in self._metadata if key not in metadata],
+        )
+        connection.executemany(
+            "INSERT OR REPLACE INTO metadata VALUES (?, ?)",
+            [
+                (key, json.dumps(value, sort_keys=True))
+                for key, value in metadata.items()
+                if key not in self._metadata or self._metadata[key] != value
+            ],
+        )
+
+    def compact(self, history, metadata):
+        """Writes the whole history.
+
+        A new database is built under a temporary name and moved into
+        place, an existing one is rewritten in a single transaction and
+        its write-ahead log is folded into it.
+        """
+
+        if not available():
+            raise RuntimeError("The sqlite3 module is not available")
+
+        self._metadata = {}
+        history.changed = set(history)
+
+        if self.exists():
+            with self._connect() as connection:
+                with connection:
+                    connection.execute("DELETE FROM checkpoints")
+                    connection.execute("DELETE FROM metadata")
+                    self._write_changes(connection, history, metadata)
+                connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        else:
+            tmp_filename = f"{self.filename}.tmp"
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            connection = sqlite3.connect(tmp_filename, timeout=_timeout)
+            try:
+                with connection:
+                    connection.executescript(_schema)
+                with connection:
+                    self._write_changes(connection, history, metadata)
+                # persistent, applies to every later connection
+                connection.execute("PRAGMA journal_mode=WAL")
+            finally:
+                connection.close()
+            # a log left behind by a removed database would be applied to this one
+            self.remove()
+            os.replace(tmp_filename, self.filename)
+
+        history.reset_changes()
+        self._metadata = json.loads(json.dumps(metadata))
+        history_cache.put(self._data_dir, self._signature(), history, metadata)
+
+    def remove(self):
+        """Deletes the database and its write-ahead log"""
+
+        history_cache.discard(self._data_dir)
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(f"{self.filename}{suffix}")
+            except FileNotFoundError:
+                pass
+
+    def _select(self, where="", parameters=(), order="mtime", limit=None):
+        query = "SELECT doc_id, entry FROM checkpoints"
+        if where:
+            query += f" WHERE {where}"
+        query += f" ORDER BY {order}"
+        if limit is not None:
+            query += " LIMIT ?"
+            parameters = tuple(parameters) + (int(limit),)
+        with self._connect() as connection:
+            return [
+                (doc_id, json.loads(entry))
+                for doc_id, entry in connection.execute(query, parameters)
+            ]
+
+    def latest(self, count):
+        """The count most recent checkpoints, newest first"""
+        return self._select(order="mtime DESC", limit=count)
+
+    def between(self, start, end):
+        """Checkpoints with start <= mtime < end, oldest first"""
+        return self._select("mtime >= ? AND mtime < ?", (start, end))
+
+    def with_digest(self, digest):
+        """Checkpoints whose payload has the given digest, oldest first"""
+        return self._select("digest = ?", (digest,))
+
+    def by_owner(self, owner):
+        """Checkpoints of an owner, oldest first"""
+        return self._select("owner = ?", (owner,))
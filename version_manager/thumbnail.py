@@ -0,0 +1,256 @@
+# SPDX-FileCopyrightText: © Cesar Velazquez <cesarve@gmail.com>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Thumbnails read straight from krita archives.
+
+Every .kra file holds a flattened copy of the image: preview.png, at
+most 256 pixels wide or high, and mergedimage.png at full size.
+Thumbnails are made from these without Krita, so no document is opened,
+cloned or flattened and the UI is not blocked while the canvas is
+rendered.
+
+preview.png is used whenever it is large enough. Otherwise
+mergedimage.png is decoded with QImageReader.setScaledSize(), so the cost
+of a thumbnail depends on its size rather than on the size of the canvas.
+
+Each checkpoint stores its thumbnail at several widths (see
+pyramid_levels), so views can pick the level closest to the size they
+show instead of scaling a single image on every paint.
+
+Only QImage is used, thumbnails can be made in any thread.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+
+from PyQt5 import QtCore, QtGui
+
+from . import kra_archive
+
+# default size of the larger side of a thumbnail (in pixels)
+default_resolution = 240
+
+# archive members holding a flattened image, smallest first
+image_members = ("preview.png", "mergedimage.png")
+
+# widths (in pixels) of the thumbnail levels stored for each checkpoint.
+# Thumbnails are never scaled up, levels wider than the image are not stored.
+pyramid_levels = (32, 64, 128, 256, 512)
+
+
+class ThumbnailError(Exception):
+    """Raised when an archive holds no usable image"""
+
+    pass
+
+
+def thumbnail_size(size, resolution):
+    """Returns the size (QtCore.QSize) of an image scaled so its larger
+    side is resolution pixels.
+
+    Parameters:
+    size (QtCore.QSize) - size of the image
+    resolution (int) - size of the larger side of the thumbnail
+    """
+
+    scale = resolution / max(size.width(), size.height())
+    return QtCore.QSize(
+        max(1, round(size.width() * scale)), max(1, round(size.height() * scale))
+    )
+
+
+def _excess(size, resolution, width):
+    """Returns how much larger than the thumbnail an image of the given
+    size is, negative if it is smaller. See render().
+    """
+
+    if width:
+        return size.width() - width
+    return max(size.width(), size.height()) - resolution
+
+
+def _decode(data, resolution, width):
+    """Decodes an image, scaled down to the size of the thumbnail.
+
+    Returns a null QImage if the data is not an image.
+    """
+
+    buffer = QtCore.QBuffer()
+    buffer.setData(data)
+    buffer.open(QtCore.QIODevice.ReadOnly)
+
+    reader = QtGui.QImageReader(buffer)
+    size = reader.size()
+    if not size.isValid():
+        return QtGui.QImage()
+    if _excess(size, resolution, width) > 0:
+        if width:
+            reader.setScaledSize(
+                QtCore.QSize(width, max(1, round(size.height() * width / size.width())))
+            )
+        else:
+            reader.setScaledSize(thumbnail_size(size, resolution))
+    return reader.read()
+
+
+def image_size(data):
+    """Returns the size of an image without decoding it, an invalid
+    QtCore.QSize if the data is not an image.
+    """
+
+    buffer = QtCore.QBuffer()
+    buffer.setData(data)
+    buffer.open(QtCore.QIODevice.ReadOnly)
+    return QtGui.QImageReader(buffer).size()
+
+
+def read_image_size(filename):
+    """Returns the size of an image file, read from its header. An invalid
+    QtCore.QSize if the file is not an image.
+    """
+    return QtGui.QImageReader(filename).size()
+
+
+def render(read_member, resolution=None, width=None):
+    """Returns the thumbnail (QtGui.QImage) of a krita archive.
+
+    Parameters:
+    read_member (callable) - returns the content of an archive member
+        by name, None if the archive has no such member
+    resolution (int) - see default_resolution
+    width (int) - width of the thumbnail, overrides resolution
+
+    Raises ThumbnailError if the archive holds no usable image.
+    """
+
+    resolution = resolution or default_resolution
+
+    # smaller images that were not large enough, used if nothing better is found
+    fallback = None
+
+    for name in image_members:
+        data = read_member(name)
+        if data is None:
+            continue
+        size = image_size(data)
+        if not size.isValid():
+            continue
+        if _excess(size, resolution, width) < 0 and name != image_members[-1]:
+            fallback = fallback or data
+            continue
+        image = _decode(data, resolution, width)
+        if not image.isNull():
+            return image
+
+    if fallback is not None:
+        image = _decode(fallback, resolution, width)
+        if not image.isNull():
+            return image
+
+    raise ThumbnailError(f"No image found in the archive (looked for {', '.join(image_members)})")
+
+
+def save(read_member, filename, resolution=None, width=None):
+    """Writes the thumbnail of a krita archive to a png file.
+
+    Parameters:
+    read_member (callable) - see render()
+    filename (str) - png file to write
+    resolution (int) - see default_resolution
+    width (int) - width of the thumbnail, overrides resolution
+    """
+
+    image = render(read_member, resolution, width)
+    if not image.save(filename, "PNG"):
+        raise ThumbnailError(f"Unable to write thumbnail {filename}")
+
+
+def save_from_file(krita_filename, filename, resolution=None, width=None):
+    """Writes the thumbnail of a krita file to a png file.
+
+    Parameters:
+    krita_filename (str) - krita document
+    filename (str) - png file to write
+    resolution (int) - see default_resolution
+    width (int) - width of the thumbnail, overrides resolution
+    """
+
+    def read_member(name):
+        return kra_archive.read_archive_member(krita_filename, name)
+
+    save(read_member, filename, resolution, width)
+
+
+def level_filename(level):
+    """Returns the file name of a thumbnail level, e.g. "thumbnail_64.png" """
+    return f"thumbnail_{level}.png"
+
+
+def nearest_level(levels, width):
+    """Returns the smallest level at least width pixels wide, the largest
+    level if none is that wide. None if there are no levels.
+
+    Parameters:
+    levels (list) - widths of the stored levels
+    width (int) - width to show the thumbnail at
+    """
+
+    for level in sorted(levels):
+        if level >= width:
+            return level
+    return max(levels) if levels else None
+
+
+def load(filename):
+    """Returns the image (QtGui.QImage) stored in a png file"""
+
+    image = QtGui.QImage(filename)
+    if image.isNull():
+        raise ThumbnailError(f"Unable to read thumbnail {filename}")
+    return image
+
+
+def write_pyramid(image, directory, levels=None):
+    """Writes the levels of a thumbnail, see level_filename().
+
+    Levels wider than the image are not written, except for the first
+    one, which holds the image at its own size.
+
+    Parameters:
+    image (QtGui.QImage) - thumbnail, at least as wide as the largest level
+        for all levels to be sharp
+    directory (str) - directory receiving the level files
+    levels (list) - see pyramid_levels
+
+    Returns list of the levels written, smallest first
+    """
+
+    written = []
+    for level in sorted(levels or pyramid_levels):
+        if level >= image.width():
+            scaled = image
+        else:
+            scaled = image.scaledToWidth(level, QtCore.Qt.SmoothTransformation)
+        filename = os.path.join(directory, level_filename(level))
+        if not scaled.save(filename, "PNG"):
+            raise ThumbnailError(f"Unable to write thumbnail {filename}")
+        written.append(level)
+        if scaled is image:
+            break
+    return written
+
+
+def save_pyramid(read_member, directory, levels=None):
+    """Writes the levels of the thumbnail of a krita archive.
+
+    Parameters:
+    read_member (callable) - see render()
+    directory (str) - directory receiving the level files
+    levels (list) - see pyramid_levels
+
+    Returns list of the levels written, smallest first
+    """
+
+    levels = levels or pyramid_levels
+    return write_pyramid(render(read_member, width=max(levels)), directory, levels)
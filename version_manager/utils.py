@@ -3,15 +3,40 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import collections
+import concurrent.futures
+import contextlib
 import errno
+import functools
+import heapq
 import json
+import multiprocessing
 import os
 import random
 import shutil
+import stat
+import sys
+import tempfile
+import time
 from datetime import datetime
 
 from PyQt5 import QtCore
 
+from . import (
+    blob_store,
+    copy_engine,
+    history_cache,
+    history_lock,
+    journal,
+    kra_archive,
+    packfile,
+    quota,
+    recompress,
+    retention,
+    sqlite_history,
+    thumbnail,
+)
+
 if os.name == "nt":
     # import win32api
     # import win32con
@@ -20,6 +45,102 @@ if os.name == "nt":
 else:
     from pwd import getpwuid
 
+# How checkpoint payloads are stored in the object store
+#   "blob"    - one object holding the whole krita file
+#   "members" - one object per zip member of the krita file. Layers that
+#               did not change are shared between checkpoints.
+default_storage_mode = "blob"
+
+# Maximum number of deltas needed to rebuild a checkpoint stored in "blob"
+# mode. Each new checkpoint is stored as a delta against the previous one
+# until the chain reaches this length, then a full keyframe is stored.
+# Longer chains use less disk space but take longer to load. 0 disables
+# delta storage.
+default_max_chain_length = 0
+
+# Checkpoints older than this number of days are moved into the pack
+# file by repack()
+default_repack_age = 30
+
+# Number of most recent checkpoints that repack() always leaves loose
+default_repack_keep = 20
+
+# Checkpoints older than this number of days are recompressed by recompress()
+default_recompress_age = 90
+
+# What add_checkpoint() does when the document content is identical to
+# the latest checkpoint
+#   "reference" - add a checkpoint that shares the latest checkpoint's payload
+#   "refuse"    - raise FileExistsError
+default_duplicate_policy = "reference"
+
+# Whether the short ids of removed checkpoints are given to new
+# checkpoints. Otherwise short ids only increase.
+default_reuse_ids = False
+
+# How the history of a new data directory is stored
+#   "json"   - history.json and a journal of changes, see version_manager.journal
+#   "sqlite" - history.sqlite database, see version_manager.sqlite_history
+# Existing histories keep their backend until set_history_backend() is called.
+history_backends = ("json", "sqlite")
+default_history_backend = "json"
+
+# Whether new data directories keep a copy of all thumbnails in a single
+# file, the thumbnail atlas (see Utils.set_thumbnail_atlas()). Showing a
+# history then opens one file instead of one per checkpoint, which helps
+# on network drives.
+default_thumbnail_atlas = False
+
+
+# Staging directories of checkpoints older than this number of seconds are
+# left over from crashes and removed by prune_objects()
+stale_staging_age = 24 * 60 * 60
+
+# Checkouts that are full copies rather than hard links to an object, e.g.
+# rebuilt from zip members or deltas, are only kept for this number of most
+# recently loaded checkpoints. See Utils.checkpoint_filename()
+max_copied_checkouts = 3
+
+
+class StagedCheckpoint(object):
+    """Payload and thumbnail of a new checkpoint, copied into the data
+    directory but not yet part of the history. See Utils.stage_checkpoint()
+    """
+
+    def __init__(self, directory, modtime):
+        """
+        Arguments:
+        directory (str) - staging directory inside the data directory
+        modtime (float) - modification time of the staged krita document
+        """
+
+        self.directory = directory
+        self.modtime = modtime
+
+        # objects of the payload, moved into the object store on commit
+        self.objects = blob_store.BlobStore(os.path.join(directory, "objects"))
+
+        # checkpoint fields describing the payload, see Utils.store_payload()
+        self.payload = None
+
+        # delta of the payload against the object delta_base, None if the
+        # payload is stored as a keyframe. See BlobStore.compute_delta()
+        self.delta = None
+        self.delta_base = None
+
+        # staged thumbnail png, None if there is none
+        self.thumbnail = None
+
+        # thumbnail levels written into the staging directory, see
+        # version_manager.thumbnail.write_pyramid()
+        self.thumbnails = []
+
+    def discard(self):
+        """Deletes whatever is left in the staging directory"""
+
+        if os.path.isdir(self.directory):
+            shutil.rmtree(self.directory, onerror=_remove_readonly)
+
 
 class Utils(QtCore.QObject):
     """Manages lower level operations for Krita document version manager"""
@@ -28,25 +149,66 @@ class Utils(QtCore.QObject):
     document_template = {
         "filename": "",
         "thumbnail": "",
+        "thumbnails": [],
+        "thumbnail_size": [],
         "mtime": 0.0,
         "dirname": "",
         "message": "",
         "owner": "",
         "date": "",
+        "digest": "",
+        "size": 0,
+        "storage": "",
+        "manifest": "",
+        "packed": False,
+        "duplicate_of": "",
+        "codec": "",
+        "pinned": False,
+        "loaded": 0.0,
     }
 
+    # key of the history.json entry holding data about the history itself
+    # (e.g. the latest checkpoint). It is kept out of the history dictionary.
+    metadata_key = "__metadata__"
+
     # Signal to send text to debug console
     info_update = QtCore.pyqtSignal(str)
     error_update = QtCore.pyqtSignal(str, str)
 
-    def __init__(self, filename):
+    # Signal with the progress of long operations (done, total)
+    progress_update = QtCore.pyqtSignal(int, int)
+
+    def __init__(
+        self,
+        filename,
+        storage_mode=None,
+        max_chain_length=None,
+        duplicate_policy=None,
+        history_backend=None,
+        lock_timeout=None,
+    ):
         """
         Arguments:
         filename (str) - Krita document .kra to manage
+        storage_mode (str) - How new checkpoints are stored (see default_storage_mode)
+        max_chain_length (int) - Maximum delta chain length (see default_max_chain_length)
+        duplicate_policy (str) - How unchanged documents are checkpointed (see default_duplicate_policy)
+        history_backend (str) - How the history of a new data directory is stored (see default_history_backend)
+        lock_timeout (float) - Seconds to wait for the history lock (see version_manager.history_lock.default_timeout)
         """
 
         super().__init__()
 
+        self._history_backend = history_backend or default_history_backend
+        if self._history_backend not in history_backends:
+            raise ValueError(f"Unknown history backend: {self._history_backend}")
+
+        self._storage_mode = storage_mode or default_storage_mode
+        self._duplicate_policy = duplicate_policy or default_duplicate_policy
+        self._max_chain_length = (
+            default_max_chain_length if max_chain_length is None else max_chain_length
+        )
+
         self._krita_file = filename
 
         # check source krita document
@@ -68,11 +230,49 @@ class Utils(QtCore.QObject):
         self._data_basename = "history.json"
         self._data_filename = os.path.join(self.data_dir, self._data_basename)
 
+        # storage of the history, an existing database takes precedence
+        self._store = self._history_store("sqlite")
+        if not self._store.exists():
+            self._store = self._history_store("json")
+
+        # content addressed storage for checkpoint payloads
+        # pack file holding old checkpoints, see repack()
+        self._pack = packfile.PackFile(os.path.join(self.data_dir, "pack"))
+
+        # copies of the loose thumbnails, see set_thumbnail_atlas()
+        self._thumbnail_atlas = packfile.PackFile(
+            os.path.join(self.data_dir, "pack"), basename="thumbnails"
+        )
+
+        self._objects = blob_store.BlobStore(
+            os.path.join(self.data_dir, "objects"),
+            reporter=self.status_update,
+            pack=self._pack,
+        )
+
+        # directory where stored checkpoints are made available to Krita
+        self._checkout_dir = os.path.join(self.data_dir, "checkout")
+
         # dictionary holding  ndata for all document versions
         self._history = None
 
-        # lockfile used when writing history json file
-        self._lockfile = None
+        # data about the history itself, stored under metadata_key
+        self._metadata = {}
+
+        # bytes added to the data directory (negative if removed) by files
+        # written outside of the object store and pack since the last
+        # write_history(). See usage.
+        self._usage_change = 0
+
+        # reader/writer lock on the history
+        self._lock = history_lock.HistoryLock(
+            os.path.join(self.data_dir, f"{self.history_basename}.lock"),
+            timeout=lock_timeout,
+            reporter=self.status_update,
+        )
+
+        # number of nested transaction() blocks
+        self._transaction_depth = 0
 
     @property
     def krita_filename(self):
@@ -109,13 +309,107 @@ class Utils(QtCore.QObject):
         """Dictionary holding history data"""
         return self._history
 
+    @property
+    def metadata(self):
+        """Dictionary holding data about the history, e.g. the latest checkpoint"""
+        return self._metadata
+
+    @property
+    def usage(self):
+        """Number of bytes used by the data directory.
+
+        Kept up to date in the history metadata while files are added and
+        removed, so the directory does not need to be walked.
+        """
+
+        return self.metadata.get("usage", 0) + self._pending_usage()
+
+    def _pending_usage(self):
+        """Returns bytes added to the data directory since the usage in the
+        metadata was last updated (negative if removed)
+        """
+
+        return (
+            self._usage_change
+            + self.objects.usage_change
+            + self.pack.usage_change
+            + self.thumbnail_atlas.usage_change
+        )
+
+    @property
+    def quota(self):
+        """Maximum number of bytes the data directory may use, 0 for no limit"""
+        return self.metadata.get("quota", quota.default_document_quota)
+
+    @property
+    def eviction_policy(self):
+        """Which checkpoints are evicted first, see version_manager.quota.policies"""
+        return self.metadata.get("eviction_policy", quota.default_policy)
+
+    @property
+    def objects(self):
+        """version_manager.blob_store.BlobStore holding checkpoint payloads"""
+        return self._objects
+
+    @property
+    def pack(self):
+        """version_manager.packfile.PackFile holding old checkpoints"""
+        return self._pack
+
+    @property
+    def thumbnail_atlas(self):
+        """version_manager.packfile.PackFile holding copies of the loose
+        thumbnails, keyed "<doc_id>/<thumbnail file>". See set_thumbnail_atlas()
+        """
+        return self._thumbnail_atlas
+
+    @property
+    def use_thumbnail_atlas(self):
+        """True if thumbnails are copied into the thumbnail atlas"""
+        return self.metadata.get("thumbnail_atlas", default_thumbnail_atlas)
+
+    @property
+    def checkout_dir(self):
+        """Absolute path to directory holding checked out checkpoints"""
+        return self._checkout_dir
+
     def data_dir_exists(self):
         """Returns True if data_dir exists"""
         return os.path.exists(self.data_dir)
 
     def history_exists(self):
         """Returns True if history file exists"""
-        return os.path.exists(self.history_filename)
+        return self._store.exists()
+
+    @property
+    def history_backend(self):
+        """How the history is stored, see default_history_backend"""
+        if isinstance(self._store, sqlite_history.SqliteHistory):
+            return "sqlite"
+        return "json"
+
+    def history_files(self):
+        """Absolute paths to the files the history can be stored in, by
+        any backend. Not all of them exist.
+        """
+
+        files = []
+        for backend in history_backends:
+            files.extend(self._history_store(backend).files)
+        return files
+
+    def history_signature(self):
+        """Returns a value that changes whenever the history is written,
+        by this or any other process. Does not read the history.
+        """
+        return history_cache.signature(self.history_files())
+
+    def _history_store(self, backend):
+        """Returns the storage object of a history backend"""
+
+        if backend == "sqlite":
+            return sqlite_history.SqliteHistory(os.path.join(self.data_dir, "history.sqlite"))
+        return journal.Journal(self.history_filename, Utils.metadata_key)
 
     def report_error(self, msg, title):
         """Emits error_update signal to open error dialog"""
@@ -147,54 +441,237 @@ class Utils(QtCore.QObject):
 
         os.makedirs(self.data_dir)
 
-        self._history = Utils.history_template.copy()
+        self._store = self._history_store(self._history_backend)
+        self._history = journal.TrackedDict(Utils.history_template)
+        self._metadata = {}
 
         self.write_history()
 
     def write_history(self):
-        """Writes document history to json"""
+        """Writes the changes made to the document history.
+
+        Changed entries are appended to the history journal, see
+        version_manager.journal. Entries must be replaced rather than
+        changed in place for their changes to be written.
+        """
+
+        usage = self.metadata.get("usage")
+        self._update_usage()
+
+        self._store.write(self.history, self.metadata)
+
+        if self.metadata["usage"] != usage:
+            try:
+                quota.record_usage(self.data_dir, self.metadata["usage"])
+            except Exception as e:
+                self.status_update(f"Cannot update disk usage registry: {e}")
+
+    def _update_usage(self):
+        """Adds the pending changes to the disk usage in the metadata.
+
+        The data directory is walked instead if the usage was never
+        counted or was last counted more than quota.usage_recount_interval
+        seconds ago.
+        """
+
+        change = self._pending_usage()
+        self._usage_change = 0
+        self.objects.usage_change = 0
+        self.pack.usage_change = 0
+        self.thumbnail_atlas.usage_change = 0
+
+        checked = self.metadata.get("usage_checked", 0)
+        if "usage" in self.metadata and time.time() - checked < quota.usage_recount_interval:
+            self.metadata["usage"] += change
+        else:
+            self.metadata["usage"] = quota.directory_usage(self.data_dir)
+            self.metadata["usage_checked"] = time.time()
 
-        with open(self.history_filename, "w") as file_out:
-            json.dump(self.history, file_out, sort_keys=True, indent=4)
+    def _remove_directory(self, directory):
+        """Deletes a directory tree and accounts for the freed space"""
+
+        self._usage_change -= quota.directory_usage(directory)
+        shutil.rmtree(directory)
 
     def read_history(self):
         """Loads document history from disk"""
 
-        if not os.path.exists(self.history_filename):
-            raise FileNotFoundError(f"File not found: {self.history_filename}")
+        if not self.history_exists():
+            raise FileNotFoundError(f"File not found: {self._store.filename}")
 
-        with open(self.history_filename, "r") as file_in:
-            self._history = json.load(file_in)
+        if self.history_backend == "sqlite":
+            # readers of the database are isolated from writers by its log
+            self._history, self._metadata = self._store.read()
+            return
 
-    def lock_history(self):
-        """Locks history json file"""
+        with self._lock.shared():
+            self._history, self._metadata = self._store.read()
 
-        lock_filename = os.path.join(self.data_dir, f"{self.history_basename}.lock")
+    def compact_history(self):
+        """Writes the whole history at once, e.g. history.json and an empty journal"""
 
-        self.status_update(f"Getting lock on {lock_filename}")
+        with self.transaction():
+            self._store.compact(self.history, self.metadata)
 
-        self._lockfile = QtCore.QLockFile(lock_filename)
+    def set_history_backend(self, backend):
+        """Moves the history to another backend
 
-        result = self._lockfile.tryLock(15)
+        Parameters:
+        backend (str) - one of history_backends
+        """
 
-        if not result:
-            reason = ""
-            if result == QtCore.QLockFile.NoError:
-                reason = "NoError"
-            elif result == QtCore.QLockFile.LockFailedError:
-                reason = "LockFailedError"
-            elif result == QtCore.QLockFile.PermissionError:
-                reason = "PermissionError"
-            else:
-                reason = "UnknownError"
-            raise Exception(f"Unable to obtain file lock on {lock_filename}: {reason}")
+        if backend not in history_backends:
+            raise ValueError(f"Unknown history backend: {backend}")
+        if backend == "sqlite" and not sqlite_history.available():
+            raise RuntimeError("The sqlite3 module is not available")
+
+        with self.transaction():
+            if backend == self.history_backend:
+                return
+
+            # the new backend is complete before the old one is removed.
+            # An interrupted move leaves the old history behind, but the
+            # database is preferred when both exist.
+            previous = self._store
+            self._store = self._history_store(backend)
+            self._store.compact(self.history, self.metadata)
+            previous.remove()
+            self.status_update(f"Moved history to {self._store.filename}")
+
+    def export_history(self, filename):
+        """Writes the history in the history.json format, whatever the backend
+
+        Parameters:
+        filename (str) - json file to write
+        """
+
+        history, metadata = self._store.read()
+        data = dict(history)
+        if metadata:
+            data[Utils.metadata_key] = metadata
+
+        tmp_filename = f"{filename}.tmp"
+        with open(tmp_filename, "w") as file_out:
+            json.dump(data, file_out, sort_keys=True, indent=4)
+        os.replace(tmp_filename, filename)
+
+    def _query(self, name, select, *args):
+        """Runs a query on the stored history.
+
+        The database answers it directly. history.json is loaded and
+        filtered with select(history) instead.
+        """
+
+        if isinstance(self._store, sqlite_history.SqliteHistory):
+            return getattr(self._store, name)(*args)
+        history, _ = self._store.read()
+        return select(history)
+
+    def latest_checkpoints(self, count):
+        """Returns the count most recent stored checkpoints as (doc_id, entry) tuples, newest first"""
+
+        def select(history):
+            return sorted(history.items(), key=lambda item: item[1]["mtime"], reverse=True)[:count]
+
+        return self._query("latest", select, count)
+
+    def checkpoints_between(self, start, end):
+        """Returns the stored checkpoints with start <= mtime < end as (doc_id, entry) tuples, oldest first"""
+
+        def select(history):
+            return sorted(
+                (item for item in history.items() if start <= item[1]["mtime"] < end),
+                key=lambda item: item[1]["mtime"],
+            )
+
+        return self._query("between", select, start, end)
+
+    def checkpoints_with_digest(self, digest):
+        """Returns the stored checkpoints with a payload digest as (doc_id, entry) tuples, oldest first"""
+
+        def select(history):
+            return sorted(
+                (item for item in history.items() if item[1].get("digest") == digest),
+                key=lambda item: item[1]["mtime"],
+            )
+
+        return self._query("with_digest", select, digest)
+
+    def checkpoints_by_owner(self, owner):
+        """Returns the stored checkpoints of an owner as (doc_id, entry) tuples, oldest first"""
+
+        def select(history):
+            return sorted(
+                (item for item in history.items() if item[1].get("owner") == owner),
+                key=lambda item: item[1]["mtime"],
+            )
+
+        return self._query("by_owner", select, owner)
+
+    def lock_history(self):
+        """Locks history json file for writing.
+
+        Waits for other writers and for readers, see version_manager.history_lock
+        """
+
+        self.status_update(f"Getting lock on {self._lock.filename}")
+        self._lock.lock_exclusive()
         self.status_update("Lock aquired")
 
     def unlock_history(self):
         """Unlock history json file"""
 
-        self._lockfile.unlock()
-        self._lockfile = None
+        self._lock.unlock_exclusive()
+
+    @property
+    def lock_stats(self):
+        """Lock wait metrics, see version_manager.history_lock.HistoryLock.stats"""
+        return self._lock.stats
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Context manager for changing the history.
+
+        Locks and loads the history, yields the history dictionary and
+        writes it once when the block completes. The lock is released in
+        any case, nothing is written if the block raises or changed
+        nothing (no entries, metadata or disk usage).
+
+            with vmutils.transaction() as history:
+                entry = dict(history[doc_id])
+                entry["message"] = repr(msg)
+                history[doc_id] = entry
+
+        Transactions nest: a transaction started inside another one uses
+        its lock and history and leaves writing to it. Entries must be
+        replaced rather than changed in place, see
+        version_manager.journal.TrackedDict.
+        """
+
+        if self._transaction_depth:
+            self._transaction_depth += 1
+            try:
+                yield self.history
+            finally:
+                self._transaction_depth -= 1
+            return
+
+        self.lock_history()
+        self._transaction_depth = 1
+        try:
+            self.read_history()
+            metadata = json.loads(json.dumps(self.metadata))
+            yield self.history
+            if (
+                self.history.changed
+                or self.history.removed
+                or self._pending_usage()
+                or self.metadata != metadata
+            ):
+                self.write_history()
+        finally:
+            self._transaction_depth = 0
+            self.unlock_history()
 
     def update_checkpoint_message(self, doc_id, msg):
         """Updates the check-in message for a document
@@ -204,23 +681,68 @@ class Utils(QtCore.QObject):
         msg (str): new message to update document checkpoint with.
         """
 
-        self.lock_history()
-        self.read_history()
-        if doc_id not in self.history:
-            raise IndexError(f"unknown document index {doc_id}")
-        self.history[doc_id]["message"] = repr(msg)
-        self.write_history()
-        self.unlock_history()
+        with self.transaction() as history:
+            if doc_id not in history:
+                raise IndexError(f"unknown document index {doc_id}")
+            entry = dict(history[doc_id])
+            entry["message"] = repr(msg)
+            history[doc_id] = entry
 
-    def add_checkpoint(self, msg=""):
-        """Adds a new checkpoint for the krita document.
+    def set_pinned(self, doc_id, pinned):
+        """Pins a checkpoint. Pinned checkpoints are never removed by thin_history()
 
-        This will store a copy of the krita file as well as
-        a thumbnail and checkpoint metadata.
+        Parameters:
+        doc_id (str): history dictionary key of the checkpoint
+        pinned (bool): new pinned state
+        """
+
+        with self.transaction() as history:
+            if doc_id not in history:
+                raise IndexError(f"unknown document index {doc_id}")
+            entry = dict(history[doc_id])
+            entry["pinned"] = bool(pinned)
+            history[doc_id] = entry
 
+    def mark_loaded(self, doc_id):
+        """Records that a checkpoint was loaded, see quota.policies
+
+        Parameters:
+        doc_id (str): history dictionary key of the checkpoint
+        """
+
+        with self.transaction() as history:
+            if doc_id not in history:
+                raise IndexError(f"unknown document index {doc_id}")
+            entry = dict(history[doc_id])
+            entry["loaded"] = time.time()
+            history[doc_id] = entry
+            self.prune_checkouts()
+
+    def track_file(self, filename, previous_size=0):
+        """Accounts for a file written to the data directory by other code,
+        e.g. a thumbnail.
+
+        Parameters:
+        filename (str): file that was written
+        previous_size (int): size of the file before it was overwritten
+        """
+
+        self._usage_change += quota.file_usage(filename) - previous_size
+
+    def stage_checkpoint(self, thumbnail=None):
+        """Copies the krita document into a staging directory, first phase
+        of add_checkpoint().
+
+        Runs without the history lock, so other instances working on the
+        same history do not wait for the copy. add_checkpoint() then only
+        needs the lock to move the staged files into place.
 
         Arguments:
-        msg - str: Checkpoint message
+        thumbnail (callable) - Writes a thumbnail png to the filename it is
+            called with. Not called if the document is identical to the
+            latest checkpoint, whose thumbnail is reused.
+
+        Returns StagedCheckpoint
         """
 
         # check that krita file exists
@@ -230,19 +752,106 @@ class Utils(QtCore.QObject):
         # get modification time of krita file
         modtime = os.path.getmtime(self.krita_filename)
 
+        staging_dir = os.path.join(self.data_dir, "staging")
+        os.makedirs(staging_dir, exist_ok=True)
+        staged = StagedCheckpoint(
+            tempfile.mkdtemp(prefix="checkpoint_", dir=staging_dir), modtime
+        )
+        try:
+            staged.payload = self.store_payload(self.krita_filename, staged.objects)
+
+            # a look at the history under the shared lock. add_checkpoint()
+            # checks again, worst case the checkpoint has no thumbnail or
+            # is stored as a keyframe.
+            latest = None
+            if self.history_exists():
+                self.read_history()
+                latest = self.latest_checkpoint()
+
+            self._stage_delta(staged, latest)
+
+            if thumbnail is not None:
+                if (
+                    latest is None
+                    or self.history[latest]["digest"] != staged.payload["digest"]
+                    or not self.history[latest]["thumbnail"]
+                ):
+                    staged.thumbnail = os.path.join(staged.directory, "thumbnail.png")
+                    thumbnail(staged.thumbnail)
+                    staged.thumbnails = self._write_pyramid(staged.thumbnail, staged.directory)
+        except BaseException:
+            staged.discard()
+            raise
+        return staged
+
+    def _stage_delta(self, staged, latest):
+        """Computes the delta of a staged payload against the latest
+        checkpoint, see default_max_chain_length.
+
+        Parameters:
+        staged (StagedCheckpoint): checkpoint being staged
+        latest (str): history dictionary key of the latest checkpoint, None if there is none
+        """
+
+        payload = staged.payload
+        if (
+            self._max_chain_length <= 0
+            or latest is None
+            or payload["storage"] != "blob"
+            or self.history[latest].get("storage") != "blob"
+            or self.objects.exists(payload["digest"])
+        ):
+            return
+
+        base = self.history[latest]["digest"]
+        delta_filename = os.path.join(staged.directory, "payload.delta")
+        if self.objects.compute_delta(
+            staged.objects.object_path(payload["digest"]),
+            payload["digest"],
+            base,
+            self._max_chain_length,
+            delta_filename,
+        ):
+            staged.delta = delta_filename
+            staged.delta_base = base
+
+    def add_checkpoint(self, msg="", staged=None):
+        """Adds a new checkpoint for the krita document.
+
+        This will store a copy of the krita file as well as
+        a thumbnail and checkpoint metadata.
+
+        The document is copied by stage_checkpoint() before the history is
+        locked. The lock is only held to allocate an id, move the staged
+        files into place and write the history.
+
+        Arguments:
+        msg - str: Checkpoint message
+        staged - StagedCheckpoint: document staged by stage_checkpoint(). Staged here if None.
+        """
+
+        if staged is None:
+            staged = self.stage_checkpoint()
+
+        modtime = staged.modtime
+
         # more human readable form for displaying in history widget.
         mod_date = datetime.fromtimestamp(modtime)
         date_string = mod_date.strftime("%m/%d/%Y\n%I:%M %p\n%A")
         # date_string += f"\n{mod_date}"
         date_file = mod_date.strftime("%Y_%m_%d__%H_%M_%S_%f")
 
-        self.lock_history()
-        self.read_history()
+        try:
+            with self.transaction():
+                return self._add_staged_checkpoint(staged, msg, date_string, date_file)
+        finally:
+            staged.discard()
+
+    def _add_staged_checkpoint(self, staged, msg, date_string, date_file):
+        """Second phase of add_checkpoint(), runs inside transaction()"""
 
-        short_id = 0
-        while short_id in [int(self.history[entry]["id"]) for entry in self.history]:
-            short_id += 1
-        short_id = "{:04}".format(short_id)
+        modtime = staged.modtime
+        short_id = self.allocate_id()
 
         # name of directory to hold checkpoint data
         dirname = f"doc__{date_file}"
@@ -257,22 +866,59 @@ class Utils(QtCore.QObject):
 
         # quit if an entry for this timestamp already exists
         if dirname in self.history:
-            self.unlock_history()
             raise Exception(
                 "Timestamp for this version of the krita file already exists"
             )
 
         # quit if a document directory for this timestamp already exists
         if os.path.exists(doc_dir):
-            self.unlock_history()
             raise FileExistsError(
                 f"No modifications to save. A checkpoint for this timestamp already exists. {date_string}"
             )
 
+        # move the staged objects into the object store. Identical content
+        # is only stored once.
+        latest = self.latest_checkpoint()
+        payload = staged.payload
+        stored = self.objects.adopt(staged.objects)
+
+        if payload["storage"] == "blob":
+            if payload["digest"] not in stored:
+                self.status_update(f"Content already stored as object {payload['digest']}")
+            elif staged.delta is not None:
+                # the delta was computed by stage_checkpoint(), only use it
+                # if it is still against the latest checkpoint
+                if (
+                    latest is not None
+                    and self.history[latest]["digest"] == staged.delta_base
+                    and self.objects.exists(staged.delta_base)
+                ):
+                    self.objects.commit_delta(payload["digest"], staged.delta)
+                else:
+                    self.status_update(
+                        "Latest checkpoint changed while staging, keeping keyframe"
+                    )
+
+        if latest is not None and self.history[latest]["digest"] == payload["digest"]:
+            if self._duplicate_policy == "refuse":
+                raise FileExistsError(
+                    "No modifications to save. The document is identical to "
+                    f"checkpoint {self.history[latest]['id']}."
+                )
+            self.status_update(
+                f"Document is identical to checkpoint {self.history[latest]['id']}. "
+                "Sharing its payload."
+            )
+            payload = {
+                key: self.history[latest][key]
+                for key in ("storage", "digest", "size", "manifest")
+            }
+            payload["duplicate_of"] = latest
+
         doc_id = str(modtime)
 
         # create copy of document dictionary template
-        self.history[doc_id] = Utils.document_template.copy()
+        entry = Utils.document_template.copy()
 
         if os.name == "nt":
             # sd = win32security.GetFileSecurity(self.krita_filename, win32security.OWNER_SECURITY_INFORMATION)
@@ -292,15 +938,1387 @@ class Utils(QtCore.QObject):
             ("owner", owner),
             ("id", short_id),
         ):
-            self.history[doc_id][key] = value
+            entry[key] = value
 
         # make document data directory
         os.makedirs(doc_dir)
 
-        # copy krita file to document data directory
-        shutil.copyfile(self.krita_filename, os.path.join(doc_dir, checkpoint_filename))
+        entry.update(payload)
+
+        if staged.thumbnails:
+            self._move_thumbnails(staged.directory, doc_dir, staged.thumbnails)
+            entry.update(_thumbnail_fields(staged.thumbnails, doc_dir))
+
+        elif staged.thumbnail is not None and os.path.isfile(staged.thumbnail):
+            target = os.path.join(doc_dir, "thumbnail.png")
+            os.replace(staged.thumbnail, target)
+            self.track_file(target)
+            entry["thumbnail"] = "thumbnail.png"
+            entry["thumbnail_size"] = _size_field(thumbnail.read_image_size(target))
+
+        # identical content looks the same, reuse the thumbnail
+        elif payload.get("duplicate_of") and self.history[latest]["thumbnail"]:
+            for name in self.thumbnail_files(latest):
+                data = self.checkpoint_file_data(latest, name)
+                if data is None:
+                    continue
+                with open(os.path.join(doc_dir, name), "wb") as file_out:
+                    file_out.write(data)
+                self._usage_change += len(data)
+            entry["thumbnail"] = self.history[latest]["thumbnail"]
+            entry["thumbnails"] = list(self.history[latest].get("thumbnails", []))
+            entry["thumbnail_size"] = list(self.history[latest].get("thumbnail_size", []))
+
+        self.history[doc_id] = entry
+        self.metadata["latest"] = doc_id
+        self._update_thumbnail_atlas([doc_id])
+
+        return doc_id, entry
+
+    def allocate_id(self):
+        """Returns the short id (str) for a new checkpoint.
+
+        The next id is kept in the history metadata together with the ids
+        of removed checkpoints (if default_reuse_ids is set), so no scan of
+        the history is needed. Histories without them are migrated here,
+        the result is stored by the next write_history().
+
+        Must be called inside transaction().
+        """
+
+        if "next_id" not in self.metadata:
+            used = set(int(entry["id"]) for entry in self.history.values())
+            self.metadata["next_id"] = max(used) + 1 if used else 0
+            self.metadata["free_ids"] = (
+                [i for i in range(self.metadata["next_id"]) if i not in used]
+                if default_reuse_ids
+                else []
+            )
+
+        free_ids = self.metadata.get("free_ids", [])
+        if default_reuse_ids and free_ids:
+            short_id = heapq.heappop(free_ids)
+        else:
+            short_id = self.metadata["next_id"]
+            self.metadata["next_id"] += 1
+        return "{:04}".format(short_id)
+
+    def release_id(self, doc_id):
+        """Makes the short id of a checkpoint available again before it is
+        removed from the history, see default_reuse_ids.
+
+        Parameters:
+        doc_id (str): history dictionary key of the checkpoint
+        """
+
+        if not default_reuse_ids or "next_id" not in self.metadata:
+            return
+        free_ids = self.metadata.setdefault("free_ids", [])
+        heapq.heappush(free_ids, int(self.history[doc_id]["id"]))
+
+    def store_payload(self, filename, store=None):
+        """Stores a krita file in an object store.
+
+        Parameters:
+        filename (str): krita file to store
+        store (version_manager.blob_store.BlobStore): store receiving the
+            objects. Defaults to the object store of the data directory.
+
+        Returns dictionary of checkpoint fields describing the stored payload
+        """
+
+        if store is None:
+            store = self.objects
+
+        if self._storage_mode == "members":
+            try:
+                manifest, digest, size = kra_archive.split(filename, store)
+            except kra_archive.UnsupportedArchive as e:
+                self.status_update(f"Storing whole file. Cannot split {filename}: {e}")
+            else:
+                manifest_digest, _, _ = store.store_bytes(kra_archive.dumps(manifest))
+                return {
+                    "storage": "members",
+                    "digest": digest,
+                    "size": size,
+                    "manifest": manifest_digest,
+                }
+
+        digest, size, _ = store.store_file(filename)
+        return {"storage": "blob", "digest": digest, "size": size}
+
+    def latest_checkpoint(self):
+        """Returns the key of the most recent checkpoint with a stored payload
+
+        The latest checkpoint is recorded in the history metadata. The
+        history is only searched if it is not recorded or was deleted.
+
+        Returns None if there is no such checkpoint.
+        """
+
+        latest = self.metadata.get("latest")
+        if latest in self.history and self.history[latest].get("digest"):
+            return latest
+
+        stored = [doc_id for doc_id in self.history if self.history[doc_id].get("digest")]
+        if not stored:
+            return None
+        return max(stored, key=lambda doc_id: self.history[doc_id]["mtime"])
+
+    def read_manifest(self, doc_id):
+        """Returns the zip member manifest of a checkpoint stored as members"""
+
+        return kra_archive.loads(
+            self.objects.read_bytes(self.history[doc_id]["manifest"])
+        )
+
+    def checkpoint_filename(self, doc_id):
+        """Returns path to a krita file holding the given checkpoint.
+
+        Checkpoints stored in the object store are checked out into
+        checkout_dir first. Whole file objects are hard linked when
+        possible, checkpoints stored as zip members are rebuilt. Only a
+        few rebuilt copies are kept, see prune_checkouts().
+
+        Parameters:
+        doc_id (str): history dictionary key of the checkpoint
+        """
+
+        if doc_id not in self.history:
+            raise IndexError(f"unknown document index {doc_id}")
+
+        filename = os.path.join(self.checkout_dir, self.history[doc_id]["filename"])
+        before = quota.file_usage(filename) if os.path.exists(filename) else 0
+
+        result = self._checkout(doc_id, filename)
+
+        after = quota.file_usage(filename) if os.path.exists(filename) else 0
+        self._usage_change += after - before
+        return result
+
+    def _checkout(self, doc_id, filename):
+        """Makes a checkpoint available as filename in checkout_dir.
+
+        Returns the path to the krita file, which is a file in the
+        checkpoint directory for old checkpoints. See checkpoint_filename()
+        """
+
+        entry = self.history[doc_id]
+
+        # checkpoints created before the object store hold their own copy
+        if not entry.get("digest"):
+            doc_filename = os.path.join(self.data_dir, entry["dirname"], entry["filename"])
+            if os.path.exists(doc_filename) or not entry.get("packed"):
+                return doc_filename
+            if not os.path.exists(filename):
+                os.makedirs(self.checkout_dir, exist_ok=True)
+                self.pack.extract(f"{doc_id}/{entry['filename']}", filename)
+            return filename
+
+        os.makedirs(self.checkout_dir, exist_ok=True)
+
+        if entry.get("storage") == "members":
+            manifest = self.read_manifest(doc_id)
+            if os.path.exists(filename) and os.path.getsize(filename) == manifest["size"]:
+                return filename
+            self.status_update(f"Rebuilding {filename}")
+            kra_archive.build(manifest, self.objects, filename)
+            return filename
+
+        object_filename = self.objects.object_path(entry["digest"])
+
+        if not os.path.isfile(object_filename):
+            # rebuilt or unpacked checkouts are kept read-only, like the objects
+            if os.path.exists(filename):
+                if os.path.getsize(filename) == entry["size"] and not (
+                    os.stat(filename).st_mode & stat.S_IWUSR
+                ):
+                    return filename
+                os.chmod(filename, stat.S_IWRITE | stat.S_IREAD)
+                os.remove(filename)
+            self.objects.export(entry["digest"], filename)
+            os.chmod(filename, stat.S_IREAD | stat.S_IRGRP | stat.S_IROTH)
+            return filename
+
+        # reuse previous checkout if it is still linked to the object
+        if os.path.exists(filename):
+            if os.path.samefile(filename, object_filename):
+                return filename
+
+        self.objects.export(entry["digest"], filename, link=True)
+        return filename
+
+    def export_checkpoint(self, doc_id, target):
+        """Writes a copy of a checkpoint to a file
+
+        Parameters:
+        doc_id (str): history dictionary key of the checkpoint
+        target (str): krita file to write
+        """
+
+        if doc_id not in self.history:
+            raise IndexError(f"unknown document index {doc_id}")
+
+        entry = self.history[doc_id]
+
+        if entry.get("storage") == "members":
+            kra_archive.build(self.read_manifest(doc_id), self.objects, target)
+        elif entry.get("digest"):
+            self.objects.export(entry["digest"], target)
+        else:
+            result = copy_engine.copy_file(self.checkpoint_filename(doc_id), target)
+            self.status_update(f"Copied {doc_id} -> {target} ({result})")
+
+    def referenced_objects(self, doc_ids=None):
+        """Returns set of object digests used by checkpoints
+
+        Parameters:
+        doc_ids (iterable): checkpoints to look at. Defaults to all checkpoints in history.
+        """
+
+        if doc_ids is None:
+            doc_ids = self.history
+
+        referenced = set()
+        for doc_id in doc_ids:
+            entry = self.history[doc_id]
+            if entry.get("storage") == "members":
+                referenced.add(entry["manifest"])
+                referenced.update(kra_archive.referenced_objects(self.read_manifest(doc_id)))
+            elif entry.get("digest"):
+                referenced.add(entry["digest"])
+        return referenced
+
+    def checkpoint_file_data(self, doc_id, name):
+        """Returns the content of a file in a checkpoint's directory
+
+        Looks in the pack for checkpoints that have been packed.
+
+        Parameters:
+        doc_id (str): history dictionary key of the checkpoint
+        name (str): basename of the file, e.g. "thumbnail.png"
 
+        Returns None if the file does not exist.
+        """
+
+        entry = self.history[doc_id]
+        filename = os.path.join(self.data_dir, entry["dirname"], name)
+        if os.path.isfile(filename):
+            with open(filename, "rb") as file_in:
+                return file_in.read()
+
+        if entry.get("packed"):
+            key = f"{doc_id}/{name}"
+            if key in self.pack:
+                return self.pack.read(key)
+
+        return None
+
+    def checkpoint_member_data(self, doc_id, name):
+        """Returns the content of a member of a checkpoint's krita archive,
+        e.g. "preview.png". The checkpoint is not checked out.
+
+        Parameters:
+        doc_id (str): history dictionary key of the checkpoint
+        name (str): member name
+
+        Returns None if the archive has no such member. Raises
+        kra_archive.UnsupportedArchive if the checkpoint is not a zip file.
+        """
+
+        entry = self.history[doc_id]
+
+        if entry.get("storage") == "members":
+            return kra_archive.read_member(self.read_manifest(doc_id), self.objects, name)
+
+        if entry.get("digest"):
+            file_in = self.objects.open(entry["digest"])
+        else:
+            # checkpoints created before the object store hold their own copy
+            doc_filename = os.path.join(self.data_dir, entry["dirname"], entry["filename"])
+            if os.path.exists(doc_filename) or not entry.get("packed"):
+                file_in = open(doc_filename, "rb")
+            else:
+                file_in = self.pack.open(f"{doc_id}/{entry['filename']}")
+
+        with file_in:
+            return kra_archive.read_archive_member(file_in, name)
+
+    def has_thumbnail(self, doc_id):
+        """Returns True if the thumbnail of a checkpoint exists
+
+        Parameters:
+        doc_id (str): history dictionary key of the checkpoint
+        """
+
+        entry = self.history[doc_id]
+        if not entry["thumbnail"]:
+            return False
+        if os.path.isfile(os.path.join(self.data_dir, entry["dirname"], entry["thumbnail"])):
+            return True
+        return bool(entry.get("packed")) and f"{doc_id}/{entry['thumbnail']}" in self.pack
+
+    def thumbnail_files(self, doc_id):
+        """Returns the names of a checkpoint's thumbnail files, the levels
+        (see version_manager.thumbnail.pyramid_levels) and the thumbnail
+        of checkpoints made before there were levels.
+
+        Parameters:
+        doc_id (str): history dictionary key of the checkpoint
+        """
+
+        entry = self.history[doc_id]
+        names = [thumbnail.level_filename(level) for level in entry.get("thumbnails", [])]
+        if entry["thumbnail"] and entry["thumbnail"] not in names:
+            names.append(entry["thumbnail"])
+        return names
+
+    def _write_pyramid(self, filename, directory):
+        """Writes the thumbnail levels of an image, see
+        version_manager.thumbnail.write_pyramid().
+
+        Returns list of the levels written, empty if the image cannot be read.
+        """
+
+        try:
+            return thumbnail.write_pyramid(thumbnail.load(filename), directory)
+        except thumbnail.ThumbnailError as e:
+            self.status_update(str(e))
+            return []
+
+    def _move_thumbnails(self, source_dir, doc_dir, levels):
+        """Moves thumbnail levels into a checkpoint directory, replacing
+        the files that are there already.
+        """
+
+        for level in levels:
+            name = thumbnail.level_filename(level)
+            target = os.path.join(doc_dir, name)
+            previous = quota.file_usage(target) if os.path.exists(target) else 0
+            os.replace(os.path.join(source_dir, name), target)
+            self.track_file(target, previous)
+
+    def _set_thumbnails(self, doc_id, levels):
+        """Points a checkpoint to new thumbnail levels in its directory and
+        removes the loose thumbnail files they replace.
+
+        Parameters:
+        doc_id (str): history dictionary key of the checkpoint
+        levels (list): levels moved into the checkpoint directory
+        """
+
+        entry = dict(self.history[doc_id])
+        fields = _thumbnail_fields(levels, os.path.join(self.data_dir, entry["dirname"]))
+        keep = set(thumbnail.level_filename(level) for level in levels)
+
+        for name in self.thumbnail_files(doc_id):
+            filename = os.path.join(self.data_dir, entry["dirname"], name)
+            if name not in keep and os.path.isfile(filename):
+                self._usage_change -= quota.file_usage(filename)
+                os.remove(filename)
+
+        entry.update(fields)
+        self.history[doc_id] = entry
+        self._update_thumbnail_atlas([doc_id])
+
+    def _install_thumbnail(self, doc_id, write):
+        """Replaces the thumbnail levels of a checkpoint.
+
+        Parameters:
+        doc_id (str): history dictionary key of the checkpoint
+        write (callable): writes the levels into the directory it is called
+            with and returns the list of levels written
+        """
+
+        with self.transaction():
+            doc_dir = os.path.join(self.data_dir, self.history[doc_id]["dirname"])
+            os.makedirs(doc_dir, exist_ok=True)
+            tmp_dir = tempfile.mkdtemp(prefix="tmp_", dir=doc_dir)
+            try:
+                levels = write(tmp_dir)
+                self._move_thumbnails(tmp_dir, doc_dir, levels)
+            finally:
+                shutil.rmtree(tmp_dir)
+            self._set_thumbnails(doc_id, levels)
+
+    def make_thumbnail(self, doc_id):
+        """Makes the thumbnail levels of a checkpoint from its archive.
+
+        Parameters:
+        doc_id (str): history dictionary key of the checkpoint
+
+        Raises thumbnail.ThumbnailError or kra_archive.UnsupportedArchive if
+        the archive holds no usable image.
+        """
+
+        def write(directory):
+            return thumbnail.save_pyramid(
+                functools.partial(self.checkpoint_member_data, doc_id), directory
+            )
+
+        self._install_thumbnail(doc_id, write)
+
+    def set_thumbnail_image(self, doc_id, filename):
+        """Makes the thumbnail levels of a checkpoint from an image, e.g.
+        one rendered by Krita.
+
+        Parameters:
+        doc_id (str): history dictionary key of the checkpoint
+        filename (str): png file
+        """
+
+        def write(directory):
+            return thumbnail.write_pyramid(thumbnail.load(filename), directory)
+
+        self._install_thumbnail(doc_id, write)
+
+    def set_thumbnail_atlas(self, enabled):
+        """Turns the thumbnail atlas on or off.
+
+        The atlas is a pack file (see version_manager.packfile) holding a
+        copy of every loose thumbnail file. Views read thumbnails from its
+        memory map, so showing the history opens a single file instead of
+        one per checkpoint. The loose files are kept, the atlas can be
+        removed at any time.
+
+        Parameters:
+        enabled (bool): True to build the atlas, False to remove it
+        """
+
+        with self.transaction():
+            self.metadata["thumbnail_atlas"] = bool(enabled)
+            atlas = self.thumbnail_atlas
+            if enabled:
+                self._update_thumbnail_atlas(sorted(self.history))
+                self.status_update(f"Thumbnail atlas holds {len(atlas)} thumbnails")
+                return
+
+            atlas.delete()
+
+    def _update_thumbnail_atlas(self, doc_ids):
+        """Copies the loose thumbnail files of checkpoints into the
+        thumbnail atlas, replacing what it holds for them. Does nothing if
+        the atlas is turned off.
+
+        Thumbnails of packed checkpoints are read from the pack file and
+        not copied.
+        """
+
+        if not self.use_thumbnail_atlas:
+            return
+
+        atlas = self.thumbnail_atlas
+        obsolete = []
+        records = []
+        for doc_id in doc_ids:
+            entry = self.history[doc_id]
+            names = self.thumbnail_files(doc_id)
+            if atlas.exists():
+                obsolete.extend(
+                    key
+                    for key, _ in atlas.items(f"{doc_id}/")
+                    if key.split("/", 1)[1] not in names
+                )
+            for name in names:
+                filename = os.path.join(self.data_dir, entry["dirname"], name)
+                if os.path.isfile(filename):
+                    records.append((f"{doc_id}/{name}", filename))
+
+        if obsolete:
+            atlas.remove(obsolete)
+        if records:
+            atlas.append(records)
+
+    def record_thumbnail_sizes(self):
+        """Stores the thumbnail size of checkpoints made before sizes were
+        stored. Only the headers of the thumbnails are decoded.
+
+        The history must be locked.
+
+        Returns number of checkpoints updated
+        """
+
+        count = 0
+        for doc_id in sorted(self.history):
+            entry = self.history[doc_id]
+            if entry.get("thumbnail_size") or not entry["thumbnail"]:
+                continue
+            levels = entry.get("thumbnails")
+            name = thumbnail.level_filename(max(levels)) if levels else entry["thumbnail"]
+            data = self.checkpoint_file_data(doc_id, name)
+            if data is None:
+                continue
+            size = _size_field(thumbnail.image_size(data))
+            if size:
+                entry = dict(entry)
+                entry["thumbnail_size"] = size
+                self.history[doc_id] = entry
+                count += 1
+        return count
+
+    def regenerate_thumbnails(self, missing_only=False, levels=None, max_workers=None, cancel=None):
+        """Makes new thumbnails for the checkpoints, in parallel.
+
+        Thumbnails are read from the checkpoints' archives (see
+        version_manager.thumbnail) and moved into the checkpoint
+        directories as thumbnail levels once all are made. The history is
+        not locked while they are made, the levels are moved and the
+        history is written under a single lock at the end.
+
+        Parameters:
+        missing_only (bool): Only make thumbnails of checkpoints that have
+            none. The sizes of existing thumbnails are recorded where they
+            are missing, see record_thumbnail_sizes().
+        levels (list): Widths of the thumbnail levels (see thumbnail.pyramid_levels)
+        max_workers (int): Number of parallel tasks. Defaults to the number of cores.
+        cancel (threading.Event): Stops making thumbnails once set. The
+            thumbnails made so far are kept.
+
+        Returns list of keys of the checkpoints with new thumbnails
+        """
+
+        levels = levels or thumbnail.pyramid_levels
+
+        # only read here, the history is written once at the end
+        self.read_history()
+        candidates = sorted(
+            doc_id
+            for doc_id in self.history
+            if not missing_only or not self.has_thumbnail(doc_id)
+        )
+
+        rendered = self._render_thumbnails(candidates, levels, max_workers, cancel)
+        done = []
+        try:
+            with self.transaction():
+                for doc_id, (source_dir, written) in rendered.items():
+                    # removed while its thumbnail was made
+                    if doc_id not in self.history:
+                        continue
+                    doc_dir = os.path.join(self.data_dir, self.history[doc_id]["dirname"])
+                    os.makedirs(doc_dir, exist_ok=True)
+                    self._move_thumbnails(source_dir, doc_dir, written)
+                    self._set_thumbnails(doc_id, written)
+                    done.append(doc_id)
+
+                if missing_only:
+                    self.record_thumbnail_sizes()
+
+                # replaced thumbnails are left behind in the atlas
+                if done and self.thumbnail_atlas.exists():
+                    self.compact_pack()
+        finally:
+            for source_dir, _ in rendered.values():
+                shutil.rmtree(source_dir, ignore_errors=True)
+
+        if not candidates:
+            self.status_update("No thumbnails to regenerate")
+            return []
+
+        self.status_update(f"Regenerated {len(done)} of {len(candidates)} thumbnails")
+        return done
+
+    def _render_thumbnails(self, doc_ids, levels, max_workers, cancel):
+        """Writes the thumbnail levels of checkpoints in parallel.
+
+        Each task writes into its own directory in the staging directory.
+        The caller moves the levels into place under the history lock and
+        removes the directories. Directories left by a crash are removed
+        by prune_objects().
+
+        Parameters:
+        doc_ids (list): keys of the checkpoints
+        levels (list): Widths of the thumbnail levels
+        max_workers (int): Number of parallel tasks
+        cancel (threading.Event): Stops making thumbnails once set (optional)
+
+        Returns dictionary of checkpoint key -> (directory, levels written)
+        """
+
+        if not doc_ids:
+            return {}
+
+        staging_dir = os.path.join(self.data_dir, "staging")
+        os.makedirs(staging_dir, exist_ok=True)
+
+        done = {}
+        pending = {}
+
+        try:
+            with _executor(max_workers) as executor:
+                for doc_id in doc_ids:
+                    target = tempfile.mkdtemp(prefix="thumbnails_", dir=staging_dir)
+                    future = executor.submit(
+                        _thumbnail_task, self.krita_filename, doc_id, target, levels
+                    )
+                    pending[future] = (doc_id, target)
+
+                for count, future in enumerate(
+                    concurrent.futures.as_completed(list(pending)), 1
+                ):
+                    doc_id, target = pending.pop(future)
+                    try:
+                        done[doc_id] = (target, future.result())
+                    except Exception as e:
+                        # FileNotFoundError if the checkpoint was removed meanwhile
+                        self.status_update(f"Cannot make thumbnail of {doc_id}: {e}")
+                        shutil.rmtree(target, ignore_errors=True)
+
+                    self.status_update(f"Regenerated thumbnail {count}/{len(doc_ids)}")
+                    self.progress_update.emit(count, len(doc_ids))
+
+                    if cancel is not None and cancel.is_set():
+                        self.status_update("Thumbnail regeneration cancelled")
+                        for waiting in pending:
+                            waiting.cancel()
+                        break
+        except BaseException:
+            for target, _ in done.values():
+                shutil.rmtree(target, ignore_errors=True)
+            raise
+        finally:
+            # cancelled or failed tasks
+            for _, target in pending.values():
+                shutil.rmtree(target, ignore_errors=True)
+
+        return done
+
+    def remove_checkpoint_files(self, doc_id):
+        """Deletes the directory of a checkpoint and its files in the pack
+
+        The history must be locked and loaded. Objects are removed by
+        prune_objects().
+        """
+
+        entry = self.history[doc_id]
+        doc_dir = os.path.join(self.data_dir, entry["dirname"])
+
+        if not os.path.isdir(doc_dir) and not entry.get("packed"):
+            raise FileNotFoundError(f"Document directory not found: {doc_dir}")
+
+        if os.path.isdir(doc_dir):
+            self._remove_directory(doc_dir)
+
+        if entry.get("packed"):
+            self.pack.remove([key for key, _ in self.pack.items(f"{doc_id}/")])
+
+        if self.thumbnail_atlas.exists():
+            self.thumbnail_atlas.remove(
+                [key for key, _ in self.thumbnail_atlas.items(f"{doc_id}/")]
+            )
+
+    def repack(self, older_than=None, keep_loose=None):
+        """Moves old checkpoints into the pack file.
+
+        The files in a checkpoint's directory and the objects only used by
+        packed checkpoints are appended to a single pack file, and the
+        loose copies are deleted.
+
+        Parameters:
+        older_than (float): Only pack checkpoints older than this number of days
+        keep_loose (int): Number of most recent checkpoints that stay loose
+
+        Returns list of keys of the packed checkpoints
+        """
+
+        older_than = default_repack_age if older_than is None else older_than
+        keep_loose = default_repack_keep if keep_loose is None else keep_loose
+        cutoff = time.time() - older_than * 24 * 60 * 60
+
+        with self.transaction():
+
+            newest_first = sorted(
+                self.history, key=lambda doc_id: self.history[doc_id]["mtime"], reverse=True
+            )
+            candidates = [
+                doc_id
+                for doc_id in newest_first[keep_loose:]
+                if not self.history[doc_id].get("packed")
+                and self.history[doc_id]["mtime"] < cutoff
+            ]
+            if not candidates:
+                self.status_update("No checkpoints to pack")
+                return []
+
+            loose = [
+                doc_id
+                for doc_id in newest_first
+                if not self.history[doc_id].get("packed") and doc_id not in candidates
+            ]
+            keep_objects = self.objects.closure(self.referenced_objects(loose))
+            pack_objects = (
+                self.objects.closure(self.referenced_objects(candidates)) - keep_objects
+            )
+
+            records = self.objects.loose_records(pack_objects)
+            for doc_id in candidates:
+                doc_dir = os.path.join(self.data_dir, self.history[doc_id]["dirname"])
+                if not os.path.isdir(doc_dir):
+                    continue
+                for name in sorted(os.listdir(doc_dir)):
+                    filename = os.path.join(doc_dir, name)
+                    if os.path.isfile(filename):
+                        records.append((f"{doc_id}/{name}", filename))
+
+            self.status_update(f"Packing {len(candidates)} checkpoints ({len(records)} files)")
+            self.pack.append(records)
+
+            for doc_id in candidates:
+                entry = dict(self.history[doc_id])
+                entry["packed"] = True
+                self.history[doc_id] = entry
+            # written before the loose copies are deleted
+            self.write_history()
+
+            # everything is in the pack now, remove the loose copies
+            for doc_id in candidates:
+                doc_dir = os.path.join(self.data_dir, self.history[doc_id]["dirname"])
+                if os.path.isdir(doc_dir):
+                    self._remove_directory(doc_dir)
+            for digest in pack_objects:
+                self.objects.remove(digest)
+
+            self.compact_pack()
+
+            self.status_update(f"Packed {len(candidates)} checkpoints")
+            return candidates
+
+    def thin_history(self, rules=None, dry_run=False, only=None):
+        """Removes checkpoints according to a retention policy.
+
+        All checkpoints are removed under a single lock, with one write of
+        the history. A dry run only reads the history, under the shared
+        lock.
+
+        Parameters:
+        rules (sequence): (maximum age, interval) pairs, see version_manager.retention.default_rules
+        dry_run (bool): Only return the checkpoints that would be removed
+        only (iterable): Remove no other checkpoints than these, e.g. the
+            result of a dry run the user confirmed. The policy may select
+            fewer by now, e.g. once newer checkpoints were added.
+
+        Returns list of keys of the removed checkpoints, oldest first
+        """
+
+        if dry_run:
+            self.read_history()
+            removed = retention.thin(self.history, rules)
+            self.status_update(f"{len(removed)} checkpoints to remove")
+            return removed
+
+        with self.transaction():
+
+            removed = retention.thin(self.history, rules)
+            if only is not None:
+                only = set(only)
+                removed = [doc_id for doc_id in removed if doc_id in only]
+            if not removed:
+                self.status_update(f"{len(removed)} checkpoints to remove")
+                return removed
+
+            self._remove_checkpoints(removed)
+
+        self.status_update(f"Removed {len(removed)} checkpoints")
+        return removed
+
+    def _remove_checkpoints(self, doc_ids):
+        """Removes checkpoints with a single write of the history, then
+        deletes the objects no longer used.
+
+        Must be called inside transaction(), which records the freed space.
+        """
+
+        for doc_id in doc_ids:
+            self.status_update(f"Removing checkpoint {self.history[doc_id]['id']}")
+            try:
+                self.remove_checkpoint_files(doc_id)
+            except FileNotFoundError as e:
+                self.status_update(str(e))
+            self.release_id(doc_id)
+            del self.history[doc_id]
         self.write_history()
-        self.unlock_history()
 
-        return doc_id, self.history[doc_id]
+        self.prune_objects()
+        if self.pack.exists() or self.thumbnail_atlas.exists():
+            self.compact_pack()
+
+    def remove_checkpoints(self, doc_ids, keep_pinned=True):
+        """Removes checkpoints unless they are pinned.
+
+        Parameters:
+        doc_ids (iterable): history dictionary keys of the checkpoints
+        keep_pinned (bool): Leave pinned checkpoints alone
+
+        Returns list of keys of the removed checkpoints
+        """
+
+        with self.transaction():
+            removed = [
+                doc_id
+                for doc_id in doc_ids
+                if doc_id in self.history
+                and not (keep_pinned and self.history[doc_id].get("pinned"))
+            ]
+            if removed:
+                self._remove_checkpoints(removed)
+
+        return removed
+
+    def set_quota(self, limit, policy=None):
+        """Sets the quota of the data directory
+
+        Parameters:
+        limit (int): maximum number of bytes, 0 for no limit
+        policy (str): which checkpoints are evicted first, see quota.policies
+        """
+
+        if policy is not None and policy not in quota.policies:
+            raise ValueError(f"Unknown eviction policy: {policy}")
+
+        with self.transaction():
+            self.metadata["quota"] = int(limit)
+            if policy is not None:
+                self.metadata["eviction_policy"] = policy
+
+    def _needed_objects(self):
+        """Returns dictionary of checkpoint key -> set of the object digests
+        needed to rebuild the checkpoint
+        """
+
+        return {
+            doc_id: self.objects.closure(self.referenced_objects([doc_id]))
+            for doc_id in self.history
+        }
+
+    def eviction_candidates(self, needed=None):
+        """Returns the checkpoints that may be evicted to free space.
+
+        Pinned checkpoints and the latest checkpoint are never evicted.
+        The history must be loaded.
+
+        Parameters:
+        needed (dict): result of _needed_objects(), computed if None
+
+        Returns list of dictionaries with the keys
+            doc_id - history dictionary key
+            mtime, loaded - see document_template
+            size - bytes freed by removing only this checkpoint
+            files - bytes used by the checkpoint's own files and checkout
+            objects - object digest -> stored bytes of the objects the
+                checkpoint needs
+            needed_by - object digest -> number of checkpoints needing the
+                object, the same for all candidates
+        """
+
+        latest = self.latest_checkpoint()
+
+        if needed is None:
+            needed = self._needed_objects()
+        counts = collections.Counter()
+        for digests in needed.values():
+            counts.update(digests)
+
+        candidates = []
+        for doc_id, entry in self.history.items():
+            if doc_id == latest or entry.get("pinned"):
+                continue
+
+            files = 0
+            doc_dir = os.path.join(self.data_dir, entry["dirname"])
+            if os.path.isdir(doc_dir):
+                files += quota.directory_usage(doc_dir)
+            if entry.get("packed"):
+                files += sum(size for _, size in self.pack.items(f"{doc_id}/"))
+            checkout = os.path.join(self.checkout_dir, entry["filename"])
+            if os.path.isfile(checkout):
+                files += quota.file_usage(checkout)
+
+            objects = {digest: self.objects.stored_size(digest) for digest in needed[doc_id]}
+            exclusive = sum(
+                size for digest, size in objects.items() if counts[digest] == 1
+            )
+
+            candidates.append(
+                {
+                    "doc_id": doc_id,
+                    "mtime": entry["mtime"],
+                    "loaded": entry.get("loaded", 0.0),
+                    "size": files + exclusive,
+                    "files": files,
+                    "objects": objects,
+                    "needed_by": counts,
+                }
+            )
+
+        return candidates
+
+    def _select_evictions(self, amount, policy):
+        """Returns (keys of the checkpoints to evict to free amount bytes,
+        bytes freed), see quota.select_candidates(). The history must be
+        loaded.
+        """
+
+        candidates = quota.order_candidates(self.eviction_candidates(), policy)
+        selected, freed = quota.select_candidates(candidates, amount)
+        return [candidate["doc_id"] for candidate in selected], freed
+
+    def enforce_quota(self, incoming=0):
+        """Evicts checkpoints until the data directory is within its quota.
+
+        Parameters:
+        incoming (int): number of bytes about to be added
+
+        Returns list of keys of the evicted checkpoints
+        """
+
+        evicted = []
+
+        if not self._transaction_depth:
+            # most calls have nothing to evict, look without the writer lock
+            self.read_history()
+            if self._quota_excess(incoming) <= 0:
+                return []
+
+        with self.transaction():
+
+            excess = self._quota_excess(incoming)
+            if excess <= 0:
+                return []
+
+            self.status_update(
+                "Disk usage {} exceeds quota of {}. Evicting {} checkpoints first.".format(
+                    quota.format_size(self.usage + incoming),
+                    quota.format_size(self.quota),
+                    self.eviction_policy.replace("_", " "),
+                )
+            )
+            evicted, freed = self._select_evictions(excess, self.eviction_policy)
+            if evicted:
+                self._remove_checkpoints(evicted)
+            else:
+                self.status_update(
+                    "Quota still exceeded, no checkpoints evicted: evicting all unpinned "
+                    "checkpoints but the latest would only free {}, the rest is needed by "
+                    "the checkpoints kept".format(quota.format_size(freed))
+                )
+
+        return evicted
+
+    def _quota_excess(self, incoming):
+        """Returns the number of bytes by which the data directory would
+        exceed its quota after adding incoming bytes, 0 or less if it
+        would not (or there is no quota)
+        """
+
+        if not self.quota:
+            return 0
+        return self.usage + incoming - self.quota
+
+    def quota_warning(self, incoming):
+        """Returns a message if adding a number of bytes would exceed the
+        document or the global quota, None otherwise.
+
+        Parameters:
+        incoming (int): number of bytes about to be added
+        """
+
+        if self.history_exists():
+            self.read_history()
+
+        messages = []
+        if self.quota and self.usage + incoming > self.quota:
+            messages.append(
+                "This document's checkpoints would use {} of its {} quota.".format(
+                    quota.format_size(self.usage + incoming),
+                    quota.format_size(self.quota),
+                )
+            )
+
+        registry = quota.read_registry()
+        total = quota.global_usage(registry) + incoming
+        if registry["quota"] and total > registry["quota"]:
+            messages.append(
+                "All documents' checkpoints would use {} of the global {} quota.".format(
+                    quota.format_size(total), quota.format_size(registry["quota"])
+                )
+            )
+
+        if not messages:
+            return None
+        messages.append("Unpinned checkpoints will be evicted to make room.")
+        return "\n".join(messages)
+
+
+    def compact_pack(self):
+        """Reclaims the space of removed data in the pack file and the
+        thumbnail atlas once it is more than half of the file.
+
+        The history must be locked.
+        """
+
+        for pack, name in ((self.pack, "pack file"), (self.thumbnail_atlas, "thumbnail atlas")):
+            if pack.exists() and pack.garbage() > os.path.getsize(pack.pack_filename) // 2:
+                self.status_update(f"Compacting {name}")
+                pack.compact()
+
+    def recompress(self, older_than=None, max_workers=None):
+        """Recompresses the payloads of old checkpoints with LZMA.
+
+        Old checkpoints stored as whole files are split into zip members
+        first. The members are recompressed in parallel, one member per
+        task. Members shared with newer checkpoints are left alone, so
+        loading recent checkpoints does not get slower.
+
+        The history is only locked while choosing the members and while
+        replacing them, not during the recompression.
+
+        Parameters:
+        older_than (float): Only recompress checkpoints older than this number of days
+        max_workers (int): Number of parallel tasks. Defaults to the number of cores.
+
+        Returns list of keys of the recompressed checkpoints
+        """
+
+        if older_than is None:
+            older_than = default_recompress_age
+        cutoff = time.time() - older_than * 24 * 60 * 60
+
+        with self.transaction():
+
+            candidates = [
+                doc_id
+                for doc_id in self.history
+                if self.history[doc_id]["mtime"] < cutoff
+                and self.history[doc_id].get("digest")
+                and not self.history[doc_id].get("codec")
+            ]
+            if not candidates:
+                self.status_update("No checkpoints to recompress")
+                return []
+
+            recent = [
+                doc_id
+                for doc_id in self.history
+                if self.history[doc_id]["mtime"] >= cutoff
+            ]
+            keep_objects = self.objects.closure(self.referenced_objects(recent))
+
+            for doc_id in candidates:
+                if (
+                    self.history[doc_id]["storage"] == "blob"
+                    and self.history[doc_id]["digest"] not in keep_objects
+                ):
+                    self.split_checkpoint(doc_id)
+
+            candidates = [
+                doc_id for doc_id in candidates if self.history[doc_id]["storage"] == "members"
+            ]
+
+            # zip compression method of each member object to recompress
+            tasks = {}
+            for doc_id in candidates:
+                for member in self.read_manifest(doc_id)["members"]:
+                    digest = member["digest"]
+                    if digest in keep_objects or digest in tasks:
+                        continue
+                    if self.objects.is_delta(digest) or self.objects.is_recompressed(digest):
+                        continue
+                    tasks[digest] = member["compress_type"]
+
+        recompressed = self._recompress_objects(tasks, max_workers)
+
+        with self.transaction():
+            self.objects.store_recompressed(recompressed)
+
+            candidates = [doc_id for doc_id in candidates if doc_id in self.history]
+            for doc_id in candidates:
+                entry = dict(self.history[doc_id])
+                entry["codec"] = "lzma"
+                self.history[doc_id] = entry
+            self.write_history()
+
+            # whole file objects of split checkpoints
+            self.prune_objects()
+            if self.pack.exists():
+                self.compact_pack()
+
+        self.status_update(f"Recompressed {len(candidates)} checkpoints")
+        return candidates
+
+    def _recompress_objects(self, tasks, max_workers):
+        """Recompresses objects in parallel.
+
+        Parameters:
+        tasks (dict): digest -> zip compression method of the objects to recompress
+        max_workers (int): Number of parallel tasks
+
+        Returns list of (digest, recompressed filename) pairs
+        """
+
+        recompressed = []
+        pending = {}
+        saved = 0
+
+        try:
+            with _executor(max_workers) as executor:
+                for digest, compress_type in tasks.items():
+                    filename, offset, size = self.objects.object_range(digest)
+                    fd, target = tempfile.mkstemp(
+                        prefix="tmp_",
+                        suffix=blob_store.recompressed_suffix,
+                        dir=self.objects.root,
+                    )
+                    os.close(fd)
+                    future = executor.submit(
+                        recompress.encode, filename, offset, size, compress_type, target
+                    )
+                    pending[future] = (digest, target, size)
+
+                for count, future in enumerate(
+                    concurrent.futures.as_completed(list(pending)), 1
+                ):
+                    digest, target, size = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        self.status_update(f"Cannot recompress {digest}: {e}")
+                        if os.path.exists(target):
+                            os.remove(target)
+                        continue
+
+                    if result is not None:
+                        recompressed.append((digest, target))
+                        saved += size - result[1]
+                    self.status_update(
+                        "Recompressed {}/{} objects, saved {:.1f} MB".format(
+                            count, len(tasks), saved / 1e6
+                        )
+                    )
+        except BaseException:
+            for _, target in recompressed:
+                os.remove(target)
+            for _, target, _ in pending.values():
+                if os.path.exists(target):
+                    os.remove(target)
+            raise
+
+        return recompressed
+
+    def split_checkpoint(self, doc_id):
+        """Stores a checkpoint stored as a whole file as zip members instead.
+
+        The history must be locked and loaded. The whole file object is
+        left in place, see prune_objects().
+
+        Returns True if the checkpoint was split
+        """
+
+        entry = self.history[doc_id]
+        filename = self.objects.object_path(entry["digest"])
+        tmp_filename = None
+
+        try:
+            if not os.path.isfile(filename):
+                fd, tmp_filename = tempfile.mkstemp(prefix="tmp_", dir=self.data_dir)
+                os.close(fd)
+                self.objects.export(entry["digest"], tmp_filename)
+                filename = tmp_filename
+
+            manifest, digest, _ = kra_archive.split(filename, self.objects)
+        except kra_archive.UnsupportedArchive as e:
+            self.status_update(f"Cannot split checkpoint {entry['id']}: {e}")
+            return False
+        finally:
+            if tmp_filename is not None:
+                os.remove(tmp_filename)
+
+        if digest != entry["digest"]:
+            raise IOError(f"Object {entry['digest']} is corrupt")
+
+        manifest_digest, _, _ = self.objects.store_bytes(kra_archive.dumps(manifest))
+
+        entry = dict(entry)
+        entry["storage"] = "members"
+        entry["manifest"] = manifest_digest
+        self.history[doc_id] = entry
+        return True
+
+    def prune_objects(self):
+        """Removes objects that are no longer referenced by any checkpoint.
+
+        The history must be locked and loaded.
+        """
+
+        for digest in self.objects.prune(self.referenced_objects()):
+            self.status_update(f"Removed unreferenced object {digest}")
+
+        # staging directories left behind by interrupted checkpoints
+        staging_dir = os.path.join(self.data_dir, "staging")
+        if os.path.isdir(staging_dir):
+            for name in os.listdir(staging_dir):
+                directory = os.path.join(staging_dir, name)
+                if time.time() - os.path.getmtime(directory) > stale_staging_age:
+                    self.status_update(f"Removing stale staging directory {directory}")
+                    StagedCheckpoint(directory, 0).discard()
+
+        self.prune_checkouts()
+
+    def prune_checkouts(self):
+        """Removes checkouts of removed checkpoints, and checkouts that are
+        full copies beyond the max_copied_checkouts most recently loaded
+        or checked out ones. Hard linked checkouts take no extra space and
+        are kept.
+
+        The history must be locked and loaded.
+        """
+
+        if not os.path.isdir(self.checkout_dir):
+            return
+
+        filenames = {entry["filename"]: entry for entry in self.history.values()}
+        copies = []
+        for name in os.listdir(self.checkout_dir):
+            filename = os.path.join(self.checkout_dir, name)
+            if name not in filenames:
+                self._remove_checkout(filename)
+                continue
+            info = os.lstat(filename)
+            if info.st_nlink == 1:
+                used = max(filenames[name].get("loaded", 0.0), info.st_mtime)
+                copies.append((used, filename))
+
+        copies.sort(reverse=True)
+        for _, filename in copies[max_copied_checkouts:]:
+            self._remove_checkout(filename)
+
+    def _remove_checkout(self, filename):
+        """Removes a checkout, unless it is in use, e.g. on Windows"""
+
+        size = quota.file_usage(filename)
+        try:
+            # rebuilt checkouts are read-only, like the objects
+            os.chmod(filename, stat.S_IWRITE | stat.S_IREAD)
+            os.remove(filename)
+        except OSError as e:
+            self.status_update(f"Cannot remove checkout {filename}: {e}")
+            return
+        self._usage_change -= size
+
+
+def _remove_readonly(func, path, _):
+    """shutil.rmtree() error handler for read-only files (objects are read-only)"""
+
+    os.chmod(path, stat.S_IWRITE | stat.S_IREAD)
+    func(path)
+
+
+def _executor(max_workers=None):
+    """Returns an executor for CPU heavy tasks.
+
+    Inside Krita, sys.executable is Krita itself and cannot run worker
+    processes. zlib and lzma release the GIL, so threads still keep all
+    cores busy there.
+    """
+
+    if os.path.basename(sys.executable).lower().startswith("python"):
+        # worker processes must not inherit the state of a Qt application
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+    return concurrent.futures.ThreadPoolExecutor(max_workers or os.cpu_count())
+
+
+def _thumbnail_task(krita_filename, doc_id, target, levels):
+    """Writes the thumbnail levels of a checkpoint into the directory
+    target. Runs in a worker process, see Utils.regenerate_thumbnails().
+
+    Returns list of the levels written
+    """
+
+    vmutils = Utils(krita_filename)
+    vmutils.read_history()
+    return thumbnail.save_pyramid(
+        functools.partial(vmutils.checkpoint_member_data, doc_id), target, levels
+    )
+
+
+def _thumbnail_fields(levels, directory):
+    """Returns the checkpoint fields describing stored thumbnail levels.
+
+    "thumbnail" names the level closest to thumbnail.default_resolution,
+    for code that shows a single thumbnail. "thumbnail_size" is the
+    [width, height] of the largest level, read from the level file in
+    directory, so views can size rows without reading thumbnails.
+    """
+
+    level = thumbnail.nearest_level(levels, thumbnail.default_resolution)
+    size = thumbnail.read_image_size(
+        os.path.join(directory, thumbnail.level_filename(max(levels)))
+    )
+    return {
+        "thumbnails": sorted(levels),
+        "thumbnail": thumbnail.level_filename(level),
+        "thumbnail_size": _size_field(size),
+    }
+
+
+def _size_field(size):
+    """Returns [width, height] of a QtCore.QSize, empty if it is invalid"""
+    return [size.width(), size.height()] if size.isValid() else []
+
+
+def enforce_global_quota(incoming=0, reporter=None):
+    """Evicts checkpoints of all registered documents until they are
+    within the global quota, see version_manager.quota.read_registry()
+
+    Parameters:
+    incoming (int): number of bytes about to be added
+    reporter (callable): receives progress messages (optional)
+
+    Returns dictionary of krita filename -> keys of the evicted checkpoints
+    """
+
+    registry = quota.read_registry()
+    if not registry["quota"]:
+        return {}
+    excess = quota.global_usage(registry) + incoming - registry["quota"]
+    if excess <= 0:
+        return {}
+
+    candidates = []
+    for data_dir in registry["documents"]:
+        krita_filename = data_dir[: -len(".d")]
+        if not data_dir.endswith(".d") or not os.path.isfile(krita_filename):
+            continue
+        vmutils = Utils(krita_filename)
+        if not vmutils.history_exists():
+            continue
+        if reporter is not None:
+            vmutils.info_update.connect(reporter)
+        vmutils.read_history()
+        for candidate in vmutils.eviction_candidates():
+            candidate["utils"] = vmutils
+            candidates.append(candidate)
+
+    # objects are not shared between documents, each candidate counts
+    # the checkpoints of its own document needing an object
+    candidates = quota.order_candidates(candidates, registry["policy"])
+    chosen, freed = quota.select_candidates(candidates, excess)
+    if not chosen:
+        if reporter is not None:
+            reporter(
+                "Global quota still exceeded, no checkpoints evicted: evicting all "
+                "unpinned checkpoints but the latest would only free {}".format(
+                    quota.format_size(freed)
+                )
+            )
+        return {}
+
+    selected = collections.defaultdict(list)
+    for candidate in chosen:
+        selected[candidate["utils"]].append(candidate["doc_id"])
+
+    evicted = {}
+    for vmutils, doc_ids in selected.items():
+        evicted[vmutils.krita_filename] = vmutils.remove_checkpoints(doc_ids)
+    return evicted